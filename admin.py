@@ -0,0 +1,207 @@
+import os
+import logging
+from datetime import datetime
+from flask import current_app
+from sqlalchemy import select, update, delete, func, case, and_, or_
+from app import db
+from models import (
+    User, File, Folder, StorageClass, UserTypeUsage, UploadSession, UploadChunk, QuotaReservation, ChangeEvent
+)
+from auth import invalidate_user
+from blobstore import release_blobs, delete_contents, unlink_paths
+from utils import bulk_delete_folders
+from cache import TTLCache
+from search import get_like_pattern
+
+# Columns the admin user list can be sorted by, keyed by the sort values the dashboard accepts
+USER_SORT_KEYS = {
+    'usage': User.storage_used,
+    'registered': User.date_registered,
+    'name': User.username,
+}
+
+_fleet_stats = None
+
+def get_stats_cache():
+    """Get the cache of fleet-wide stats, with its TTL from the config on first use"""
+    global _fleet_stats
+    if _fleet_stats is None:
+        _fleet_stats = TTLCache(maxsize=1, ttl=current_app.config.get('ADMIN_STATS_TTL', 30))
+    return _fleet_stats
+
+def get_users_page(page=1, per_page=50, sort_by='usage', order='desc', query=None, pending=None, exclude_id=None):
+    """Get one page of users, optionally filtered by a username or email substring.
+    
+    `pending` keeps only users awaiting approval (True) or only approved
+    ones (False). Returns a Flask-SQLAlchemy Pagination.
+    """
+    column = USER_SORT_KEYS.get(sort_by, User.storage_used)
+    statement = select(User)
+    if exclude_id is not None:
+        statement = statement.where(User.id != exclude_id)
+    if pending is not None:
+        statement = statement.where(User.is_approved.is_not(True) if pending else User.is_approved.is_(True))
+    if query:
+        pattern = get_like_pattern(query)
+        statement = statement.where(or_(
+            User.username.ilike(pattern, escape='\\'), User.email.ilike(pattern, escape='\\')
+        ))
+    if order == 'asc':
+        statement = statement.order_by(column.asc(), User.id.asc())
+    else:
+        statement = statement.order_by(column.desc(), User.id.desc())
+    return db.paginate(statement, page=page, per_page=per_page, error_out=False)
+
+def compute_fleet_stats(near_quota_ratio=0.9, largest=10):
+    """Compute fleet-wide totals and the largest tenants in one query.
+    
+    The totals are window aggregates over every user, evaluated before the
+    LIMIT keeps only the largest tenants.
+    """
+    near_quota = case(
+        (and_(User.storage_limit > 0, User.storage_used >= User.storage_limit * near_quota_ratio), 1), else_=0
+    )
+    pending = case((User.is_approved, 0), else_=1)
+    rows = db.session.execute(
+        select(
+            User.id, User.username, User.storage_used, User.storage_limit, User.file_count,
+            func.count().over(),
+            func.sum(User.storage_used).over(),
+            func.sum(User.storage_limit).over(),
+            func.sum(User.file_count).over(),
+            func.sum(near_quota).over(),
+            func.sum(pending).over(),
+        )
+        .order_by(User.storage_used.desc(), User.id)
+        .limit(max(largest, 1))
+    ).all()
+    
+    users, total_bytes, total_limit, total_files, near, waiting = rows[0][5:] if rows else (0, 0, 0, 0, 0, 0)
+    return {
+        'users': users,
+        'pending_users': waiting or 0,
+        'total_bytes': total_bytes or 0,
+        'total_limit_bytes': total_limit or 0,
+        'total_files': total_files or 0,
+        'users_near_quota': near or 0,
+        'largest_tenants': [
+            {'id': user_id, 'username': username, 'storage_used': used, 'storage_limit': limit, 'files': files}
+            for user_id, username, used, limit, files, *_ in rows[:largest]
+        ],
+        'computed_at': datetime.utcnow().isoformat(),
+    }
+
+def get_fleet_stats():
+    """Get the fleet-wide stats, recomputed at most every ADMIN_STATS_TTL seconds"""
+    cache = get_stats_cache()
+    stats = cache.get('fleet')
+    if stats is None:
+        stats = compute_fleet_stats(
+            current_app.config.get('ADMIN_NEAR_QUOTA_RATIO', 0.9),
+            current_app.config.get('ADMIN_LARGEST_TENANTS', 10)
+        )
+        cache.set('fleet', stats)
+    return stats
+
+def invalidate_fleet_stats():
+    """Drop the cached fleet-wide stats so the next dashboard view recomputes them"""
+    get_stats_cache().clear()
+
+def apply_to_users(statement, user_ids):
+    """Run one bulk UPDATE or DELETE on users and return how many rows it touched"""
+    try:
+        count = db.session.execute(statement.execution_options(synchronize_session=False)).rowcount
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        logging.error(f"Error updating users: {str(e)}")
+        return None, str(e)
+    
+    for user_id in user_ids:
+        invalidate_user(user_id)
+    invalidate_fleet_stats()
+    return count, None
+
+def approve_users(user_ids):
+    """Approve every pending user among `user_ids` in one statement"""
+    return apply_to_users(
+        update(User).where(User.id.in_(user_ids), User.is_approved.is_not(True)).values(is_approved=True),
+        user_ids
+    )
+
+def reject_users(user_ids, admin_id):
+    """Delete every pending user among `user_ids` in one statement.
+    
+    Only accounts that own nothing yet are removed, so no files or folders
+    are left behind; approved users and the admin themselves are skipped.
+    """
+    return apply_to_users(
+        delete(User).where(
+            User.id.in_(user_ids), User.id != admin_id, User.is_approved.is_not(True),
+            User.file_count == 0, User.folder_count == 0, User.storage_used == 0
+        ),
+        user_ids
+    )
+
+def delete_user(user_id):
+    """Delete a user and everything they own with set-based statements.
+    
+    Every dependent table is cleared explicitly rather than through foreign
+    key cascades, which SQLite leaves off. Stored content and upload scratch
+    files are removed only once the deletion has committed.
+    """
+    try:
+        # Upload sessions point at folders, so they go first
+        session_ids = db.session.execute(
+            select(UploadSession.id).where(UploadSession.user_id == user_id)
+        ).scalars().all()
+        db.session.execute(delete(UploadChunk).where(UploadChunk.session_id.in_(session_ids)))
+        db.session.execute(
+            delete(UploadSession).where(UploadSession.user_id == user_id).execution_options(synchronize_session=False)
+        )
+        
+        root_ids = db.session.execute(
+            select(Folder.id).where(Folder.user_id == user_id, Folder.parent_id.is_(None))
+        ).scalars().all()
+        unused_names = bulk_delete_folders(root_ids, user_id)
+        
+        # Files outside any folder, trashed or not
+        ref_counts = {}
+        for blob_id, filename in db.session.execute(
+            select(File.blob_id, File.filename).where(File.user_id == user_id)
+        ).all():
+            if blob_id:
+                ref_counts[blob_id] = ref_counts.get(blob_id, 0) + 1
+            else:
+                unused_names.append(filename)
+        db.session.execute(delete(File).where(File.user_id == user_id).execution_options(synchronize_session=False))
+        unused_names += release_blobs(ref_counts)
+        
+        for model in (StorageClass, UserTypeUsage, QuotaReservation, ChangeEvent):
+            db.session.execute(
+                delete(model).where(model.user_id == user_id).execution_options(synchronize_session=False)
+            )
+        count = db.session.execute(
+            delete(User).where(User.id == user_id).execution_options(synchronize_session=False)
+        ).rowcount
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        logging.error(f"Error deleting user: {str(e)}")
+        return False, str(e)
+    
+    if not count:
+        return False, "User not found"
+    delete_contents(unused_names)
+    upload_folder = current_app.config['UPLOAD_FOLDER']
+    unlink_paths([os.path.join(upload_folder, f".session_{session_id}") for session_id in session_ids])
+    invalidate_user(user_id)
+    invalidate_fleet_stats()
+    return True, None
+
+def set_storage_limits(user_ids, storage_limit):
+    """Set the storage limit, in bytes, of every user in `user_ids` in one statement"""
+    return apply_to_users(
+        update(User).where(User.id.in_(user_ids)).values(storage_limit=storage_limit),
+        user_ids
+    )
@@ -1,13 +1,99 @@
+import os
 from flask import Flask
-from extensions import db
+from extensions import db, init_database
 from models import User, File, Folder, StorageClass
 
-app = Flask(__name__)
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///site.db'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SECRET_KEY'] = 'cle-secrete-a-changer'
+def create_app(config=None):
+    """Create the app, configured from the environment and then from `config`"""
+    app = Flask(__name__)
+    # Any SQLAlchemy URL; postgres:// as set by some hosts is accepted too
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///site.db')
+    # Read-only replica that READ_REPLICA_ENDPOINTS query on GET; unset: everything reads the primary
+    app.config['DATABASE_REPLICA_URL'] = os.environ.get('DATABASE_REPLICA_URL')
+    # Listings that tolerate replication lag; everything else reads and writes the primary
+    app.config['READ_REPLICA_ENDPOINTS'] = ('file_manager', 'search_files', 'dashboard', 'api_sort_files')
+    app.config['DB_POOL_SIZE'] = int(os.environ.get('DB_POOL_SIZE', 10))  # Connections kept open per process and engine
+    app.config['DB_MAX_OVERFLOW'] = int(os.environ.get('DB_MAX_OVERFLOW', 20))  # Extra connections opened under load
+    app.config['DB_POOL_PRE_PING'] = os.environ.get('DB_POOL_PRE_PING', '1') != '0'  # Test connections before use
+    app.config['DB_POOL_RECYCLE'] = int(os.environ.get('DB_POOL_RECYCLE', 1800))  # Seconds before a connection is replaced
+    app.config['SQLITE_JOURNAL_MODE'] = 'WAL'  # Readers do not block the writer, nor the writer readers
+    app.config['SQLITE_SYNCHRONOUS'] = 'NORMAL'  # Safe with WAL; fsyncs at checkpoints instead of every commit
+    app.config['SQLITE_BUSY_TIMEOUT'] = 5000  # Milliseconds a connection waits for a lock before failing
+    app.config['SQLITE_MMAP_SIZE'] = 256 * 1024 * 1024  # Bytes of the database file read through memory mapping
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['SECRET_KEY'] = 'cle-secrete-a-changer'
+    app.config['UPLOAD_FOLDER'] = os.path.join(app.root_path, 'uploads')
+    app.config['UPLOAD_CHUNK_SIZE'] = 1024 * 1024  # Bytes read per write when streaming uploads to disk
+    app.config['UPLOAD_SESSION_CHUNK_SIZE'] = 8 * 1024 * 1024  # Chunk size of resumable uploads
+    app.config['UPLOAD_SESSION_TTL'] = 24 * 3600  # Seconds an idle resumable upload is kept before being discarded
+    app.config['QUOTA_RESERVATION_STEP'] = 16 * 1024 * 1024  # Smallest quota reservation an upload grows by
+    app.config['QUOTA_RESERVATION_TTL'] = 3600  # Seconds before the reservation of a stalled upload is released
+    app.config['LOGIN_CACHE_TTL'] = 60  # Seconds a logged-in user's identity is served from memory
+    app.config['LOGIN_CACHE_SIZE'] = 4096  # Identities kept per process, least recently used evicted first
+    app.config['DEFAULT_BANDWIDTH_LIMIT'] = 0  # Bytes per second per user unless set on the user; 0 for no limit
+    app.config['DEFAULT_MAX_TRANSFERS'] = 4  # Concurrent uploads/downloads per user unless set on the user; 0 for no cap
+    app.config['TRANSFER_MAX_IN_FLIGHT'] = 32  # Transfers served at once by each process
+    app.config['TRANSFER_QUEUE_SIZE'] = 64  # Transfers allowed to wait for a slot; more are refused with 429
+    app.config['TRANSFER_QUEUE_TIMEOUT'] = 10  # Seconds a transfer waits for a slot before a 429
+    app.config['TRANSFER_RETRY_AFTER'] = 5  # Retry-After, in seconds, sent with 429 responses
+    # Log requests slower than this many seconds, with every query they ran; None disables the log
+    app.config['SLOW_REQUEST_THRESHOLD'] = float(os.environ['SLOW_REQUEST_THRESHOLD']) if os.environ.get('SLOW_REQUEST_THRESHOLD') else None
+    app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')  # Bearer token for /metrics scrapers; unset: admins only
+    app.config['DELETE_BATCH_SIZE'] = 500  # Rows per DELETE statement in bulk deletions
+    app.config['TRASH_RETENTION_DAYS'] = 30  # Trashed items can be restored for this long before being purged
+    app.config['TRASH_PURGE_INTERVAL'] = 300  # Seconds between purge runs; 0 disables the background worker
+    app.config['TRASH_PURGE_BATCH_SIZE'] = 200  # Folders and files removed per purge batch
+    app.config['TRASH_PURGE_PAUSE'] = 0.5  # Seconds to wait between purge batches
+    app.config['FSCK_BATCH_SIZE'] = 1000  # Rows and directory entries the consistency checker handles per query
+    app.config['FSCK_ORPHAN_GRACE'] = 3600  # Seconds before an unreferenced file on disk counts as an orphan
+    app.config['ADMIN_USERS_PAGE_SIZE'] = 50  # Users per page in the admin dashboard
+    app.config['ADMIN_STATS_TTL'] = 30  # Seconds the admin dashboard's fleet-wide totals are cached
+    app.config['ADMIN_NEAR_QUOTA_RATIO'] = 0.9  # Share of their limit past which a user counts as near quota
+    app.config['ADMIN_LARGEST_TENANTS'] = 10  # Heaviest users listed on the admin dashboard
+    app.config['FILES_PAGE_SIZE'] = 100  # Files per page in the file manager and the sort API
+    app.config['API_MAX_PAGE_SIZE'] = 500  # Largest page the sort API will return
+    app.config['LISTING_CACHE_SIZE'] = 1024  # Rendered folder listings and sort API pages kept in memory
+    app.config['LISTING_CACHE_TTL'] = 300  # Seconds a cached listing is kept, even while still current
+    app.config['CHANGES_PAGE_SIZE'] = 500  # Changes per response of the change feed
+    app.config['CHANGES_LONGPOLL_TIMEOUT'] = 30  # Longest a change feed request may wait for new changes, in seconds
+    app.config['CHANGES_POLL_INTERVAL'] = 2  # Seconds between journal checks while waiting, for writes from other processes
+    app.config['CHANGES_RETENTION_DAYS'] = 30  # Changes older than this are compacted away by the purge worker
+    app.config['CHANGES_COMPACT_BATCH_SIZE'] = 1000  # Changes removed per compaction batch
+    app.config['PREVIEW_FOLDER'] = os.path.join(app.root_path, 'previews')  # Cache of rendered thumbnails
+    app.config['PREVIEW_SIZES'] = (128, 512, 1024)  # Longest edge, in pixels, of each preview size
+    app.config['PREVIEW_CACHE_MAX_BYTES'] = 512 * 1024 * 1024  # Least recently used previews are evicted past this
+    app.config['PREVIEW_WORKERS'] = 2  # Processes rendering previews
+    app.config['PREVIEW_TIMEOUT'] = 30  # Seconds a request waits for a preview rendered on a cache miss
+    app.config['DOWNLOAD_CHUNK_SIZE'] = 256 * 1024  # Bytes per read when streaming downloads
+    # Compress document uploads at rest: 'auto' (zstd if installed, else gzip), 'zstd', 'gzip' or 'off'
+    app.config['STORAGE_COMPRESSION'] = os.environ.get('STORAGE_COMPRESSION', 'auto')
+    app.config['COMPRESSION_SAMPLE_SIZE'] = 64 * 1024  # Bytes of the first chunk compressed to decide
+    app.config['COMPRESSION_MIN_SAVING'] = 0.1  # Smallest fraction of the sample compression must save
+    app.config['COMPRESSION_MIN_SIZE'] = 1024  # Smaller content is always stored as is
+    # Hand download bodies to the front proxy: None, 'x-accel-redirect' (nginx) or 'x-sendfile' (Apache/lighttpd)
+    app.config['DOWNLOAD_OFFLOAD'] = os.environ.get('DOWNLOAD_OFFLOAD') or None
+    app.config['DOWNLOAD_ACCEL_PREFIX'] = '/protected-uploads/'  # nginx internal location aliased to UPLOAD_FOLDER
+    # Where stored content lives: 'local' (UPLOAD_FOLDER) or 's3' (any S3-compatible bucket; needs boto3)
+    app.config['STORAGE_BACKEND'] = os.environ.get('STORAGE_BACKEND', 'local')
+    app.config['S3_BUCKET'] = os.environ.get('S3_BUCKET')
+    app.config['S3_PREFIX'] = os.environ.get('S3_PREFIX', '')  # Key prefix, e.g. 'files/', to share a bucket
+    app.config['S3_ENDPOINT_URL'] = os.environ.get('S3_ENDPOINT_URL')  # For MinIO, Ceph and other non-AWS endpoints
+    app.config['S3_REGION'] = os.environ.get('S3_REGION')
+    app.config['S3_ACCESS_KEY_ID'] = os.environ.get('S3_ACCESS_KEY_ID')  # Unset: boto3's own credential chain
+    app.config['S3_SECRET_ACCESS_KEY'] = os.environ.get('S3_SECRET_ACCESS_KEY')
+    app.config['S3_PART_SIZE'] = 8 * 1024 * 1024  # Multipart upload part size; at least 5 MB
+    app.config['S3_PRESIGN_EXPIRES'] = 300  # Seconds a presigned download URL stays valid
+    app.config['S3_PRESIGN_DOWNLOADS'] = True  # Redirect downloads to the bucket instead of proxying the bytes
+    
+    if config:
+        app.config.update(config)
+    
+    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+    
+    init_database(app)
+    return app
 
-db.init_app(app)
+app = create_app()
 
 @app.route('/')
 def home():
@@ -16,4 +102,4 @@ def home():
 if __name__ == '__main__':
     with app.app_context():
         db.create_all()
-    app.run(debug=True)
\ No newline at end of file
+    app.run(debug=True)
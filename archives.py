@@ -0,0 +1,149 @@
+import zipfile
+from datetime import datetime
+from flask import current_app
+from sqlalchemy import select
+from app import db
+from models import File, Folder, FolderClosure
+from storage import get_storage
+from blobstore import iter_content
+
+# Formats that are already compressed; deflating them again costs CPU for nothing
+COMPRESSED_TYPES = {'image', 'video', 'audio'}
+COMPRESSED_EXTENSIONS = {
+    'zip', 'gz', 'tgz', 'bz2', 'xz', '7z', 'rar', 'zst',
+    'docx', 'xlsx', 'pptx', 'odt', 'ods', 'odp', 'pdf', 'epub', 'jar', 'apk'
+}
+
+class ZipOutput:
+    """Write-only sink for ZipFile that hands written bytes back in pieces.
+    
+    It reports a position but cannot seek, so ZipFile writes sizes in data
+    descriptors after each entry instead of going back to patch headers.
+    """
+    
+    def __init__(self):
+        self.buffer = bytearray()
+        self.position = 0
+    
+    def write(self, data):
+        self.buffer += data
+        self.position += len(data)
+        return len(data)
+    
+    def tell(self):
+        return self.position
+    
+    def flush(self):
+        pass
+    
+    def drain(self):
+        """Take everything written since the last drain"""
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        return data
+
+def get_compress_type(file):
+    """Store already-compressed media as-is and deflate everything else"""
+    ext = file.original_filename.rsplit('.', 1)[1].lower() if '.' in file.original_filename else ''
+    if file.file_type in COMPRESSED_TYPES or ext in COMPRESSED_EXTENSIONS:
+        return zipfile.ZIP_STORED
+    return zipfile.ZIP_DEFLATED
+
+def clean_name(name):
+    """Make a file or folder name safe to use as one archive path component"""
+    name = name.replace('/', '_').replace('\\', '_').strip()
+    return name if name not in ('', '.', '..') else '_'
+
+def unique_name(path, used):
+    """Add ' (n)' before the extension until the path is unused in the archive"""
+    if path not in used:
+        used.add(path)
+        return path
+    base, dot, ext = path.rpartition('.')
+    if not dot or '/' in ext:
+        base, ext = path, ''
+    n = 1
+    while True:
+        candidate = f"{base} ({n}).{ext}" if ext else f"{base} ({n})"
+        if candidate not in used:
+            used.add(candidate)
+            return candidate
+        n += 1
+
+def get_folder_paths(folder, user_id):
+    """Map every live folder in a subtree to its path inside the archive, with one query"""
+    rows = db.session.execute(
+        select(Folder.id, Folder.name, Folder.parent_id)
+        .join(FolderClosure, FolderClosure.descendant_id == Folder.id)
+        .where(FolderClosure.ancestor_id == folder.id, Folder.user_id == user_id, Folder.deleted_at.is_(None))
+        .order_by(FolderClosure.depth)
+    ).all()
+    paths = {}
+    for folder_id, name, parent_id in rows:
+        if folder_id == folder.id:
+            paths[folder_id] = clean_name(name)
+        elif parent_id in paths:
+            paths[folder_id] = f"{paths[parent_id]}/{clean_name(name)}"
+    return paths
+
+def iter_zip(entries):
+    """Yield a ZIP archive (ZIP64 where needed) built from (arcname, file or None) entries.
+    
+    File contents are copied in DOWNLOAD_CHUNK_SIZE pieces and handed out as
+    soon as they are written, so no archive is ever held in memory or on disk.
+    An entry with no file is an empty directory.
+    """
+    chunk_size = current_app.config.get('DOWNLOAD_CHUNK_SIZE', 256 * 1024)
+    storage = get_storage()
+    output = ZipOutput()
+    with zipfile.ZipFile(output, 'w', allowZip64=True) as archive:
+        for arcname, file in entries:
+            if file is None:
+                archive.writestr(zipfile.ZipInfo(arcname.rstrip('/') + '/'), b'')
+                yield output.drain()
+                continue
+            
+            if storage.get_size(file.filename) is None:
+                continue
+            info = zipfile.ZipInfo(arcname, (file.date_modified or datetime.utcnow()).timetuple()[:6])
+            info.compress_type = get_compress_type(file)
+            # A known size lets ZipFile decide on ZIP64 headers per entry
+            info.file_size = file.size
+            with archive.open(info, 'w') as dest:
+                for chunk in iter_content(file, chunk_size=chunk_size):
+                    dest.write(chunk)
+                    data = output.drain()
+                    if data:
+                        yield data
+            yield output.drain()
+    yield output.drain()
+
+def iter_folder_entries(folder, user_id):
+    """Yield archive entries for a folder subtree, reading file rows in batches"""
+    paths = get_folder_paths(folder, user_id)
+    used = set()
+    folders_with_files = set()
+    files = (
+        File.query.filter(File.folder_id.in_(list(paths)), File.user_id == user_id, File.deleted_at.is_(None))
+        .order_by(File.folder_id, File.id)
+        .yield_per(500)
+    )
+    for file in files:
+        folders_with_files.add(file.folder_id)
+        yield unique_name(f"{paths[file.folder_id]}/{clean_name(file.original_filename)}", used), file
+    # Folders with neither files nor subfolders still get a directory entry
+    parents = {path.rsplit('/', 1)[0] for path in paths.values() if '/' in path}
+    for folder_id, path in paths.items():
+        if folder_id not in folders_with_files and path not in parents:
+            yield path + '/', None
+
+def iter_file_entries(file_ids, user_id):
+    """Yield archive entries for a selection of files, flat at the archive root"""
+    used = set()
+    files = (
+        File.query.filter(File.id.in_(file_ids), File.user_id == user_id, File.deleted_at.is_(None))
+        .order_by(File.id)
+        .yield_per(500)
+    )
+    for file in files:
+        yield unique_name(clean_name(file.original_filename), used), file
@@ -0,0 +1,69 @@
+from flask import g, current_app
+from flask_login import LoginManager
+from sqlalchemy import inspect
+from sqlalchemy.orm import make_transient_to_detached
+from app import db
+from models import User
+from cache import TTLCache
+
+login_manager = LoginManager()
+login_manager.login_view = 'login'
+login_manager.login_message_category = 'info'
+
+# Columns kept per session identity. Counters such as storage_used change with
+# every upload, so they are left out and load from the database when read.
+SNAPSHOT_COLUMNS = (
+    'id', 'username', 'email', 'is_admin', 'is_approved', 'date_registered', 'profile_picture', 'storage_limit',
+    'bandwidth_limit', 'max_transfers'
+)
+
+_identities = None
+
+def get_identity_cache():
+    """Get the cache of user snapshots, sized from the config on first use"""
+    global _identities
+    if _identities is None:
+        _identities = TTLCache(
+            maxsize=current_app.config.get('LOGIN_CACHE_SIZE', 4096),
+            ttl=current_app.config.get('LOGIN_CACHE_TTL', 60)
+        )
+    return _identities
+
+def take_snapshot(user):
+    return {name: getattr(user, name) for name in SNAPSHOT_COLUMNS}
+
+@login_manager.user_loader
+def load_user(user_id):
+    """Load the logged-in user from a cached snapshot, querying only on a miss.
+    
+    The snapshot is attached to the session without a SELECT; columns it
+    does not hold are loaded if and when they are read.
+    """
+    user_id = int(user_id)
+    cache = get_identity_cache()
+    snapshot = cache.get(user_id)
+    if snapshot is None:
+        user = db.session.get(User, user_id)
+        if user is None:
+            return None
+        cache.set(user_id, take_snapshot(user))
+    else:
+        user = User(**snapshot)
+        make_transient_to_detached(user)
+        user = db.session.merge(user, load=False)
+    g.user = user
+    return user
+
+def get_user(user_id):
+    """Get a user, reusing this request's logged-in instance when it is the one asked for"""
+    user = g.get('user') if g else None
+    if user is not None and inspect(user).identity == (user_id,):
+        return user
+    return db.session.get(User, user_id)
+
+def invalidate_user(user_id):
+    """Drop a user's cached snapshot so the next request reloads it"""
+    get_identity_cache().pop(user_id)
+
+def init_login(app):
+    login_manager.init_app(app)
@@ -0,0 +1,352 @@
+import io
+import os
+import time
+import random
+import threading
+import mimetypes
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app, url_for
+from sqlalchemy import select, insert, bindparam, func
+from app import db
+from models import User, File, Folder, FolderClosure, Blob
+from blobstore import store_stream
+from stats import reconcile_user_stats
+from utils import FILE_TYPES, get_file_type
+from admin import delete_user
+from metrics import registry
+
+# Scenarios in the order they run, with the endpoint each one drives. Those
+# that change data come last so they do not skew the read-only ones.
+SCENARIOS = {
+    'dashboard': 'dashboard',
+    'file_manager': 'file_manager',
+    'api_sort_files': 'api_sort_files',
+    'search_files': 'search_files',
+    'download_file': 'download_file',
+    'upload_file': 'upload_file',
+    'delete_folder': 'delete_folder_route',
+}
+
+# Metrics compared against a baseline, and whether a higher value is worse
+COMPARED_METRICS = {
+    'throughput': False,
+    'p50_ms': True,
+    'p99_ms': True,
+    'queries_per_request': True,
+}
+
+# Generated names are two of these words, so searches for one match a share of every tenant
+WORDS = (
+    'report', 'invoice', 'holiday', 'draft', 'scan', 'budget', 'photo', 'meeting',
+    'notes', 'backup', 'contract', 'summary', 'archive', 'final', 'review', 'project',
+)
+EXTENSIONS = [ext for extensions in FILE_TYPES.values() for ext in extensions]
+SORT_KEYS = ('name', 'date', 'size', 'type')
+
+# Ids kept per tenant for requests to pick from
+SAMPLE_SIZE = 1000
+
+class Tenant:
+    """A generated user, with samples of its ids for the scenarios to pick from"""
+    
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.folder_ids = []
+        self.file_ids = []
+        # Each of these is deleted by at most one request
+        self.disposable_folder_ids = []
+        self.lock = threading.Lock()
+    
+    def take_disposable_folder(self):
+        with self.lock:
+            return self.disposable_folder_ids.pop() if self.disposable_folder_ids else None
+
+def create_blob_pool(count, max_size, rng):
+    """Store `count` blobs of random content, from 1 KB up to `max_size` bytes, and return them"""
+    blobs = []
+    for i in range(count):
+        size = max(1024, int(max_size * (i + 1) / count))
+        blob, _ = store_stream(io.BytesIO(os.urandom(size)))
+        blobs.append(blob)
+    db.session.commit()
+    return blobs
+
+def add_folder_tree(user_id, depth, breadth, closure, rng, roots=None, label='folder'):
+    """Create folder trees `depth` levels deep with `breadth` folders under each parent.
+    
+    There are `roots` top-level folders, `breadth` by default. Closure rows are
+    only collected into `closure` ({folder_id: [(ancestor_id, depth)]});
+    returns the ids of the new folders, top level first.
+    """
+    folder_ids = []
+    parents = [None]
+    for level_number in range(depth):
+        width = (roots or breadth) if level_number == 0 else breadth
+        level = [
+            Folder(name=f"{rng.choice(WORDS)} {label} {i + 1}", user_id=user_id, parent_id=parent_id, size=0)
+            for parent_id in parents for i in range(width)
+        ]
+        db.session.add_all(level)
+        db.session.flush()
+        for folder in level:
+            closure[folder.id] = [(folder.id, 0)] + [
+                (ancestor_id, distance + 1) for ancestor_id, distance in closure.get(folder.parent_id, [])
+            ]
+        parents = [folder.id for folder in level]
+        folder_ids.extend(parents)
+    return folder_ids
+
+def generate_tenant(name, files, depth, breadth, disposable, blobs, rng, batch_size=5000):
+    """Create one synthetic user with a folder tree and `files` File rows sharing the blob pool.
+    
+    Rows are inserted in bulk and the counters set from what was inserted,
+    so the tenant is as consistent as one built through the routes.
+    """
+    user = User(
+        username=name, email=f"{name}@benchmark.invalid", password_hash='!', is_approved=True,
+        storage_limit=0, storage_used=0
+    )
+    db.session.add(user)
+    db.session.flush()
+    tenant = Tenant(user.id)
+    
+    closure = {}
+    tenant.folder_ids = add_folder_tree(user.id, depth, breadth, closure, rng)
+    # Small trees for the delete scenario, kept out of the folders other requests pick from
+    if disposable:
+        disposable_ids = add_folder_tree(user.id, 2, breadth, closure, rng, roots=disposable, label='disposable')
+        tenant.disposable_folder_ids = disposable_ids[:disposable]
+    db.session.execute(insert(FolderClosure), [
+        {'ancestor_id': ancestor_id, 'descendant_id': folder_id, 'depth': distance}
+        for folder_id, ancestors in closure.items() for ancestor_id, distance in ancestors
+    ])
+    
+    # Files land anywhere in the tree, the root included; disposable trees get their share too
+    placements = [None] + list(closure)
+    folder_sizes = dict.fromkeys(closure, 0)
+    total_size = 0
+    uploaded_since = datetime.utcnow() - timedelta(days=365)
+    rows = []
+    for n in range(files):
+        # Every blob gets at least one reference
+        blob = blobs[n] if n < len(blobs) else rng.choice(blobs)
+        filename = f"{rng.choice(WORDS)}-{rng.choice(WORDS)}-{n + 1}.{rng.choice(EXTENSIONS)}"
+        folder_id = rng.choice(placements)
+        date_uploaded = uploaded_since + timedelta(seconds=rng.randrange(365 * 86400))
+        rows.append({
+            'filename': blob.filename,
+            'original_filename': filename,
+            'file_type': get_file_type(filename),
+            'mimetype': mimetypes.guess_type(filename)[0] or 'application/octet-stream',
+            'size': blob.size,
+            'user_id': user.id,
+            'folder_id': folder_id,
+            'blob_id': blob.id,
+            'date_uploaded': date_uploaded,
+            'date_modified': date_uploaded,
+        })
+        total_size += blob.size
+        if folder_id is not None:
+            for ancestor_id, _ in closure[folder_id]:
+                folder_sizes[ancestor_id] += blob.size
+        if len(rows) == batch_size:
+            db.session.execute(insert(File), rows)
+            rows = []
+    if rows:
+        db.session.execute(insert(File), rows)
+    
+    folder_table = Folder.__table__
+    db.session.execute(
+        folder_table.update().where(folder_table.c.id == bindparam('folder_id'))
+        .values(size=bindparam('folder_size')),
+        [{'folder_id': folder_id, 'folder_size': size} for folder_id, size in folder_sizes.items()]
+    )
+    # Room for everything stored plus what the upload scenario adds
+    user.storage_used = total_size
+    user.storage_limit = total_size + 1024 ** 3
+    db.session.commit()
+    reconcile_user_stats(user.id)
+    
+    file_ids = db.session.execute(select(File.id).where(File.user_id == user.id)).scalars().all()
+    tenant.file_ids = rng.sample(file_ids, min(SAMPLE_SIZE, len(file_ids)))
+    tenant.folder_ids = rng.sample(tenant.folder_ids, min(SAMPLE_SIZE, len(tenant.folder_ids)))
+    return tenant
+
+def generate_tenants(count, files, depth, breadth, disposable, seed=0, blob_count=16, blob_size=256 * 1024):
+    """Create `count` synthetic tenants sharing `files` File rows between them"""
+    rng = random.Random(seed)
+    blobs = create_blob_pool(blob_count, blob_size, rng)
+    references = dict.fromkeys((blob.id for blob in blobs), 0)
+    run_id = f"{int(time.time())}-{rng.randrange(10 ** 6)}"
+    tenants = []
+    for i in range(count):
+        tenant_files = files // count + (1 if i < files % count else 0)
+        tenants.append(generate_tenant(
+            f"benchmark-{run_id}-{i + 1}", tenant_files, depth, breadth, disposable, blobs, rng
+        ))
+    
+    # Reference counts as if every row had been uploaded through the routes
+    for tenant in tenants:
+        rows = db.session.execute(
+            select(File.blob_id, func.count()).where(File.user_id == tenant.user_id).group_by(File.blob_id)
+        ).all()
+        for blob_id, refs in rows:
+            references[blob_id] += refs
+    blob_table = Blob.__table__
+    db.session.execute(
+        blob_table.update().where(blob_table.c.id == bindparam('blob_id')).values(ref_count=bindparam('refs')),
+        [{'blob_id': blob_id, 'refs': refs} for blob_id, refs in references.items() if refs]
+    )
+    db.session.commit()
+    return tenants
+
+def remove_tenants(tenants):
+    """Delete generated tenants with everything they own, stored content included"""
+    for tenant in tenants:
+        success, error = delete_user(tenant.user_id)
+        if not success:
+            raise RuntimeError(f"Could not remove tenant {tenant.user_id}: {error}")
+
+def build_request(scenario, tenant, rng, upload_size):
+    """Get (method, url, options) for one request of a scenario, or None once it has run out of targets"""
+    if scenario == 'dashboard':
+        return 'GET', url_for('dashboard'), {}
+    if scenario == 'file_manager':
+        return 'GET', url_for('file_manager', folder_id=rng.choice(tenant.folder_ids + [None])), {}
+    if scenario == 'api_sort_files':
+        url = url_for('api_sort_files', folder_id=rng.choice(tenant.folder_ids + [None]),
+                      sort_by=rng.choice(SORT_KEYS), order=rng.choice(('asc', 'desc')))
+        return 'GET', url, {}
+    if scenario == 'search_files':
+        return 'GET', url_for('search_files', query=rng.choice(WORDS)), {}
+    if scenario == 'download_file':
+        return 'GET', url_for('download_file', file_id=rng.choice(tenant.file_ids)), {}
+    if scenario == 'upload_file':
+        folder_id = rng.choice(tenant.folder_ids + [None])
+        data = {
+            'file': (io.BytesIO(os.urandom(upload_size)), f"upload-{rng.randrange(10 ** 9)}.bin"),
+            'folder_id': str(folder_id or ''),
+        }
+        return 'POST', url_for('upload_file'), {'data': data, 'content_type': 'multipart/form-data'}
+    if scenario == 'delete_folder':
+        folder_id = tenant.take_disposable_folder()
+        if folder_id is None:
+            return None
+        return 'POST', url_for('delete_folder_route', folder_id=folder_id), {}
+    raise ValueError(f"Unknown scenario: {scenario}")
+
+def login_client(app, user_id):
+    """Get a test client logged in as a user"""
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = str(user_id)
+        session['_fresh'] = True
+    return client
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of sorted values"""
+    if not values:
+        return 0.0
+    return values[max(int(len(values) * fraction + 0.5) - 1, 0)]
+
+def run_scenario(scenario, tenants, requests, workers, upload_size, seed=0):
+    """Send `requests` requests of one scenario from `workers` threads and summarise how they went"""
+    app = current_app._get_current_object()
+    labels = {'endpoint': SCENARIOS[scenario]}
+    queries_before = registry.get_counter('eforice_sql_queries_total', labels)
+    commits_before = registry.get_counter('eforice_commits_total', labels)
+    sent = [0]
+    lock = threading.Lock()
+    
+    def work(index):
+        rng = random.Random(f"{seed}-{scenario}-{index}")
+        clients = {}
+        samples = []
+        while True:
+            with lock:
+                if sent[0] >= requests:
+                    break
+                sent[0] += 1
+            tenant = rng.choice(tenants)
+            with app.test_request_context():
+                spec = build_request(scenario, tenant, rng, upload_size)
+            if spec is None:
+                break
+            method, url, options = spec
+            client = clients.get(tenant.user_id)
+            if client is None:
+                client = clients[tenant.user_id] = login_client(app, tenant.user_id)
+            
+            # Buffering reads the whole body and closes the response, as a real client would
+            start = time.perf_counter()
+            response = client.open(url, method=method, buffered=True, **options)
+            samples.append((time.perf_counter() - start, response.status_code))
+        return samples
+    
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        samples = [sample for batch in executor.map(work, range(workers)) for sample in batch]
+    seconds = time.perf_counter() - start
+    
+    latencies = sorted(elapsed for elapsed, _ in samples)
+    statuses = {}
+    for _, status in samples:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    count = len(samples)
+    queries = registry.get_counter('eforice_sql_queries_total', labels) - queries_before
+    commits = registry.get_counter('eforice_commits_total', labels) - commits_before
+    return {
+        'requests': count,
+        'errors': sum(1 for _, status in samples if status >= 400),
+        'statuses': statuses,
+        'seconds': round(seconds, 3),
+        'throughput': round(count / seconds, 2) if seconds else 0.0,
+        'p50_ms': round(percentile(latencies, 0.5) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+        'mean_ms': round(sum(latencies) / count * 1000, 2) if count else 0.0,
+        'queries_per_request': round(queries / count, 2) if count else 0.0,
+        'commits_per_request': round(commits / count, 2) if count else 0.0,
+    }
+
+def run_benchmark(tenants, scenarios, requests, workers, upload_size, seed=0):
+    """Run each scenario in turn against generated tenants and return the results"""
+    # The test client cannot fetch CSRF tokens, so forms are checked without them for the run
+    csrf_enabled = current_app.config.get('WTF_CSRF_ENABLED', True)
+    current_app.config['WTF_CSRF_ENABLED'] = False
+    try:
+        results = {}
+        for scenario in SCENARIOS:
+            if scenario in scenarios:
+                results[scenario] = run_scenario(scenario, tenants, requests, workers, upload_size, seed)
+        return results
+    finally:
+        current_app.config['WTF_CSRF_ENABLED'] = csrf_enabled
+
+def compare_results(results, baseline, tolerance=0.2):
+    """Compare scenario results with a baseline run.
+    
+    Returns one row per scenario and metric present in both, flagged as
+    regressed when it got worse by more than `tolerance` (a fraction).
+    """
+    rows = []
+    for scenario, current in results['scenarios'].items():
+        previous = baseline.get('scenarios', {}).get(scenario)
+        if not previous:
+            continue
+        for metric, higher_is_worse in COMPARED_METRICS.items():
+            old, new = previous.get(metric), current.get(metric)
+            if old is None or new is None:
+                continue
+            # From zero, any increase counts as doubling
+            change = (new - old) / old if old else (0.0 if new == old else 1.0)
+            regressed = change > tolerance if higher_is_worse else change < -tolerance
+            rows.append({
+                'scenario': scenario,
+                'metric': metric,
+                'baseline': old,
+                'current': new,
+                'change': round(change, 4),
+                'regressed': regressed,
+            })
+    return rows
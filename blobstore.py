@@ -0,0 +1,272 @@
+import os
+import shutil
+import hashlib
+import logging
+from flask import current_app
+from sqlalchemy import update, delete, select, bindparam, event
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from models import Blob
+from app import db
+from storage import get_storage, get_temp_name
+from compression import choose_encoding, iter_compressed, iter_decompressed, slice_chunks
+
+def write_stream(stream, name, limit=None, chunk_size=None, compress=False):
+    """Copy a stream into storage in fixed-size chunks, computing its size and SHA-256 in one pass.
+    
+    With `compress`, the first chunk decides whether the content is stored
+    compressed. Returns (size, checksum, encoding, stored_size), where size
+    and checksum are those of the uncompressed content, or None for all four
+    after removing the partial content as soon as more than `limit` bytes
+    have been received.
+    """
+    chunk_size = chunk_size or current_app.config.get('UPLOAD_CHUNK_SIZE', 1024 * 1024)
+    checksum = hashlib.sha256()
+    state = {'size': 0, 'stored_size': 0, 'over_limit': False}
+    first_chunk = stream.read(chunk_size)
+    encoding = choose_encoding(first_chunk) if compress else None
+    
+    def chunks():
+        chunk = first_chunk
+        while chunk:
+            state['size'] += len(chunk)
+            if limit is not None and state['size'] > limit:
+                state['over_limit'] = True
+                return
+            checksum.update(chunk)
+            yield chunk
+            chunk = stream.read(chunk_size)
+    
+    def stored_chunks():
+        for chunk in chunks() if encoding is None else iter_compressed(chunks(), encoding):
+            state['stored_size'] += len(chunk)
+            yield chunk
+    
+    storage = get_storage()
+    try:
+        storage.write_chunks(name, stored_chunks())
+    except Exception:
+        storage.delete(name)
+        raise
+    
+    if state['over_limit']:
+        storage.delete(name)
+        return None, None, None, None
+    return state['size'], checksum.hexdigest(), encoding, state['stored_size']
+
+def hash_file(filepath, chunk_size=None):
+    """Compute the size and SHA-256 of a file already on disk"""
+    chunk_size = chunk_size or current_app.config.get('UPLOAD_CHUNK_SIZE', 1024 * 1024)
+    checksum = hashlib.sha256()
+    size = 0
+    with open(filepath, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            size += len(chunk)
+            checksum.update(chunk)
+    return size, checksum.hexdigest()
+
+def blob_filename(checksum):
+    """Get the on-disk name of the blob holding content with the given checksum"""
+    return checksum
+
+def acquire_blob(temp_name, size, checksum, encoding=None, stored_size=None, attempts=3):
+    """Add a reference to the blob for some content, adopting the scratch content `temp_name` if it is new.
+    
+    The row is claimed or inserted before any content moves, so stored
+    content is never replaced under a blob that already exists. `temp_name`
+    is consumed either way: it is renamed into the store for a new blob or
+    removed as a duplicate. The caller commits the session; if it rolls back
+    instead, the adopted content is removed again.
+    """
+    storage = get_storage()
+    for _ in range(attempts):
+        # Identical content already stored: only add a reference. A blob down to
+        # no references is being deleted, so it is not brought back.
+        claimed = db.session.execute(
+            update(Blob).where(Blob.checksum == checksum, Blob.ref_count > 0)
+            .values(ref_count=Blob.ref_count + 1).execution_options(synchronize_session=False)
+        ).rowcount
+        if claimed:
+            storage.delete(temp_name)
+            return db.session.execute(
+                select(Blob).where(Blob.checksum == checksum).execution_options(populate_existing=True)
+            ).scalar_one()
+        
+        blob = Blob(
+            checksum=checksum, filename=blob_filename(checksum), size=size, ref_count=1,
+            encoding=encoding, stored_size=size if stored_size is None else stored_size
+        )
+        try:
+            with db.session.begin_nested():
+                db.session.add(blob)
+        except IntegrityError:
+            # Another upload of the same content created the blob concurrently: claim that one
+            continue
+        storage.rename(temp_name, blob.filename)
+        db.session.info.setdefault('adopted_blob_names', []).append(blob.filename)
+        return blob
+    raise RuntimeError(f"Could not store content {checksum}: its blob is being deleted")
+
+@event.listens_for(Session, 'after_commit')
+def forget_adopted_blobs(session):
+    session.info.pop('adopted_blob_names', None)
+
+@event.listens_for(Session, 'after_soft_rollback')
+def remove_adopted_blobs(session, previous_transaction):
+    # Content renamed into the store for blob rows that were never committed
+    if not previous_transaction.nested:
+        delete_contents(session.info.pop('adopted_blob_names', []))
+
+def store_file(filepath, size, checksum, compress=False):
+    """Move a local file of known size and checksum into the blob store and return its blob.
+    
+    The file is consumed. With `compress`, content that compresses well is
+    written to storage compressed instead of being moved as is.
+    """
+    temp_name = get_temp_name()
+    encoding = stored_size = None
+    try:
+        with open(filepath, 'rb') as f:
+            chunk_size = current_app.config.get('UPLOAD_CHUNK_SIZE', 1024 * 1024)
+            if compress and choose_encoding(f.read(chunk_size)):
+                f.seek(0)
+                _, _, encoding, stored_size = write_stream(f, temp_name, chunk_size=chunk_size, compress=True)
+        if encoding:
+            os.remove(filepath)
+        else:
+            get_storage().put_file(filepath, temp_name)
+        return acquire_blob(temp_name, size, checksum, encoding, stored_size)
+    except Exception:
+        delete_contents([temp_name])
+        raise
+
+def link_for_store(path):
+    """Give a local file a second name for store_file to consume, so the original survives a rollback.
+    
+    The caller removes the original once its transaction has committed.
+    """
+    link = path + '.store'
+    unlink_paths([link])
+    try:
+        os.link(path, link)
+    except OSError:
+        shutil.copyfile(path, link)
+    return link
+
+def store_stream(stream, limit=None, compress=False):
+    """Stream content into the blob store and return (blob, size), or (None, None) if over `limit`"""
+    temp_name = get_temp_name()
+    size, checksum, encoding, stored_size = write_stream(stream, temp_name, limit=limit, compress=compress)
+    if size is None:
+        return None, None
+    try:
+        return acquire_blob(temp_name, size, checksum, encoding, stored_size), size
+    except Exception:
+        delete_contents([temp_name])
+        raise
+
+def release_blob(blob_id):
+    """Drop one reference to a blob and return its name if it is no longer referenced.
+    
+    The content must only be deleted once the session has committed.
+    """
+    db.session.execute(
+        update(Blob).where(Blob.id == blob_id).values(ref_count=Blob.ref_count - 1)
+    )
+    blob = db.session.get(Blob, blob_id, populate_existing=True)
+    if blob and blob.ref_count <= 0:
+        name = blob.filename
+        db.session.execute(delete(Blob).where(Blob.id == blob_id, Blob.ref_count <= 0))
+        db.session.expunge(blob)
+        return name
+    return None
+
+def release_blobs(ref_counts, batch_size=500):
+    """Drop many blob references at once, given a {blob_id: references_dropped} mapping.
+    
+    Returns the names of blobs that are no longer referenced; delete their
+    content only once the session has committed.
+    """
+    if not ref_counts:
+        return []
+    blob_table = Blob.__table__
+    db.session.execute(
+        blob_table.update().where(blob_table.c.id == bindparam('blob_id'))
+        .values(ref_count=blob_table.c.ref_count - bindparam('dropped')),
+        [{'blob_id': blob_id, 'dropped': dropped} for blob_id, dropped in ref_counts.items()]
+    )
+    
+    names = []
+    blob_ids = list(ref_counts)
+    for i in range(0, len(blob_ids), batch_size):
+        batch = blob_ids[i:i + batch_size]
+        unused = db.session.execute(
+            select(Blob.id, Blob.filename).where(Blob.id.in_(batch), Blob.ref_count <= 0)
+        ).all()
+        if unused:
+            db.session.execute(
+                delete(Blob).where(Blob.id.in_([blob_id for blob_id, _ in unused]))
+                .execution_options(synchronize_session=False)
+            )
+            names.extend(filename for _, filename in unused)
+    return names
+
+def get_content_encoding(file):
+    """Get the content coding a file is stored in, or None if it is stored as is"""
+    return file.blob.encoding if file.blob else None
+
+def iter_content(file, start=0, stop=None, chunk_size=256 * 1024, decode=True):
+    """Yield the bytes [start, stop) of a file's content.
+    
+    Compressed content is decompressed as it streams, unless `decode` is off,
+    in which case the range applies to the stored bytes.
+    """
+    storage = get_storage()
+    encoding = get_content_encoding(file)
+    if encoding is None or not decode:
+        return storage.iter_range(file.filename, start, stop, chunk_size)
+    chunks = iter_decompressed(storage.iter_range(file.filename, 0, None, chunk_size), encoding)
+    return slice_chunks(chunks, start, stop)
+
+def delete_contents(names):
+    """Delete stored content by name, logging rather than failing on errors.
+    
+    This runs once the transaction that released the content has committed,
+    by which time another upload of the same content may have claimed it
+    again, so names held by a referenced blob are kept.
+    """
+    names = [name for name in names if name]
+    if not names:
+        return
+    try:
+        # Committed state only, whatever the session is in
+        with db.engine.connect() as conn:
+            claimed = set(conn.execute(
+                select(Blob.filename).where(Blob.filename.in_(names), Blob.ref_count > 0)
+            ).scalars())
+    except Exception as e:
+        logging.error(f"Error checking stored content before deleting it: {str(e)}")
+        return
+    
+    storage = get_storage()
+    for name in names:
+        if name in claimed:
+            continue
+        try:
+            storage.delete(name)
+        except Exception as e:
+            logging.error(f"Error deleting stored content {name}: {str(e)}")
+
+def unlink_paths(paths):
+    """Remove files from disk, logging rather than failing on errors"""
+    for path in paths:
+        if not path:
+            continue
+        try:
+            if os.path.exists(path):
+                os.remove(path)
+        except OSError as e:
+            logging.error(f"Error removing {path}: {str(e)}")
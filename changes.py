@@ -0,0 +1,174 @@
+import time
+import base64
+import threading
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import select, update, delete, insert, func, event
+from sqlalchemy.orm import Session
+from app import db
+from models import User, Folder, ChangeEvent
+
+# Wakes the long-polling requests of this process as soon as a journal write
+# commits; writes from other processes are seen within CHANGES_POLL_INTERVAL
+_journal_changed = threading.Condition()
+_generation = 0
+
+class CursorExpiredError(Exception):
+    """Raised when changes after a cursor were compacted away; the client has to list everything again"""
+
+def encode_change_cursor(seq):
+    """Encode the sequence number of the last change a client has seen as an opaque cursor"""
+    return base64.urlsafe_b64encode(str(seq).encode()).decode().rstrip('=')
+
+def decode_change_cursor(cursor):
+    """Decode a change cursor back into a sequence number; raises ValueError if it is malformed"""
+    try:
+        seq = int(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+    if seq < 0:
+        raise ValueError(f"Invalid cursor: {cursor}")
+    return seq
+
+def take_change_seqs(user_id, count=1):
+    """Take the next `count` sequence numbers of a user's journal and return the last one.
+    
+    The UPDATE keeps the user row locked until the caller's transaction ends,
+    so a user's changes commit in sequence order. A reader that sees number
+    N can never later find a smaller one appear, which autoincrement ids do
+    not guarantee once transactions commit out of order.
+    """
+    return db.session.execute(
+        update(User).where(User.id == user_id).values(change_seq=User.change_seq + count)
+        .returning(User.change_seq).execution_options(synchronize_session=False)
+    ).scalar_one()
+
+def record_change(user_id, action, item_type, item_id, parent_id, name, size=None):
+    """Append an entry to a user's change journal; runs in the caller's transaction"""
+    db.session.add(ChangeEvent(
+        user_id=user_id,
+        seq=take_change_seqs(user_id),
+        action=action,
+        item_type=item_type,
+        item_id=item_id,
+        parent_id=parent_id,
+        name=name,
+        size=size
+    ))
+    db.session.info['journal_changed'] = True
+
+def record_folder_deletions(user_id, folder_ids):
+    """Journal the deletion of every live folder among `folder_ids` in one INSERT.
+    
+    Nothing is recorded for what is inside them, nor for folders already in
+    the trash, whose deletion was journaled when they were trashed.
+    """
+    folders = db.session.execute(
+        select(Folder.id, Folder.parent_id, Folder.name)
+        .where(Folder.id.in_(folder_ids), Folder.user_id == user_id, Folder.deleted_at.is_(None))
+        .order_by(Folder.id)
+    ).all()
+    if not folders:
+        return
+    
+    first_seq = take_change_seqs(user_id, len(folders)) - len(folders) + 1
+    now = datetime.utcnow()
+    db.session.execute(insert(ChangeEvent), [
+        {
+            'user_id': user_id, 'seq': first_seq + i, 'action': 'delete', 'item_type': 'folder',
+            'item_id': folder_id, 'parent_id': parent_id, 'name': name, 'date_created': now,
+        }
+        for i, (folder_id, parent_id, name) in enumerate(folders)
+    ])
+    db.session.info['journal_changed'] = True
+
+@event.listens_for(Session, 'after_commit')
+def notify_journal_changed(session):
+    global _generation
+    if session.info.pop('journal_changed', False):
+        with _journal_changed:
+            _generation += 1
+            _journal_changed.notify_all()
+
+@event.listens_for(Session, 'after_rollback')
+def discard_journal_changed(session):
+    session.info.pop('journal_changed', None)
+
+def get_latest_change_seq(user_id):
+    """Get the sequence number of a user's newest change, the cursor a client starting to sync begins from"""
+    return db.session.execute(select(User.change_seq).where(User.id == user_id)).scalar() or 0
+
+def get_changes(user_id, after_seq, limit=500):
+    """Get up to `limit` of a user's changes after sequence number `after_seq`, oldest first.
+    
+    Returns (changes, has_more). Raises CursorExpiredError when some of the
+    changes after `after_seq` have been compacted away.
+    """
+    changes = db.session.execute(
+        select(ChangeEvent).where(ChangeEvent.user_id == user_id, ChangeEvent.seq > after_seq)
+        .order_by(ChangeEvent.seq).limit(limit + 1)
+    ).scalars().all()
+    
+    # Checked after reading, so a compaction in between cannot go unnoticed
+    floor = db.session.execute(select(User.change_floor).where(User.id == user_id)).scalar()
+    if after_seq < (floor or 0):
+        raise CursorExpiredError("Changes after this cursor are no longer available")
+    return changes[:limit], len(changes) > limit
+
+def wait_for_changes(user_id, after_seq, timeout):
+    """Block until a user has changes after sequence number `after_seq` or `timeout` seconds pass.
+    
+    The session's transaction is ended before each wait, so no connection is
+    held while idle. Returns whether there are new changes.
+    """
+    deadline = time.monotonic() + timeout
+    interval = current_app.config.get('CHANGES_POLL_INTERVAL', 2)
+    while True:
+        generation = _generation
+        found = db.session.execute(
+            select(ChangeEvent.id).where(ChangeEvent.user_id == user_id, ChangeEvent.seq > after_seq).limit(1)
+        ).first() is not None
+        db.session.commit()
+        
+        remaining = deadline - time.monotonic()
+        if found or remaining <= 0:
+            return found
+        with _journal_changed:
+            # A commit since the query already counts; otherwise sleep until one or the next poll
+            if generation == _generation:
+                _journal_changed.wait(min(remaining, interval))
+
+def compact_changes():
+    """Drop changes older than CHANGES_RETENTION_DAYS in batches and return how many went.
+    
+    Each user's change_floor is raised to the newest change dropped, so
+    cursors from before it are refused rather than silently missing changes.
+    """
+    cutoff = datetime.utcnow() - timedelta(days=current_app.config.get('CHANGES_RETENTION_DAYS', 30))
+    batch_size = current_app.config.get('CHANGES_COMPACT_BATCH_SIZE', 1000)
+    compacted = 0
+    while True:
+        rows = db.session.execute(
+            select(ChangeEvent.id, ChangeEvent.user_id).where(ChangeEvent.date_created < cutoff)
+            .order_by(ChangeEvent.id).limit(batch_size)
+        ).all()
+        if not rows:
+            break
+        
+        # Batches go oldest first, so each one's newest change is past any earlier floor
+        event_ids = [event_id for event_id, _ in rows]
+        db.session.execute(
+            update(User).where(User.id.in_({user_id for _, user_id in rows}))
+            .values(change_floor=(
+                select(func.max(ChangeEvent.seq))
+                .where(ChangeEvent.user_id == User.id, ChangeEvent.id.in_(event_ids))
+                .scalar_subquery()
+            ))
+            .execution_options(synchronize_session=False)
+        )
+        db.session.execute(
+            delete(ChangeEvent).where(ChangeEvent.id.in_(event_ids)).execution_options(synchronize_session=False)
+        )
+        db.session.commit()
+        compacted += len(rows)
+    return compacted
@@ -0,0 +1,362 @@
+import os
+import time
+import logging
+import click
+from sqlalchemy import inspect, text, select, insert, delete, literal
+
+from app import app, db
+from models import File, Blob, Folder, FolderClosure
+from blobstore import hash_file, store_file, link_for_store, unlink_paths
+from storage import LocalStorage, get_storage
+from search import ensure_search_index, rebuild_search_index
+from fsck import recompute_folder_sizes, run_fsck
+from benchmark import SCENARIOS
+
+def add_missing_columns():
+    """Add columns declared on the models but missing from existing tables"""
+    inspector = inspect(db.engine)
+    quote = db.engine.dialect.identifier_preparer.quote
+    added = []
+    for table in db.metadata.sorted_tables:
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            ddl = (
+                f"ALTER TABLE {quote(table.name)} ADD COLUMN {quote(column.name)} "
+                f"{column.type.compile(dialect=db.engine.dialect)}"
+            )
+            if column.default is not None and column.default.is_scalar:
+                default = column.default.arg
+                if isinstance(default, bool):
+                    default = int(default)
+                ddl += f" DEFAULT {default!r}" if isinstance(default, str) else f" DEFAULT {default}"
+            with db.engine.begin() as conn:
+                conn.execute(text(ddl))
+            added.append(f"{table.name}.{column.name}")
+    return added
+
+def upgrade_schema():
+    """Create missing tables, columns and indexes on an existing database"""
+    db.create_all()
+    added = add_missing_columns()
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+    ensure_search_index()
+    return added
+
+@app.cli.command('upgrade-db')
+def upgrade_db_command():
+    """Bring an existing database up to date with the models."""
+    added = upgrade_schema()
+    for name in added:
+        click.echo(f"Added column {name}")
+    click.echo("Database schema is up to date.")
+
+@app.cli.command('migrate-blobs')
+@click.option('--batch-size', default=500, show_default=True, help='Files migrated per transaction.')
+def migrate_blobs_command(batch_size):
+    """Fold files stored under per-upload names into the deduplicated blob store."""
+    upgrade_schema()
+    migrated = missing = reclaimed = 0
+    # Legacy files were always written to the local upload folder
+    legacy_storage = LocalStorage(app.config['UPLOAD_FOLDER'])
+    last_id = 0
+    while True:
+        files = (File.query.filter(File.blob_id.is_(None), File.id > last_id)
+                 .order_by(File.id).limit(batch_size).all())
+        if not files:
+            break
+        # Legacy files stay in place until the batch pointing away from them has committed;
+        # a rollback only loses the blob store's links to them
+        moved = []
+        store_path = None
+        try:
+            for file in files:
+                last_id = file.id
+                filepath = legacy_storage.get_path(file.filename)
+                if not os.path.exists(filepath):
+                    logging.warning(f"Skipping {file!r}: {filepath} is missing")
+                    missing += 1
+                    continue
+                size, checksum = hash_file(filepath)
+                if Blob.query.filter_by(checksum=checksum).first():
+                    reclaimed += size
+                store_path = link_for_store(filepath)
+                blob = store_file(store_path, size, checksum)
+                file.blob_id = blob.id
+                file.filename = blob.filename
+                moved.append(filepath)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            unlink_paths([store_path])
+            raise
+        unlink_paths(moved)
+        migrated += len(moved)
+    click.echo(f"Migrated {migrated} files ({missing} missing on disk, {reclaimed} bytes reclaimed).")
+
+@app.cli.command('migrate-layout')
+@click.option('--batch-size', default=500, show_default=True, help='Files moved per batch.')
+@click.option('--pause', default=0.5, show_default=True, help='Seconds to wait between batches.')
+def migrate_layout_command(batch_size, pause):
+    """Move stored content from the flat upload folder into the fan-out layout.
+    
+    Safe to run while serving: every file stays readable under its old or new
+    path, and the command can be interrupted and run again.
+    """
+    from models import User
+    storage = get_storage()
+    if not isinstance(storage, LocalStorage):
+        raise click.ClickException("Only the local storage backend has a directory layout to migrate.")
+    moved = 0
+    # Everything the database refers to, walked in keyset batches
+    sources = [
+        (Blob.id, Blob.filename, None),
+        (File.id, File.filename, File.blob_id.is_(None)),
+        (User.id, User.profile_picture, User.profile_picture != ''),
+    ]
+    for id_column, name_column, condition in sources:
+        last_id = 0
+        while True:
+            query = select(id_column, name_column).where(id_column > last_id)
+            if condition is not None:
+                query = query.where(condition)
+            rows = db.session.execute(query.order_by(id_column).limit(batch_size)).all()
+            db.session.rollback()
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            batch_moved = sum(1 for _, name in rows if name and storage.move_to_fanout(name))
+            moved += batch_moved
+            if batch_moved:
+                click.echo(f"Moved {moved} files so far.")
+                time.sleep(pause)
+    click.echo(f"Moved {moved} files into the fan-out layout.")
+
+def rebuild_folder_tree():
+    """Rebuild the folder closure table from parent_id links with one recursive query"""
+    tree = select(
+        Folder.id.label('ancestor_id'), Folder.id.label('descendant_id'), literal(0).label('depth')
+    ).cte('tree', recursive=True)
+    tree = tree.union_all(
+        select(tree.c.ancestor_id, Folder.id, tree.c.depth + 1)
+        .join(Folder, Folder.parent_id == tree.c.descendant_id)
+    )
+    db.session.execute(delete(FolderClosure))
+    db.session.execute(
+        insert(FolderClosure).from_select(['ancestor_id', 'descendant_id', 'depth'], select(tree))
+    )
+
+@app.cli.command('backfill-folder-tree')
+@click.option('--recompute-sizes/--no-recompute-sizes', default=True, show_default=True,
+              help='Also recompute folder sizes from the rebuilt tree.')
+def backfill_folder_tree_command(recompute_sizes):
+    """Build the folder closure table for existing folder trees."""
+    upgrade_schema()
+    rebuild_folder_tree()
+    if recompute_sizes:
+        recompute_folder_sizes()
+    db.session.commit()
+    click.echo(f"Indexed {FolderClosure.query.count()} ancestor links for {Folder.query.count()} folders.")
+
+@app.cli.command('purge-trash')
+def purge_trash_command():
+    """Permanently delete trashed items past the retention period."""
+    from trash import purge_expired_trash
+    purged = purge_expired_trash()
+    click.echo(f"Purged {purged} items from the trash.")
+
+@app.cli.command('purge-uploads')
+def purge_uploads_command():
+    """Discard resumable uploads that have been idle past UPLOAD_SESSION_TTL."""
+    from uploads import expire_upload_sessions
+    expired = expire_upload_sessions()
+    click.echo(f"Discarded {expired} abandoned upload sessions.")
+
+@app.cli.command('compact-changes')
+def compact_changes_command():
+    """Drop change journal entries older than CHANGES_RETENTION_DAYS."""
+    from changes import compact_changes
+    compacted = compact_changes()
+    click.echo(f"Compacted {compacted} change journal entries.")
+
+@app.cli.command('rebuild-search-index')
+def rebuild_search_index_command():
+    """Rebuild the file and folder name search index from scratch."""
+    upgrade_schema()
+    rebuild_search_index()
+    click.echo("Search index rebuilt.")
+
+@app.cli.command('reconcile-stats')
+@click.option('--user-id', type=int, default=None, help='Only reconcile this user.')
+def reconcile_stats_command(user_id):
+    """Recompute per-user file/folder counts and per-type usage from the tables."""
+    from stats import reconcile_user_stats
+    reconcile_user_stats(user_id)
+    click.echo("User statistics reconciled.")
+
+@app.cli.command('fsck')
+@click.option('--repair', is_flag=True, help='Fix totals and reference counts and remove orphaned content.')
+@click.option('--batch-size', default=None, type=int, help='Rows per query; defaults to FSCK_BATCH_SIZE.')
+@click.option('--json', 'as_json', is_flag=True, help='Print the full report as JSON.')
+def fsck_command(repair, batch_size, as_json):
+    """Check folder sizes, user totals, blobs and the upload folder for consistency."""
+    import json
+    report = run_fsck(repair=repair, batch_size=batch_size)
+    if as_json:
+        click.echo(json.dumps(report, indent=2, default=str))
+        return
+    for key, value in report.items():
+        if key != 'examples':
+            click.echo(f"{key}: {value}")
+    for kind, examples in report['examples'].items():
+        click.echo(f"{kind}, e.g.:")
+        for example in examples[:5]:
+            click.echo(f"  {example}")
+
+@app.cli.command('compression-report')
+@click.option('--json', 'as_json', is_flag=True, help='Print the report as JSON.')
+def compression_report_command(as_json):
+    """Report how many bytes compression at rest saves, per content coding."""
+    import json
+    from compression import get_compression_report
+    report = get_compression_report()
+    if as_json:
+        click.echo(json.dumps(report, indent=2))
+        return
+    for encoding, row in sorted(report['encodings'].items()):
+        click.echo(f"{encoding}: {row['blobs']} blobs, {row['logical_bytes']} bytes stored in {row['stored_bytes']}")
+    click.echo(f"Saved {report['saved_bytes']} of {report['logical_bytes']} bytes ({report['saved_ratio']:.1%}).")
+
+@app.cli.command('quota-stress')
+@click.option('--uploads', default=64, show_default=True, help='Concurrent uploads to attempt.')
+@click.option('--workers', default=8, show_default=True, help='Threads uploading at once.')
+@click.option('--size', default=64 * 1024, show_default=True, help='Bytes per upload.')
+@click.option('--fits', default=20, show_default=True, help='Uploads the test quota has room for.')
+def quota_stress_command(uploads, workers, size, fits):
+    """Race many uploads against one account and check the quota holds exactly."""
+    import io
+    import uuid
+    from concurrent.futures import ThreadPoolExecutor
+    from werkzeug.datastructures import FileStorage
+    from models import User, QuotaReservation
+    from utils import save_file
+    from quota import release_reservation
+    from admin import delete_user
+    
+    user = User(
+        username=f"quota-stress-{uuid.uuid4().hex[:8]}", email=f"{uuid.uuid4().hex}@quota-stress.invalid",
+        password_hash='!', is_approved=True, storage_limit=size * fits, storage_used=0
+    )
+    db.session.add(user)
+    db.session.commit()
+    user_id = user.id
+    
+    def upload(n):
+        with app.app_context():
+            # Distinct content per upload so deduplication does not short-circuit anything
+            data = os.urandom(size)
+            file = FileStorage(io.BytesIO(data), filename=f"stress-{n}.bin", content_type='application/octet-stream')
+            new_file, error = save_file(file, user_id)
+            db.session.remove()
+            return error
+    
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        errors = list(executor.map(upload, range(uploads)))
+    
+    # Reservations whose release failed are what the purge worker would expire
+    leftover = QuotaReservation.query.filter_by(user_id=user_id).all()
+    reserved = sum(reservation.size for reservation in leftover)
+    for reservation in leftover:
+        release_reservation(reservation.id)
+    
+    stored = File.query.filter_by(user_id=user_id).all()
+    used = db.session.get(User, user_id, populate_existing=True).storage_used
+    quota_errors = sum(1 for error in errors if error == "File exceeds your storage limit")
+    other_errors = [error for error in errors if error and error != "File exceeds your storage limit"]
+    click.echo(f"{len(stored)} stored, {quota_errors} rejected over quota, {len(other_errors)} failed otherwise.")
+    click.echo(f"storage_used={used}, sum of file sizes={sum(f.size for f in stored)}, "
+               f"limit={size * fits}, left reserved={len(leftover)} ({reserved} bytes)")
+    for error in set(other_errors):
+        click.echo(f"  error: {error}")
+    
+    ok = used == sum(f.size for f in stored) and used <= size * fits
+    
+    # Remove the throwaway account and its content
+    delete_user(user_id)
+    
+    if not ok:
+        raise click.ClickException("Quota accounting is inconsistent.")
+    click.echo("Quota held.")
+
+@app.cli.command('benchmark')
+@click.option('--tenants', default=4, show_default=True, help='Synthetic users to generate.')
+@click.option('--files', default=100000, show_default=True, help='File rows generated across all tenants.')
+@click.option('--depth', default=4, show_default=True, help='Levels in each tenant\'s folder tree.')
+@click.option('--breadth', default=4, show_default=True, help='Folders under each parent.')
+@click.option('--requests', default=200, show_default=True, help='Requests sent per scenario.')
+@click.option('--workers', default=4, show_default=True, help='Threads sending requests at once.')
+@click.option('--scenario', 'scenarios', multiple=True, type=click.Choice(list(SCENARIOS)),
+              help='Only run these scenarios; repeat the option for several. Defaults to all.')
+@click.option('--upload-size', default=64 * 1024, show_default=True, help='Bytes per upload.')
+@click.option('--seed', default=0, show_default=True, help='Seed of the generated data and request mix.')
+@click.option('--output', type=click.Path(dir_okay=False), help='Write the results as JSON to this file.')
+@click.option('--baseline', type=click.Path(exists=True, dir_okay=False),
+              help='Results of an earlier run to compare with; regressions fail the command.')
+@click.option('--tolerance', default=0.2, show_default=True, help='Relative change that counts as a regression.')
+@click.option('--keep', is_flag=True, help='Leave the generated tenants in the database.')
+def benchmark_command(tenants, files, depth, breadth, requests, workers, scenarios, upload_size, seed, output,
+                      baseline, tolerance, keep):
+    """Measure the storage routes under synthetic tenants. Run it against a scratch database."""
+    import json
+    import platform
+    from datetime import datetime
+    from benchmark import generate_tenants, remove_tenants, run_benchmark, compare_results
+    
+    scenarios = scenarios or tuple(SCENARIOS)
+    # One disposable folder per delete request, spread over the tenants
+    disposable = -(-requests // tenants) if 'delete_folder' in scenarios else 0
+    
+    started = time.perf_counter()
+    generated = generate_tenants(tenants, files, depth, breadth, disposable, seed=seed)
+    click.echo(f"Generated {tenants} tenants with {files} files in {time.perf_counter() - started:.1f}s.")
+    try:
+        scenario_results = run_benchmark(generated, scenarios, requests, workers, upload_size, seed=seed)
+    finally:
+        if not keep:
+            remove_tenants(generated)
+    
+    results = {
+        'date': datetime.utcnow().isoformat(),
+        'parameters': {
+            'tenants': tenants, 'files': files, 'depth': depth, 'breadth': breadth, 'requests': requests,
+            'workers': workers, 'upload_size': upload_size, 'seed': seed,
+        },
+        'environment': {'python': platform.python_version(), 'database': db.engine.dialect.name},
+        'scenarios': scenario_results,
+    }
+    for scenario, row in scenario_results.items():
+        click.echo(f"{scenario:>16}: {row['throughput']:8.1f} req/s  p50 {row['p50_ms']:8.2f} ms  "
+                   f"p99 {row['p99_ms']:8.2f} ms  {row['queries_per_request']:6.1f} queries/req  "
+                   f"{row['errors']} errors")
+    
+    regressions = []
+    if baseline:
+        with open(baseline) as f:
+            baseline_results = json.load(f)
+        if baseline_results.get('parameters') != results['parameters']:
+            click.echo("Warning: the baseline was run with different parameters.")
+        results['comparison'] = compare_results(results, baseline_results, tolerance)
+        regressions = [row for row in results['comparison'] if row['regressed']]
+        for row in regressions:
+            click.echo(f"  regressed: {row['scenario']} {row['metric']} {row['baseline']} -> {row['current']} "
+                       f"({row['change']:+.1%})")
+    
+    if output:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2)
+        click.echo(f"Results written to {output}.")
+    if regressions:
+        raise click.ClickException(f"{len(regressions)} metrics regressed beyond {tolerance:.0%} of the baseline.")
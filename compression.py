@@ -0,0 +1,111 @@
+import zlib
+from flask import current_app, request
+from sqlalchemy import select, func
+from app import db
+from models import Blob
+
+# zstandard is optional: without it, content is compressed with gzip
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# File types (see utils.FILE_TYPES) whose content is worth sampling for compression
+COMPRESSIBLE_TYPES = {'document'}
+
+def is_compressible(file_type):
+    """Check whether content of a file type is a candidate for compression at rest"""
+    return file_type in COMPRESSIBLE_TYPES
+
+def get_storage_encoding():
+    """Get the content coding new content is compressed with, or None when compression is off"""
+    setting = current_app.config.get('STORAGE_COMPRESSION')
+    if setting in ('auto', 'zstd'):
+        return 'zstd' if zstandard is not None else 'gzip'
+    if setting == 'gzip':
+        return 'gzip'
+    return None
+
+def get_compressor(encoding):
+    if encoding == 'zstd':
+        return zstandard.ZstdCompressor(level=3).compressobj()
+    # wbits=31 writes a gzip header and trailer, as Content-Encoding: gzip expects
+    return zlib.compressobj(6, zlib.DEFLATED, 31)
+
+def get_decompressor(encoding):
+    if encoding == 'zstd':
+        return zstandard.ZstdDecompressor().decompressobj()
+    return zlib.decompressobj(31)
+
+def choose_encoding(first_chunk):
+    """Decide how to store content from its first chunk: a content coding, or None to store it as is.
+    
+    Only a sample of the chunk is compressed, so the decision stays cheap
+    even for large chunks.
+    """
+    encoding = get_storage_encoding()
+    if encoding is None or len(first_chunk) < current_app.config.get('COMPRESSION_MIN_SIZE', 1024):
+        return None
+    sample = first_chunk[:current_app.config.get('COMPRESSION_SAMPLE_SIZE', 64 * 1024)]
+    compressor = get_compressor(encoding)
+    compressed_size = len(compressor.compress(sample)) + len(compressor.flush())
+    if compressed_size > len(sample) * (1 - current_app.config.get('COMPRESSION_MIN_SAVING', 0.1)):
+        return None
+    return encoding
+
+def iter_compressed(chunks, encoding):
+    """Compress a stream of chunks, yielding output as the compressor produces it"""
+    compressor = get_compressor(encoding)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+def iter_decompressed(chunks, encoding):
+    """Decompress a stream of chunks without holding more than one chunk's output"""
+    decompressor = get_decompressor(encoding)
+    for chunk in chunks:
+        data = decompressor.decompress(chunk)
+        if data:
+            yield data
+    data = decompressor.flush()
+    if data:
+        yield data
+
+def slice_chunks(chunks, start=0, stop=None):
+    """Yield the bytes [start, stop) of a stream of chunks"""
+    position = 0
+    for chunk in chunks:
+        end = position + len(chunk)
+        if end > start:
+            yield chunk[max(start - position, 0):None if stop is None else stop - position]
+        position = end
+        if stop is not None and position >= stop:
+            return
+
+def accepts_encoding(encoding):
+    """Check whether the client takes a response in this content coding as is"""
+    return request.accept_encodings[encoding] > 0
+
+def get_compression_report():
+    """Summarise logical and physical bytes of the blob store, per content coding"""
+    stored_size = func.coalesce(Blob.stored_size, Blob.size)
+    rows = db.session.execute(
+        select(Blob.encoding, func.count(), func.coalesce(func.sum(Blob.size), 0),
+               func.coalesce(func.sum(stored_size), 0))
+        .group_by(Blob.encoding)
+    ).all()
+    encodings = {
+        encoding or 'identity': {'blobs': count, 'logical_bytes': logical, 'stored_bytes': stored}
+        for encoding, count, logical, stored in rows
+    }
+    logical = sum(row['logical_bytes'] for row in encodings.values())
+    stored = sum(row['stored_bytes'] for row in encodings.values())
+    return {
+        'encodings': encodings,
+        'logical_bytes': logical,
+        'stored_bytes': stored,
+        'saved_bytes': logical - stored,
+        'saved_ratio': round((logical - stored) / logical, 4) if logical else 0.0,
+    }
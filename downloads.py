@@ -0,0 +1,199 @@
+import os
+import uuid
+import unicodedata
+from urllib.parse import quote
+from flask import request, current_app, Response, redirect
+from werkzeug.wsgi import wrap_file
+from storage import get_storage
+from blobstore import get_content_encoding, iter_content
+from compression import accepts_encoding
+
+# Past this many ranges in one request the Range header is ignored and the
+# whole file is sent, so a client cannot make us seek thousands of times
+MAX_RANGES = 16
+
+def get_file_etag(file):
+    """Get a strong validator for a file's current content"""
+    if file.blob:
+        return file.blob.checksum
+    return f"{file.id}-{file.size}-{int(file.date_modified.timestamp())}"
+
+def get_content_disposition(filename, as_attachment=True):
+    """Build a Content-Disposition value, with an RFC 5987 fallback for non-ASCII names"""
+    disposition = 'attachment' if as_attachment else 'inline'
+    try:
+        filename.encode('ascii')
+    except UnicodeEncodeError:
+        simple = unicodedata.normalize('NFKD', filename).encode('ascii', 'ignore').decode('ascii')
+        quoted = quote(filename, safe="!#$&+^`|~")
+        return f'{disposition}; filename="{simple}"; filename*=UTF-8\'\'{quoted}'
+    return f'{disposition}; filename="{filename}"'
+
+def is_not_modified(etag, last_modified):
+    """Evaluate If-None-Match / If-Modified-Since for a GET"""
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    if request.if_modified_since and last_modified:
+        return last_modified.replace(microsecond=0) <= request.if_modified_since.replace(tzinfo=None)
+    return False
+
+def is_range_applicable(etag, last_modified):
+    """Check If-Range: ranges only apply while the client's copy is still current"""
+    if_range = request.if_range
+    if if_range.etag:
+        return if_range.etag == etag
+    if if_range.date:
+        return last_modified is not None and \
+            last_modified.replace(microsecond=0) == if_range.date.replace(tzinfo=None)
+    return True
+
+def resolve_ranges(length):
+    """Turn the request's Range header into sorted, coalesced (start, stop) byte ranges.
+    
+    Returns None when the whole file should be sent and [] when no range
+    can be satisfied.
+    """
+    byte_range = request.range
+    if byte_range is None or byte_range.units != 'bytes':
+        return None
+    
+    ranges = []
+    for begin, end in byte_range.ranges:
+        if begin < 0:
+            start, stop = max(length + begin, 0), length
+        else:
+            start, stop = begin, min(end if end is not None else length, length)
+        if start < stop:
+            ranges.append((start, stop))
+    
+    ranges.sort()
+    merged = []
+    for start, stop in ranges:
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], stop))
+        else:
+            merged.append((start, stop))
+    
+    if len(merged) > MAX_RANGES:
+        return None
+    return merged
+
+def iter_multipart_ranges(parts, closing, file, decode, chunk_size):
+    """Yield a multipart/byteranges body from precomputed part headers"""
+    for header, (start, stop) in parts:
+        yield header
+        yield from iter_content(file, start, stop, chunk_size, decode=decode)
+    yield closing
+
+def build_multipart_parts(ranges, length, mimetype, boundary):
+    """Precompute the part headers so the body length is known before streaming.
+    
+    Returns the list of (header, (start, stop)) parts and the closing delimiter.
+    """
+    parts = []
+    for start, stop in ranges:
+        header = (
+            f"\r\n--{boundary}\r\n"
+            f"Content-Type: {mimetype}\r\n"
+            f"Content-Range: bytes {start}-{stop - 1}/{length}\r\n\r\n"
+        ).encode('latin-1')
+        parts.append((header, (start, stop)))
+    closing = f"\r\n--{boundary}--\r\n".encode('latin-1')
+    return parts, closing
+
+def send_stored_file(file, as_attachment=True):
+    """Send a stored file with conditional GET, byte-range and proxy offload support.
+    
+    Compressed content is sent as stored, with Content-Encoding, to clients
+    that accept its coding, and decompressed on the fly for the others.
+    Returns None when the file's content is missing from storage.
+    """
+    storage = get_storage()
+    length = storage.get_size(file.filename)
+    if length is None:
+        return None
+    
+    # The compressed and uncompressed bytes are two representations, each with its own validator
+    encoding = get_content_encoding(file)
+    decode = encoding is not None and not accepts_encoding(encoding)
+    etag = get_file_etag(file)
+    if decode:
+        length = file.size
+    elif encoding:
+        etag = f"{etag}-{encoding}"
+    last_modified = file.date_modified
+    chunk_size = current_app.config.get('DOWNLOAD_CHUNK_SIZE', 256 * 1024)
+    
+    response = Response(mimetype=file.mimetype, direct_passthrough=True)
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.headers['Accept-Ranges'] = 'bytes'
+    response.headers['Content-Disposition'] = get_content_disposition(file.original_filename, as_attachment)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    if encoding:
+        response.vary.add('Accept-Encoding')
+        if not decode:
+            response.content_encoding = encoding
+    
+    if is_not_modified(etag, last_modified):
+        response.status_code = 304
+        return response
+    
+    # Object storage serves the bytes (and Range) itself from a short-lived signed URL
+    download_url = None if decode else storage.get_download_url(
+        file.filename, file.original_filename, file.mimetype, as_attachment, encoding
+    )
+    if download_url:
+        response = redirect(download_url)
+        response.cache_control.private = True
+        response.cache_control.no_store = True
+        return response
+    
+    # Let the front proxy stream the bytes (and honour Range itself) instead of a worker
+    filepath = None if decode else storage.get_local_path(file.filename)
+    # Only content stored as is: proxies do not reliably pass Content-Encoding through an internal redirect
+    offload = current_app.config.get('DOWNLOAD_OFFLOAD') if filepath and not encoding else None
+    if offload == 'x-accel-redirect':
+        prefix = current_app.config.get('DOWNLOAD_ACCEL_PREFIX', '/protected-uploads/')
+        response.headers['X-Accel-Redirect'] = prefix + os.path.relpath(filepath, current_app.config['UPLOAD_FOLDER'])
+        return response
+    if offload == 'x-sendfile':
+        response.headers['X-Sendfile'] = os.path.abspath(filepath)
+        return response
+    
+    ranges = resolve_ranges(length) if is_range_applicable(etag, last_modified) else None
+    if ranges and len(ranges) > 1 and encoding and not decode:
+        # Content-Encoding would wrap the whole multipart body, so send the compressed file whole
+        ranges = None
+    
+    if ranges is None:
+        # Whole file: hand the server a file wrapper so it can use sendfile()
+        if filepath:
+            response.response = wrap_file(request.environ, open(filepath, 'rb'), chunk_size)
+        else:
+            response.response = iter_content(file, 0, length, chunk_size, decode=decode)
+        response.content_length = length
+        return response
+    
+    if not ranges:
+        response.status_code = 416
+        response.headers['Content-Range'] = f"bytes */{length}"
+        response.headers.pop('Content-Disposition')
+        response.headers.pop('Content-Encoding', None)
+        return response
+    
+    response.status_code = 206
+    if len(ranges) == 1:
+        start, stop = ranges[0]
+        response.response = iter_content(file, start, stop, chunk_size, decode=decode)
+        response.content_length = stop - start
+        response.headers['Content-Range'] = f"bytes {start}-{stop - 1}/{length}"
+        return response
+    
+    boundary = uuid.uuid4().hex
+    parts, closing = build_multipart_parts(ranges, length, file.mimetype, boundary)
+    response.response = iter_multipart_ranges(parts, closing, file, decode, chunk_size)
+    response.content_length = sum(len(header) + stop - start for header, (start, stop) in parts) + len(closing)
+    response.headers['Content-Type'] = f"multipart/byteranges; boundary={boundary}"
+    return response
@@ -1,3 +1,86 @@
+from flask import g, request, current_app, has_app_context
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.sql import Select
 
-db = SQLAlchemy()
\ No newline at end of file
+class RoutingSession(Session):
+    """Session that sends plain SELECTs to the read replica while a request allows it.
+    
+    Flushes, locking reads and raw SQL always go to the primary.
+    """
+    
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if (
+            bind is None and not self._flushing and isinstance(clause, Select) and clause._for_update_arg is None
+            and has_app_context() and g.get('use_replica')
+        ):
+            replica = self._db.engines.get('replica')
+            if replica is not None:
+                return replica
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+db = SQLAlchemy(session_options={'class_': RoutingSession})
+
+def normalize_database_url(url):
+    """Point PostgreSQL URLs without a driver at psycopg2, the one installed.
+    
+    The postgres:// scheme some hosts still hand out is accepted too.
+    """
+    if not url:
+        return url
+    parsed = make_url(url)
+    if parsed.drivername in ('postgres', 'postgresql'):
+        return parsed.set(drivername='postgresql+psycopg2').render_as_string(hide_password=False)
+    return url
+
+def get_engine_options(config):
+    """Build SQLAlchemy engine options from the DB_POOL_* settings"""
+    options = {
+        'pool_pre_ping': config['DB_POOL_PRE_PING'],
+        'pool_recycle': config['DB_POOL_RECYCLE'],
+    }
+    # In-memory SQLite keeps one connection per thread, which has no pool to size
+    url = make_url(config['SQLALCHEMY_DATABASE_URI'])
+    if url.get_backend_name() != 'sqlite' or url.database not in (None, '', ':memory:'):
+        options['pool_size'] = config['DB_POOL_SIZE']
+        options['max_overflow'] = config['DB_MAX_OVERFLOW']
+    return options
+
+def set_sqlite_pragmas(engine, config):
+    """Tune every new connection of a SQLite engine for concurrent web traffic"""
+    pragmas = {
+        'journal_mode': config['SQLITE_JOURNAL_MODE'],
+        'synchronous': config['SQLITE_SYNCHRONOUS'],
+        'busy_timeout': int(config['SQLITE_BUSY_TIMEOUT']),
+        'mmap_size': int(config['SQLITE_MMAP_SIZE']),
+    }
+    
+    @event.listens_for(engine, 'connect')
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+
+def use_replica_for_reads():
+    """Let the listings in READ_REPLICA_ENDPOINTS read from the replica on GET"""
+    g.use_replica = request.method == 'GET' and request.endpoint in current_app.config['READ_REPLICA_ENDPOINTS']
+
+def init_database(app):
+    """Configure the engines from the app config and bind the database to the app"""
+    config = app.config
+    config['SQLALCHEMY_DATABASE_URI'] = normalize_database_url(config['SQLALCHEMY_DATABASE_URI'])
+    config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', get_engine_options(config))
+    if config.get('DATABASE_REPLICA_URL'):
+        config.setdefault('SQLALCHEMY_BINDS', {})['replica'] = normalize_database_url(config['DATABASE_REPLICA_URL'])
+    
+    db.init_app(app)
+    
+    with app.app_context():
+        for engine in db.engines.values():
+            if engine.dialect.name == 'sqlite':
+                set_sqlite_pragmas(engine, config)
+    if config.get('DATABASE_REPLICA_URL'):
+        app.before_request(use_replica_for_reads)
@@ -17,12 +17,12 @@ class RegistrationForm(FlaskForm):
     security_question = StringField('Security Question', validators=[DataRequired()])
     security_answer = StringField('Security Answer', validators=[DataRequired()])
     submit = SubmitField('Register')
-
+    
     def validate_username(self, username):
         user = User.query.filter_by(username=username.data).first()
         if user is not None:
             raise ValidationError('Please use a different username.')
-
+    
     def validate_email(self, email):
         user = User.query.filter_by(email=email.data).first()
         if user is not None:
@@ -38,6 +38,10 @@ class FolderForm(FlaskForm):
     storage_class_id = HiddenField('Storage Class ID')
     submit = SubmitField('Create Folder')
 
+class RenameForm(FlaskForm):
+    name = StringField('New Name', validators=[DataRequired(), Length(max=128)])
+    submit = SubmitField('Rename')
+
 class StorageClassForm(FlaskForm):
     name = StringField('Class Name', validators=[DataRequired(), Length(max=64)])
     file_type = SelectField('File Type', choices=[
@@ -70,6 +74,19 @@ class AdminUserStorageForm(FlaskForm):
     storage_limit = StringField('Storage Limit (GB)', validators=[DataRequired()])
     submit = SubmitField('Update Storage Limit')
 
+class AdminUserLimitsForm(FlaskForm):
+    user_id = HiddenField('User ID', validators=[DataRequired()])
+    bandwidth_limit = StringField('Bandwidth Limit (MB/s, 0 for none, blank for the default)')
+    max_transfers = StringField('Concurrent Transfers (0 for no cap, blank for the default)')
+    submit = SubmitField('Update Transfer Limits')
+
+class AdminBulkUsersForm(FlaskForm):
+    action = SelectField('Action', choices=[
+        ('approve', 'Approve'), ('reject', 'Reject'), ('storage', 'Set Storage Limit')
+    ])
+    storage_limit = StringField('Storage Limit (GB)')
+    submit = SubmitField('Apply to Selected Users')
+
 class FileUploadForm(FlaskForm):
     file = FileField('File', validators=[DataRequired()])
     folder_id = HiddenField('Folder ID')
@@ -0,0 +1,382 @@
+import re
+import time
+import logging
+import threading
+from datetime import datetime
+from flask import current_app
+from sqlalchemy import select, update, delete, func, and_, or_, bindparam
+from sqlalchemy.orm import aliased
+
+from app import db
+from models import User, File, Folder, FolderClosure, Blob, UploadSession, QuotaReservation
+from blobstore import delete_contents
+from storage import get_storage
+
+# Examples kept per kind of problem; the counts are always complete
+MAX_EXAMPLES = 20
+
+# Names this application writes into the upload folder: blobs, upload scratch
+# files, pre-blob uploads (name_<uuid4>.ext) and profile pictures. Anything
+# else unreferenced is reported but never removed.
+OWN_NAME = re.compile(
+    r'^([0-9a-f]{64}|\.(upload|session)_[0-9a-f-]{36}|.*_[0-9a-f]{8}(-[0-9a-f]{4}){3}-[0-9a-f]{12}(\.\w+)?|profile_\d+\.\w+)$'
+)
+
+# State of the check started from the admin page, per process
+_online = {'running': False, 'report': None}
+_online_lock = threading.Lock()
+
+def get_folder_size_expression(folder):
+    """Correlated subtree total of a folder.
+    
+    A live folder counts its live files; a trashed folder counts the files
+    trashed along with it, which is what restoring it gives back.
+    """
+    return (
+        select(func.coalesce(func.sum(File.size), 0))
+        .join(FolderClosure, FolderClosure.descendant_id == File.folder_id)
+        .where(
+            FolderClosure.ancestor_id == folder.id,
+            or_(and_(File.deleted_at.is_(None), folder.deleted_at.is_(None)), File.deleted_at == folder.deleted_at)
+        )
+        .scalar_subquery()
+    )
+
+def get_user_totals_expressions():
+    """Correlated storage_used, file_count and folder_count of a user, as the live rows add up"""
+    live_size = select(func.coalesce(func.sum(File.size), 0)).where(
+        File.user_id == User.id, File.deleted_at.is_(None)
+    ).scalar_subquery()
+    reserved = select(func.coalesce(func.sum(QuotaReservation.size), 0)).where(
+        QuotaReservation.user_id == User.id
+    ).scalar_subquery()
+    live_files = select(func.count()).where(File.user_id == User.id, File.deleted_at.is_(None)).scalar_subquery()
+    live_folders = select(func.count()).where(
+        Folder.user_id == User.id, Folder.deleted_at.is_(None)
+    ).scalar_subquery()
+    return {'storage_used': live_size + reserved, 'file_count': live_files, 'folder_count': live_folders}
+
+def recompute_folder_sizes():
+    """Set every folder's size to the total of the files in its subtree in one UPDATE"""
+    db.session.execute(update(Folder).values(size=get_folder_size_expression(Folder), version=Folder.version + 1))
+    db.session.execute(update(User).values(root_version=User.root_version + 1))
+
+def iter_id_batches(column, batch_size):
+    """Yield the values of an integer primary key in ascending batches"""
+    last_id = 0
+    while True:
+        ids = db.session.execute(
+            select(column).where(column > last_id).order_by(column).limit(batch_size)
+        ).scalars().all()
+        if not ids:
+            return
+        yield ids
+        last_id = ids[-1]
+
+def new_report():
+    """Start an empty fsck report"""
+    return {
+        'started': datetime.utcnow().isoformat(),
+        'finished': None,
+        'repair': False,
+        'folders_checked': 0,
+        'folders_missing_from_tree': 0,
+        'folder_sizes_wrong': 0,
+        'users_checked': 0,
+        'user_totals_wrong': 0,
+        'blobs_checked': 0,
+        'blob_ref_counts_wrong': 0,
+        'blobs_unreferenced': 0,
+        'blobs_missing': 0,
+        'blobs_wrong_size': 0,
+        'legacy_files_missing': 0,
+        'disk_entries_scanned': 0,
+        'orphaned_on_disk': 0,
+        'orphaned_bytes': 0,
+        'unknown_on_disk': 0,
+        'repaired': 0,
+        'examples': {},
+    }
+
+def note(report, kind, example, count=1):
+    """Count a problem in the report and keep a few examples of it"""
+    report[kind] += count
+    examples = report['examples'].setdefault(kind, [])
+    if len(examples) < MAX_EXAMPLES:
+        examples.append(example)
+
+def check_folders(report, repair, batch_size):
+    """Compare every folder's stored size with its subtree total, one grouped query per batch"""
+    missing = db.session.execute(
+        select(func.count()).select_from(Folder).where(
+            ~select(FolderClosure.ancestor_id).where(
+                FolderClosure.ancestor_id == Folder.id, FolderClosure.descendant_id == Folder.id
+            ).exists()
+        )
+    ).scalar()
+    if missing:
+        note(report, 'folders_missing_from_tree', "run 'flask backfill-folder-tree'", missing)
+    
+    ancestor = aliased(Folder)
+    for ids in iter_id_batches(Folder.id, batch_size):
+        rows = db.session.execute(
+            select(ancestor.id, ancestor.size, func.coalesce(func.sum(File.size), 0))
+            .select_from(ancestor)
+            .join(FolderClosure, FolderClosure.ancestor_id == ancestor.id)
+            .outerjoin(File, and_(
+                File.folder_id == FolderClosure.descendant_id,
+                or_(and_(File.deleted_at.is_(None), ancestor.deleted_at.is_(None)),
+                    File.deleted_at == ancestor.deleted_at)
+            ))
+            .where(ancestor.id.in_(ids))
+            .group_by(ancestor.id, ancestor.size)
+        ).all()
+        report['folders_checked'] += len(ids)
+        
+        wrong = [folder_id for folder_id, stored, actual in rows if (stored or 0) != actual]
+        for folder_id, stored, actual in rows:
+            if (stored or 0) != actual:
+                note(report, 'folder_sizes_wrong', {'folder_id': folder_id, 'stored': stored, 'actual': actual})
+        if repair and wrong:
+            # Recomputed inside the UPDATE, so changes made since the check are not overwritten
+            db.session.execute(
+                update(Folder).where(Folder.id.in_(wrong))
+                .values(size=get_folder_size_expression(Folder), version=Folder.version + 1)
+                .execution_options(synchronize_session=False)
+            )
+            # Top-level folder sizes show in the root listing
+            db.session.execute(
+                update(User).where(User.id.in_(select(Folder.user_id).where(Folder.id.in_(wrong))))
+                .values(root_version=User.root_version + 1)
+                .execution_options(synchronize_session=False)
+            )
+            db.session.commit()
+            report['repaired'] += len(wrong)
+        db.session.rollback()
+
+def check_users(report, repair, batch_size):
+    """Compare each user's storage_used and counters with their live rows, one grouped query each per batch"""
+    for ids in iter_id_batches(User.id, batch_size):
+        stored = {
+            user_id: (storage_used or 0, file_count or 0, folder_count or 0)
+            for user_id, storage_used, file_count, folder_count in db.session.execute(
+                select(User.id, User.storage_used, User.file_count, User.folder_count).where(User.id.in_(ids))
+            )
+        }
+        live = {
+            user_id: (size, count) for user_id, size, count in db.session.execute(
+                select(File.user_id, func.sum(File.size), func.count())
+                .where(File.user_id.in_(ids), File.deleted_at.is_(None)).group_by(File.user_id)
+            )
+        }
+        reserved = dict(db.session.execute(
+            select(QuotaReservation.user_id, func.sum(QuotaReservation.size))
+            .where(QuotaReservation.user_id.in_(ids)).group_by(QuotaReservation.user_id)
+        ).all())
+        folders = dict(db.session.execute(
+            select(Folder.user_id, func.count()).where(Folder.user_id.in_(ids), Folder.deleted_at.is_(None))
+            .group_by(Folder.user_id)
+        ).all())
+        report['users_checked'] += len(ids)
+        
+        wrong = []
+        for user_id in ids:
+            size, count = live.get(user_id, (0, 0))
+            actual = ((size or 0) + (reserved.get(user_id) or 0), count, folders.get(user_id, 0))
+            if stored[user_id] != actual:
+                wrong.append(user_id)
+                note(report, 'user_totals_wrong', {
+                    'user_id': user_id,
+                    'stored': dict(zip(('storage_used', 'file_count', 'folder_count'), stored[user_id])),
+                    'actual': dict(zip(('storage_used', 'file_count', 'folder_count'), actual)),
+                })
+        if repair and wrong:
+            db.session.execute(
+                update(User).where(User.id.in_(wrong)).values(**get_user_totals_expressions())
+                .execution_options(synchronize_session=False)
+            )
+            db.session.commit()
+            report['repaired'] += len(wrong)
+        db.session.rollback()
+
+def check_blobs(report, repair, batch_size):
+    """Check each blob's reference count and its content on disk, a batch at a time"""
+    for ids in iter_id_batches(Blob.id, batch_size):
+        blobs = db.session.execute(
+            select(Blob.id, Blob.filename, func.coalesce(Blob.stored_size, Blob.size), Blob.ref_count)
+            .where(Blob.id.in_(ids))
+        ).all()
+        references = dict(db.session.execute(
+            select(File.blob_id, func.count()).where(File.blob_id.in_(ids)).group_by(File.blob_id)
+        ).all())
+        report['blobs_checked'] += len(blobs)
+        
+        wrong_counts = []
+        unreferenced = []
+        storage = get_storage()
+        for blob_id, filename, stored_size, ref_count in blobs:
+            actual = references.get(blob_id, 0)
+            if actual == 0:
+                unreferenced.append((blob_id, filename))
+                note(report, 'blobs_unreferenced', {'blob_id': blob_id, 'filename': filename})
+            if ref_count != actual:
+                wrong_counts.append({'blob_id': blob_id, 'actual': actual})
+                note(report, 'blob_ref_counts_wrong', {'blob_id': blob_id, 'stored': ref_count, 'actual': actual})
+            
+            disk_size = storage.get_size(filename)
+            if disk_size is None:
+                note(report, 'blobs_missing', {'blob_id': blob_id, 'filename': filename, 'files': actual})
+                continue
+            # Compressed blobs are compared on their compressed size
+            if disk_size != stored_size:
+                note(report, 'blobs_wrong_size', {'blob_id': blob_id, 'stored': stored_size, 'on_disk': disk_size})
+        
+        if repair and (wrong_counts or unreferenced):
+            blob_table = Blob.__table__
+            if wrong_counts:
+                db.session.execute(
+                    blob_table.update().where(blob_table.c.id == bindparam('blob_id'))
+                    .values(ref_count=bindparam('actual')),
+                    wrong_counts
+                )
+                db.session.commit()
+            names = []
+            for blob_id, filename in unreferenced:
+                # Deleted only if still unreferenced, in case an upload just claimed it
+                deleted = db.session.execute(
+                    delete(Blob).where(
+                        Blob.id == blob_id, Blob.ref_count <= 0,
+                        ~select(File.id).where(File.blob_id == blob_id).exists()
+                    )
+                ).rowcount
+                if deleted:
+                    names.append(filename)
+            db.session.commit()
+            delete_contents(names)
+            report['repaired'] += len(wrong_counts) + len(names)
+        db.session.rollback()
+
+def check_legacy_files(report, batch_size):
+    """Check that files stored before blobs existed are still on disk"""
+    storage = get_storage()
+    last_id = 0
+    while True:
+        files = db.session.execute(
+            select(File.id, File.filename).where(File.blob_id.is_(None), File.id > last_id)
+            .order_by(File.id).limit(batch_size)
+        ).all()
+        if not files:
+            break
+        for file_id, filename in files:
+            if storage.get_size(filename) is None:
+                note(report, 'legacy_files_missing', {'file_id': file_id, 'filename': filename})
+        last_id = files[-1][0]
+        db.session.rollback()
+
+def find_orphans(names):
+    """Get which of a batch of upload-folder names nothing in the database refers to"""
+    known = set(db.session.execute(select(Blob.filename).where(Blob.filename.in_(names))).scalars())
+    known.update(db.session.execute(
+        select(File.filename).where(File.blob_id.is_(None), File.filename.in_(names))
+    ).scalars())
+    known.update(db.session.execute(
+        select(User.profile_picture).where(User.profile_picture.in_(names))
+    ).scalars())
+    session_ids = [name[len('.session_'):] for name in names if name.startswith('.session_')]
+    if session_ids:
+        known.update(
+            f".session_{session_id}" for session_id in db.session.execute(
+                select(UploadSession.id).where(UploadSession.id.in_(session_ids))
+            ).scalars()
+        )
+    db.session.rollback()
+    return [name for name in names if name not in known]
+
+def scan_upload_folder(report, repair, batch_size):
+    """Stream the stored content and look up its entries in the database a batch at a time.
+    
+    Nothing younger than FSCK_ORPHAN_GRACE is treated as an orphan: uploads
+    rename their content into place just before committing its row.
+    """
+    storage = get_storage()
+    cutoff = time.time() - current_app.config.get('FSCK_ORPHAN_GRACE', 3600)
+    
+    def flush(batch):
+        by_name = {name: (size, mtime) for name, size, mtime in batch}
+        orphans = find_orphans(list(by_name))
+        for name in orphans:
+            size, mtime = by_name[name]
+            if mtime > cutoff:
+                continue
+            if not OWN_NAME.match(name):
+                note(report, 'unknown_on_disk', name)
+                continue
+            note(report, 'orphaned_on_disk', name)
+            report['orphaned_bytes'] += size
+            if repair:
+                try:
+                    storage.delete(name)
+                    report['repaired'] += 1
+                except Exception as e:
+                    logging.error(f"Error removing orphan {name}: {str(e)}")
+    
+    batch = []
+    for entry in storage.iter_entries():
+        # Lock files are the only other dotfiles kept here
+        if entry[0].endswith('.lock'):
+            continue
+        report['disk_entries_scanned'] += 1
+        batch.append(entry)
+        if len(batch) >= batch_size:
+            flush(batch)
+            batch = []
+    if batch:
+        flush(batch)
+
+def run_fsck(repair=False, batch_size=None):
+    """Check folder sizes, user totals, blobs and the upload folder against each other.
+    
+    With `repair`, derived totals are recomputed, reference counts fixed and
+    unreferenced content removed. Missing content can only be reported.
+    Returns the report.
+    """
+    batch_size = batch_size or current_app.config.get('FSCK_BATCH_SIZE', 1000)
+    report = new_report()
+    report['repair'] = repair
+    check_folders(report, repair, batch_size)
+    check_users(report, repair, batch_size)
+    check_blobs(report, repair, batch_size)
+    check_legacy_files(report, batch_size)
+    scan_upload_folder(report, repair, batch_size)
+    if repair:
+        # Per-type usage is rebuilt wholesale; it is a single grouped query
+        from stats import reconcile_user_stats
+        reconcile_user_stats()
+    report['finished'] = datetime.utcnow().isoformat()
+    return report
+
+def start_online_fsck(app, repair=False):
+    """Run fsck in a background thread of this process. Returns False if one is already running."""
+    with _online_lock:
+        if _online['running']:
+            return False
+        _online['running'] = True
+    
+    def run():
+        with app.app_context():
+            try:
+                _online['report'] = run_fsck(repair=repair)
+            except Exception as e:
+                db.session.rollback()
+                logging.error(f"Error running fsck: {str(e)}")
+                _online['report'] = {'error': str(e)}
+            finally:
+                db.session.remove()
+                _online['running'] = False
+    
+    threading.Thread(target=run, name='fsck', daemon=True).start()
+    return True
+
+def get_online_fsck_status():
+    """Get whether the background fsck is running and the report of the last run"""
+    return {'running': _online['running'], 'report': _online['report']}
@@ -0,0 +1,65 @@
+import time
+import hashlib
+from flask import current_app, request, session, make_response, Response
+from flask_login import current_user
+from cache import TTLCache
+
+# Response headers kept with a cached listing, besides its body and type
+CACHED_HEADERS = ('X-Next-Cursor', 'Link')
+
+_listings = None
+
+def get_listing_cache():
+    """Get the cache of built listing responses, sized from the config on first use"""
+    global _listings
+    if _listings is None:
+        _listings = TTLCache(
+            maxsize=current_app.config.get('LISTING_CACHE_SIZE', 1024),
+            ttl=current_app.config.get('LISTING_CACHE_TTL', 300)
+        )
+    return _listings
+
+def get_listing_etag(version, per_session=False):
+    """Derive the ETag of the current listing request from the version of what it lists.
+    
+    Pages that embed forms also depend on the session's CSRF secret, on how
+    long their token stays valid and on the user details every page shows.
+    """
+    parts = [current_user.id, version, request.full_path]
+    if per_session:
+        parts += [session['csrf_token'], current_user.username, current_user.profile_picture, current_user.is_admin]
+        # Tokens expire, so a page is never reused for more than half their lifetime
+        time_limit = current_app.config.get('WTF_CSRF_TIME_LIMIT', 3600)
+        if time_limit:
+            parts.append(int(time.time() // (time_limit / 2)))
+    return hashlib.sha256(':'.join(str(part) for part in parts).encode()).hexdigest()[:32]
+
+def versioned_response(version, build, per_session=False):
+    """Answer a listing request from its version rather than rebuilding it when possible.
+    
+    A client that already holds the current listing gets a 304; otherwise
+    the response comes from the cache, or from `build()` on a miss. Pages
+    showing flashed messages are always built and are neither cached nor
+    tagged.
+    """
+    if '_flashes' in session or (per_session and 'csrf_token' not in session):
+        return make_response(build())
+    
+    etag = get_listing_etag(version, per_session)
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        cache = get_listing_cache()
+        cached = cache.get(etag)
+        if cached is None:
+            response = make_response(build())
+            if response.status_code != 200:
+                return response
+            headers = [(name, value) for name, value in response.headers if name in CACHED_HEADERS]
+            cache.set(etag, (response.get_data(), response.mimetype, headers))
+        else:
+            data, mimetype, headers = cached
+            response = Response(data, mimetype=mimetype, headers=headers)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
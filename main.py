@@ -1,7 +1,15 @@
 from app import app  # noqa: F401
 from routes import *  # noqa: F401
+import commands  # noqa: F401
+from trash import init_purge_worker
+from auth import init_login
+from metrics import init_metrics
 import logging
 
+init_login(app)
+init_metrics(app)
+init_purge_worker(app)
+
 if __name__ == "__main__":
     logging.basicConfig(level=logging.DEBUG)
     app.run(host="0.0.0.0", port=5000, debug=True)
@@ -0,0 +1,204 @@
+import time
+import logging
+import threading
+from flask import g, request, current_app, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Upper bounds of the histogram buckets; +Inf is implied
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+# Name -> (type, help) of everything exported, in output order
+METRICS = {
+    'eforice_requests_total': ('counter', 'Requests handled, by endpoint, method and status.'),
+    'eforice_request_duration_seconds': ('histogram', 'Time to produce a response, by endpoint.'),
+    'eforice_request_queries': ('histogram', 'SQL statements executed per request, by endpoint.'),
+    'eforice_sql_queries_total': ('counter', 'SQL statements executed, by endpoint.'),
+    'eforice_sql_seconds_total': ('counter', 'Time spent executing SQL statements, by endpoint.'),
+    'eforice_commits_total': ('counter', 'Database transactions committed, by endpoint.'),
+    'eforice_transfer_bytes_total': ('counter', 'File bytes received and sent, by endpoint and direction.'),
+}
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+    
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.sum += value
+        self.count += 1
+
+class Registry:
+    """Counters and histograms of this process, keyed by metric name and label values"""
+    
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.lock = threading.Lock()
+    
+    def inc(self, name, labels, amount=1):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+    
+    def observe(self, name, labels, value, buckets):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+    
+    def get_counter(self, name, labels):
+        with self.lock:
+            return self.counters.get((name, tuple(sorted(labels.items()))), 0)
+    
+    def render(self):
+        """Render everything in the Prometheus text exposition format"""
+        lines = []
+        with self.lock:
+            for name, (kind, help_text) in METRICS.items():
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                if kind == 'counter':
+                    for (metric, labels), value in sorted(self.counters.items()):
+                        if metric == name:
+                            lines.append(f"{name}{format_labels(labels)} {format_value(value)}")
+                    continue
+                for (metric, labels), histogram in sorted(self.histograms.items(), key=lambda item: item[0]):
+                    if metric != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{format_labels(labels + (('le', str(bound)),))} {cumulative}")
+                    lines.append(f"{name}_sum{format_labels(labels)} {format_value(histogram.sum)}")
+                    lines.append(f"{name}_count{format_labels(labels)} {histogram.count}")
+        return '\n'.join(lines) + '\n'
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (
+        (key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for key, value in labels
+    )
+    return '{' + ','.join(f'{key}="{value}"' for key, value in escaped) + '}'
+
+def format_value(value):
+    return repr(round(value, 6)) if isinstance(value, float) else str(value)
+
+registry = Registry()
+
+class RequestStats:
+    """What one request has cost so far"""
+    
+    def __init__(self, capture):
+        self.start = time.perf_counter()
+        self.queries = 0
+        self.sql_time = 0.0
+        self.commits = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.status = 500
+        # (seconds, statement) of each query, kept only for the slow-request log
+        self.captured = [] if capture else None
+
+def get_request_stats():
+    """Get the stats of the current request, or None outside a request or before instrumentation starts"""
+    if not has_request_context():
+        return None
+    return g.get('_metrics')
+
+def record_transfer(direction, size):
+    """Count file bytes received ('in') or sent ('out') by the current request"""
+    stats = get_request_stats()
+    if stats is None or not size:
+        return
+    if direction == 'in':
+        stats.bytes_in += size
+    else:
+        stats.bytes_out += size
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('metrics_query_start', []).append(time.perf_counter())
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get('metrics_query_start')
+    if not starts:
+        return
+    # Popped even outside requests, or pooled connections would keep every start
+    elapsed = time.perf_counter() - starts.pop()
+    stats = get_request_stats()
+    if stats is None:
+        return
+    stats.queries += 1
+    stats.sql_time += elapsed
+    if stats.captured is not None and len(stats.captured) < 500:
+        stats.captured.append((elapsed, statement))
+
+def on_error(context):
+    # A statement that fails never reaches after_cursor_execute, so its start is dropped here
+    if context.connection is not None:
+        context.connection.info.pop('metrics_query_start', None)
+
+def on_commit(conn):
+    stats = get_request_stats()
+    if stats is not None:
+        stats.commits += 1
+
+def start_request():
+    g._metrics = RequestStats(capture=bool(current_app.config.get('SLOW_REQUEST_THRESHOLD')))
+
+def note_status(response):
+    stats = get_request_stats()
+    if stats is not None:
+        stats.status = response.status_code
+    return response
+
+def finish_request(exc=None):
+    stats = get_request_stats()
+    if stats is None:
+        return
+    elapsed = time.perf_counter() - stats.start
+    endpoint = request.endpoint or 'unmatched'
+    labels = {'endpoint': endpoint}
+    registry.inc('eforice_requests_total', {**labels, 'method': request.method, 'status': str(stats.status)})
+    registry.observe('eforice_request_duration_seconds', labels, elapsed, LATENCY_BUCKETS)
+    registry.observe('eforice_request_queries', labels, stats.queries, QUERY_COUNT_BUCKETS)
+    registry.inc('eforice_sql_queries_total', labels, stats.queries)
+    registry.inc('eforice_sql_seconds_total', labels, stats.sql_time)
+    registry.inc('eforice_commits_total', labels, stats.commits)
+    if stats.bytes_in:
+        registry.inc('eforice_transfer_bytes_total', {**labels, 'direction': 'in'}, stats.bytes_in)
+    if stats.bytes_out:
+        registry.inc('eforice_transfer_bytes_total', {**labels, 'direction': 'out'}, stats.bytes_out)
+    
+    threshold = current_app.config.get('SLOW_REQUEST_THRESHOLD')
+    if threshold and elapsed >= threshold:
+        queries = '\n'.join(
+            f"  {seconds * 1000:8.2f} ms  {' '.join(statement.split())}" for seconds, statement in stats.captured
+        )
+        logging.warning(
+            f"Slow request {request.method} {request.full_path} ({endpoint}): {elapsed * 1000:.1f} ms, "
+            f"{stats.queries} queries in {stats.sql_time * 1000:.1f} ms, {stats.commits} commits\n{queries}"
+        )
+
+def init_metrics(app):
+    """Instrument requests and SQL for the /metrics endpoint and the slow-request log"""
+    event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+    event.listen(Engine, 'after_cursor_execute', after_cursor_execute)
+    event.listen(Engine, 'handle_error', on_error)
+    event.listen(Engine, 'commit', on_commit)
+    
+    app.before_request(start_request)
+    app.after_request(note_status)
+    app.teardown_request(finish_request)
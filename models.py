@@ -4,6 +4,12 @@ from datetime import datetime
 import os
 
 class User(UserMixin, db.Model):
+    # The admin dashboard sorts users by usage and by registration date
+    __table_args__ = (
+        db.Index('ix_user_storage_used', 'storage_used', 'id'),
+        db.Index('ix_user_date_registered', 'date_registered', 'id'),
+    )
+    
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(64), unique=True, nullable=False)
     email = db.Column(db.String(120), unique=True, nullable=False)
@@ -14,6 +20,13 @@ class User(UserMixin, db.Model):
     profile_picture = db.Column(db.String(256), default='')
     storage_limit = db.Column(db.BigInteger, default=1073741824)  # 1GB default storage
     storage_used = db.Column(db.BigInteger, default=0)
+    bandwidth_limit = db.Column(db.BigInteger, nullable=True)  # Bytes per second across transfers; None for the default, 0 for none
+    max_transfers = db.Column(db.Integer, nullable=True)  # Concurrent uploads/downloads; None for the default, 0 for no cap
+    file_count = db.Column(db.BigInteger, default=0, nullable=False)  # Live (not trashed) files
+    folder_count = db.Column(db.BigInteger, default=0, nullable=False)  # Live (not trashed) folders
+    root_version = db.Column(db.BigInteger, default=0, nullable=False)  # Bumped whenever the root listing may change
+    change_seq = db.Column(db.BigInteger, default=0, nullable=False)  # Sequence number of the newest change event
+    change_floor = db.Column(db.BigInteger, default=0, nullable=False)  # Newest change event compacted away
     security_question = db.Column(db.String(256))
     security_answer = db.Column(db.String(256))
     
@@ -24,6 +37,16 @@ class User(UserMixin, db.Model):
     def __repr__(self):
         return f'<User {self.username}>'
 
+class UserTypeUsage(db.Model):
+    """Running totals of a user's live files for one file type"""
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), primary_key=True)
+    file_type = db.Column(db.String(20), primary_key=True)
+    size = db.Column(db.BigInteger, default=0, nullable=False)  # Size in bytes
+    file_count = db.Column(db.BigInteger, default=0, nullable=False)
+    
+    def __repr__(self):
+        return f'<UserTypeUsage {self.user_id} {self.file_type}: {self.file_count} files>'
+
 class StorageClass(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(64), nullable=False)
@@ -38,6 +61,10 @@ class StorageClass(db.Model):
         return f'<StorageClass {self.name} ({self.file_type})>'
 
 class Folder(db.Model):
+    __table_args__ = (
+        db.Index('ix_folder_user_parent_class', 'user_id', 'parent_id', 'storage_class_id'),
+    )
+    
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(128), nullable=False)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False)
@@ -45,6 +72,8 @@ class Folder(db.Model):
     date_created = db.Column(db.DateTime, default=datetime.utcnow)
     size = db.Column(db.BigInteger, default=0)  # Size in bytes
     storage_class_id = db.Column(db.Integer, db.ForeignKey('storage_class.id', ondelete='SET NULL'), nullable=True)
+    deleted_at = db.Column(db.DateTime, nullable=True, index=True)  # Set while the folder is in the trash
+    version = db.Column(db.BigInteger, default=0, nullable=False)  # Bumped whenever the folder's listing may change
     
     # Relationships
     files = db.relationship('File', backref='folder', lazy=True, cascade="all, delete-orphan")
@@ -55,15 +84,67 @@ class Folder(db.Model):
     
     def calculate_size(self):
         """Calculate total size of folder including all files and subfolders"""
-        size = 0
-        for file in self.files:
-            size += file.size
-        for subfolder in self.subfolders:
-            size += subfolder.calculate_size()
+        size = db.session.query(db.func.coalesce(db.func.sum(File.size), 0)).join(
+            FolderClosure, FolderClosure.descendant_id == File.folder_id
+        ).filter(FolderClosure.ancestor_id == self.id, File.deleted_at.is_(None)).scalar()
         self.size = size
         return size
+    
+    def get_descendants(self, include_self=False):
+        """Query every folder below this one"""
+        query = Folder.query.join(FolderClosure, FolderClosure.descendant_id == Folder.id).filter(
+            FolderClosure.ancestor_id == self.id
+        )
+        if not include_self:
+            query = query.filter(FolderClosure.depth > 0)
+        return query
+    
+    def get_breadcrumbs(self):
+        """Get the folders from the root down to this one"""
+        return Folder.query.join(FolderClosure, FolderClosure.ancestor_id == Folder.id).filter(
+            FolderClosure.descendant_id == self.id
+        ).order_by(FolderClosure.depth.desc()).all()
+
+class FolderClosure(db.Model):
+    """Closure table of the folder tree: one row per (ancestor, descendant) pair, including self"""
+    ancestor_id = db.Column(db.Integer, db.ForeignKey('folder.id', ondelete='CASCADE'), primary_key=True)
+    descendant_id = db.Column(db.Integer, db.ForeignKey('folder.id', ondelete='CASCADE'), primary_key=True, index=True)
+    depth = db.Column(db.Integer, nullable=False)  # 0 for the folder itself, 1 for its parent, ...
+    
+    def __repr__(self):
+        return f'<FolderClosure {self.ancestor_id}->{self.descendant_id} ({self.depth})>'
+
+class Blob(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    checksum = db.Column(db.String(64), unique=True, nullable=False)  # SHA-256 hex digest of the content
+    filename = db.Column(db.String(256), unique=True, nullable=False)
+    size = db.Column(db.BigInteger, nullable=False)  # Size in bytes
+    encoding = db.Column(db.String(16), nullable=True)  # Content coding at rest ('gzip', 'zstd'), None if stored as is
+    stored_size = db.Column(db.BigInteger, nullable=True)  # Bytes actually stored; None on blobs older than compression
+    ref_count = db.Column(db.Integer, default=0, nullable=False)  # Number of File rows sharing this blob
+    date_created = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    # Relationships
+    files = db.relationship('File', backref='blob', lazy=True)
+    
+    def __repr__(self):
+        return f'<Blob {self.checksum[:12]} ({self.ref_count} refs)>'
+    
+    def get_path(self):
+        """Get the full path to the blob on disk, or None when storage is not local"""
+        from storage import get_storage
+        return get_storage().get_local_path(self.filename)
 
 class File(db.Model):
+    # One index per listing sort key, so each page is a bounded range scan within a folder
+    __table_args__ = (
+        db.Index('ix_file_user_folder_name', 'user_id', 'folder_id', 'original_filename', 'id'),
+        db.Index('ix_file_user_folder_date', 'user_id', 'folder_id', 'date_uploaded', 'id'),
+        db.Index('ix_file_user_folder_size', 'user_id', 'folder_id', 'size', 'id'),
+        db.Index('ix_file_user_folder_type', 'user_id', 'folder_id', 'file_type', 'id'),
+        db.Index('ix_file_user_uploaded', 'user_id', 'date_uploaded'),
+    )
+    
     id = db.Column(db.Integer, primary_key=True)
     filename = db.Column(db.String(256), nullable=False)
     original_filename = db.Column(db.String(256), nullable=False)
@@ -72,6 +153,8 @@ class File(db.Model):
     size = db.Column(db.BigInteger, nullable=False)  # Size in bytes
     user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False)
     folder_id = db.Column(db.Integer, db.ForeignKey('folder.id', ondelete='CASCADE'), nullable=True)
+    blob_id = db.Column(db.Integer, db.ForeignKey('blob.id'), nullable=True)
+    deleted_at = db.Column(db.DateTime, nullable=True, index=True)  # Set while the file is in the trash
     date_uploaded = db.Column(db.DateTime, default=datetime.utcnow)
     date_modified = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
@@ -79,9 +162,9 @@ class File(db.Model):
         return f'<File {self.filename}>'
     
     def get_path(self):
-        """Get the full path to the file on disk"""
-        from app import app
-        return os.path.join(app.config['UPLOAD_FOLDER'], self.filename)
+        """Get the full path to the file on disk, or None when storage is not local"""
+        from storage import get_storage
+        return get_storage().get_local_path(self.filename)
     
     def get_size_display(self):
         """Get a human-readable file size"""
@@ -91,3 +174,80 @@ class File(db.Model):
                 break
             size /= 1024
         return f"{size:.2f} {unit}"
+
+class UploadSession(db.Model):
+    """A resumable upload whose chunks are written straight into one preallocated file"""
+    id = db.Column(db.String(36), primary_key=True)  # Random UUID, also part of the scratch file name
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False, index=True)
+    folder_id = db.Column(db.Integer, db.ForeignKey('folder.id', ondelete='CASCADE'), nullable=True)
+    filename = db.Column(db.String(256), nullable=False)
+    mimetype = db.Column(db.String(128), nullable=False)
+    total_size = db.Column(db.BigInteger, nullable=False)  # Size in bytes
+    chunk_size = db.Column(db.Integer, nullable=False)  # Size of every chunk but the last
+    chunk_count = db.Column(db.Integer, nullable=False)
+    date_created = db.Column(db.DateTime, default=datetime.utcnow)
+    date_updated = db.Column(db.DateTime, default=datetime.utcnow, index=True)  # Last chunk received
+    reservation_id = db.Column(db.Integer, nullable=True)  # QuotaReservation holding total_size
+    finalizing = db.Column(db.Boolean, default=False, nullable=False)  # Set while completing; chunks are refused
+    
+    # Relationships
+    chunks = db.relationship('UploadChunk', backref='session', lazy=True, cascade="all, delete-orphan")
+    
+    def __repr__(self):
+        return f'<UploadSession {self.id} ({self.filename})>'
+    
+    def get_path(self):
+        """Get the full path to the scratch file the chunks are written into"""
+        from app import app
+        return os.path.join(app.config['UPLOAD_FOLDER'], f".session_{self.id}")
+    
+    def get_chunk_length(self, index):
+        """Get the exact number of bytes chunk `index` must contain"""
+        if index == self.chunk_count - 1:
+            return self.total_size - index * self.chunk_size
+        return self.chunk_size
+
+class UploadChunk(db.Model):
+    """One chunk of an upload session that has been fully written"""
+    session_id = db.Column(db.String(36), db.ForeignKey('upload_session.id', ondelete='CASCADE'), primary_key=True)
+    index = db.Column(db.Integer, primary_key=True)
+    date_received = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<UploadChunk {self.session_id}#{self.index}>'
+
+class QuotaReservation(db.Model):
+    """Storage charged to a user for an upload still in flight; already included in storage_used"""
+    # Ids must never be reused, or releasing a settled reservation could refund someone else's
+    __table_args__ = {'sqlite_autoincrement': True}
+    
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False, index=True)
+    size = db.Column(db.BigInteger, default=0, nullable=False)  # Size in bytes
+    date_created = db.Column(db.DateTime, default=datetime.utcnow)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)  # Released by the purge worker after this
+    
+    def __repr__(self):
+        return f'<QuotaReservation {self.id} user {self.user_id}: {self.size} bytes>'
+
+class ChangeEvent(db.Model):
+    """One entry of a user's append-only change journal, read by sync clients"""
+    __table_args__ = (
+        db.Index('ix_change_event_user_seq', 'user_id', 'seq', unique=True),
+        {'sqlite_autoincrement': True},
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False)
+    # Per-user sequence number and sync cursor, taken from User.change_seq under the user row's lock
+    seq = db.Column(db.BigInteger, nullable=False)
+    action = db.Column(db.String(16), nullable=False)  # create, delete or rename
+    item_type = db.Column(db.String(16), nullable=False)  # file or folder
+    item_id = db.Column(db.Integer, nullable=False)
+    parent_id = db.Column(db.Integer, nullable=True)  # Folder the item is (or was) in; None for the root
+    name = db.Column(db.String(256), nullable=False)
+    size = db.Column(db.BigInteger, nullable=True)  # Size in bytes, for files
+    date_created = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    
+    def __repr__(self):
+        return f'<ChangeEvent {self.id} user {self.user_id}: {self.action} {self.item_type} {self.item_id}>'
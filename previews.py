@@ -0,0 +1,222 @@
+import os
+import time
+import shutil
+import logging
+import tempfile
+import subprocess
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from flask import current_app
+from storage import get_storage, create_storage
+
+# Pillow is optional: without it only PDF previews (through pdftoppm) are available
+try:
+    from PIL import Image, ImageDraw, ImageOps
+except ImportError:
+    Image = None
+
+IMAGE_EXTENSIONS = {'jpg', 'jpeg', 'png', 'gif', 'webp', 'bmp', 'tiff'}
+TEXT_EXTENSIONS = {'txt', 'csv'}
+
+_executor = None
+_last_eviction = 0
+# (settings, backend) of a worker process, so each worker connects to storage once
+_worker_storage = None
+
+def get_preview_kind(file):
+    """Get how a preview can be rendered for a file: 'image', 'pdf', 'text' or None"""
+    ext = file.original_filename.rsplit('.', 1)[1].lower() if '.' in file.original_filename else ''
+    if ext in IMAGE_EXTENSIONS and Image is not None:
+        return 'image'
+    if ext == 'pdf' and shutil.which('pdftoppm'):
+        return 'pdf'
+    if ext in TEXT_EXTENSIONS and Image is not None:
+        return 'text'
+    return None
+
+def get_preview_path(file, size):
+    """Get the cache path of a preview; content-addressed so it never goes stale"""
+    key = file.blob.checksum if file.blob else f"file{file.id}"
+    return os.path.join(current_app.config['PREVIEW_FOLDER'], f"{key}_{size}.jpg")
+
+def render_preview(source_path, kind, dest_path, size):
+    """Render a JPEG preview no larger than size x size. Runs in a worker process."""
+    temp_path = f"{dest_path}.{os.getpid()}.tmp"
+    try:
+        if kind == 'image':
+            with Image.open(source_path) as image:
+                image.draft('RGB', (size, size))
+                image = ImageOps.exif_transpose(image)
+                image.thumbnail((size, size))
+                image.convert('RGB').save(temp_path, 'JPEG', quality=85, optimize=True)
+        elif kind == 'pdf':
+            # First page only; pdftoppm appends the extension itself
+            subprocess.run(
+                ['pdftoppm', '-f', '1', '-l', '1', '-singlefile', '-jpeg', '-scale-to', str(size),
+                 source_path, temp_path],
+                check=True, timeout=60, capture_output=True
+            )
+            os.replace(f"{temp_path}.jpg", temp_path)
+        elif kind == 'text':
+            with open(source_path, 'r', errors='replace') as f:
+                lines = [f.readline().rstrip('\n')[:120] for _ in range(60)]
+            image = Image.new('RGB', (size, size), 'white')
+            draw = ImageDraw.Draw(image)
+            for i, line in enumerate(lines):
+                draw.text((4, 4 + i * 12), line, fill='black')
+            image.save(temp_path, 'JPEG', quality=85)
+        else:
+            return False
+        os.replace(temp_path, dest_path)
+        return True
+    except Exception as e:
+        logging.error(f"Error rendering preview of {source_path}: {str(e)}")
+        return False
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+def get_content_source(file):
+    """Describe where a file's content is stored, for a worker process to fetch it itself"""
+    from blobstore import get_content_encoding
+    settings = {
+        key: value for key, value in current_app.config.items()
+        if key in ('STORAGE_BACKEND', 'UPLOAD_FOLDER') or key.startswith('S3_')
+    }
+    return settings, file.filename, get_content_encoding(file), os.path.splitext(file.original_filename)[1]
+
+def fetch_source(settings, name, encoding, suffix):
+    """Get (path, is_temporary) for a local file holding stored content, uncompressed. Runs in a worker process."""
+    global _worker_storage
+    if _worker_storage is None or _worker_storage[0] != settings:
+        _worker_storage = (settings, create_storage(settings))
+    storage = _worker_storage[1]
+    if encoding is None:
+        return storage.get_local_copy(name)
+    
+    from compression import iter_decompressed
+    fd, path = tempfile.mkstemp(prefix='.decoded-', suffix=suffix)
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            for chunk in iter_decompressed(storage.iter_range(name), encoding):
+                out.write(chunk)
+    except Exception:
+        os.remove(path)
+        raise
+    return path, True
+
+def fetch_and_render(source, kind, targets):
+    """Fetch content once and render several sizes from it. Runs in a worker process.
+    
+    The worker owns the copy it fetches and removes it when done, so a
+    request that stops waiting cannot pull it away mid-render.
+    """
+    try:
+        source_path, is_temporary = fetch_source(*source)
+    except Exception as e:
+        logging.error(f"Error fetching {source[1]} for previews: {str(e)}")
+        return False
+    try:
+        return all([render_preview(source_path, kind, dest_path, size) for dest_path, size in targets])
+    finally:
+        if is_temporary and os.path.exists(source_path):
+            os.remove(source_path)
+
+def get_executor():
+    """Get the process pool previews are rendered in, creating it on first use"""
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(
+            max_workers=current_app.config.get('PREVIEW_WORKERS', 2),
+            mp_context=multiprocessing.get_context('spawn')
+        )
+    return _executor
+
+def schedule_previews(file):
+    """Queue every preview size of a newly stored file; never blocks the request"""
+    kind = get_preview_kind(file)
+    if kind is None:
+        return
+    try:
+        os.makedirs(current_app.config['PREVIEW_FOLDER'], exist_ok=True)
+        targets = [
+            (get_preview_path(file, size), size) for size in current_app.config['PREVIEW_SIZES']
+        ]
+        targets = [(dest_path, size) for dest_path, size in targets if not os.path.exists(dest_path)]
+        if targets:
+            # The worker downloads or decompresses the content itself, once for all sizes,
+            # so the upload response does not wait for another full transfer
+            get_executor().submit(fetch_and_render, get_content_source(file), kind, targets)
+        evict_previews()
+    except Exception as e:
+        logging.error(f"Error scheduling previews: {str(e)}")
+
+def get_preview(file, size):
+    """Get the path of a cached preview, rendering it on a cache miss. Returns None if unavailable."""
+    global _executor
+    kind = get_preview_kind(file)
+    storage = get_storage()
+    if kind is None or storage.get_size(file.filename) is None:
+        return None
+    
+    dest_path = get_preview_path(file, size)
+    if os.path.exists(dest_path):
+        # Hits refresh the mtime, which the eviction pass treats as last use
+        os.utime(dest_path)
+        return dest_path
+    
+    os.makedirs(current_app.config['PREVIEW_FOLDER'], exist_ok=True)
+    try:
+        future = get_executor().submit(fetch_and_render, get_content_source(file), kind, [(dest_path, size)])
+        rendered = future.result(timeout=current_app.config.get('PREVIEW_TIMEOUT', 30))
+    except FutureTimeoutError:
+        # A render that has not started is dropped; one under way finishes into the cache
+        future.cancel()
+        logging.warning(f"Preview of file {file.id} timed out")
+        return None
+    except BrokenProcessPool as e:
+        # A worker crashed; the next preview starts a fresh pool
+        _executor = None
+        logging.error(f"Error rendering preview of file {file.id}: {str(e)}")
+        return None
+    if not rendered:
+        return None
+    evict_previews()
+    return dest_path
+
+def evict_previews(force=False):
+    """Trim the preview cache to its size limit, least recently used first.
+    
+    Scans the cache at most once a minute unless forced.
+    """
+    global _last_eviction
+    if not force and time.monotonic() - _last_eviction < 60:
+        return 0
+    _last_eviction = time.monotonic()
+    
+    folder = current_app.config['PREVIEW_FOLDER']
+    limit = current_app.config['PREVIEW_CACHE_MAX_BYTES']
+    entries = []
+    total = 0
+    with os.scandir(folder) as it:
+        for entry in it:
+            if entry.is_file() and entry.name.endswith('.jpg'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+    if total <= limit:
+        return 0
+    
+    # Evict down to 90% so the next few previews do not trigger another pass
+    removed = 0
+    for _, size, path in sorted(entries):
+        if total <= limit * 0.9:
+            break
+        try:
+            os.remove(path)
+            total -= size
+            removed += 1
+        except OSError:
+            pass
+    return removed
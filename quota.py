@@ -0,0 +1,175 @@
+import logging
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import select, update, delete, insert
+
+from app import db
+from models import User, QuotaReservation
+
+class QuotaExceededError(Exception):
+    """Raised when storing something would take a user past their storage limit"""
+
+def get_charge_statement(user_id, size):
+    """Build the UPDATE that adds `size` bytes to a user's usage only if it stays within the limit"""
+    return (
+        update(User)
+        .where(User.id == user_id, User.storage_used + size <= User.storage_limit)
+        .values(storage_used=User.storage_used + size)
+        .execution_options(synchronize_session=False)
+    )
+
+def get_expiry(ttl=None):
+    """Get when a reservation made now stops being honoured"""
+    return datetime.utcnow() + timedelta(seconds=ttl or current_app.config.get('QUOTA_RESERVATION_TTL', 3600))
+
+def charge_quota(user_id, size):
+    """Charge bytes to a user in the current transaction. Returns False if they do not fit."""
+    if size <= 0:
+        credit_quota(user_id, -size)
+        return True
+    return db.session.execute(get_charge_statement(user_id, size)).rowcount == 1
+
+def credit_quota(user_id, size):
+    """Give bytes back to a user in the current transaction"""
+    if size:
+        db.session.execute(
+            update(User).where(User.id == user_id).values(storage_used=User.storage_used - size)
+            .execution_options(synchronize_session=False)
+        )
+
+def reserve_quota(user_id, size, ttl=None):
+    """Charge bytes for an upload that has not finished yet and return the reservation id, or None.
+    
+    The reservation is committed on its own connection straight away, so other
+    workers see it at once and no lock is held while the upload streams in.
+    """
+    with db.engine.connect() as conn:
+        if conn.execute(get_charge_statement(user_id, size)).rowcount != 1:
+            conn.rollback()
+            return None
+        reservation_id = conn.execute(
+            insert(QuotaReservation).values(
+                user_id=user_id, size=size, date_created=datetime.utcnow(), expires_at=get_expiry(ttl)
+            )
+        ).inserted_primary_key[0]
+        conn.commit()
+        return reservation_id
+
+def extend_reservation(reservation_id, user_id, size, ttl=None):
+    """Grow a reservation by `size` bytes. Returns False if they do not fit or it has expired."""
+    with db.engine.connect() as conn:
+        if conn.execute(get_charge_statement(user_id, size)).rowcount != 1:
+            conn.rollback()
+            return False
+        extended = conn.execute(
+            update(QuotaReservation).where(QuotaReservation.id == reservation_id)
+            .values(size=QuotaReservation.size + size, expires_at=get_expiry(ttl))
+        ).rowcount
+        if not extended:
+            conn.rollback()
+            return False
+        conn.commit()
+        return True
+
+def refresh_reservation(reservation_id, ttl=None):
+    """Push back the expiry of a reservation in the current transaction"""
+    db.session.execute(
+        update(QuotaReservation).where(QuotaReservation.id == reservation_id).values(expires_at=get_expiry(ttl))
+    )
+
+def settle_reservation(reservation_id, user_id, size):
+    """Turn a reservation into the final charge for `size` bytes, in the current transaction.
+    
+    The difference from the reserved amount is charged or refunded. Returns
+    False if the final size does not fit.
+    """
+    reserved = db.session.execute(
+        select(QuotaReservation.size).where(QuotaReservation.id == reservation_id)
+    ).scalar()
+    deleted = reserved is not None and db.session.execute(
+        delete(QuotaReservation).where(QuotaReservation.id == reservation_id)
+    ).rowcount
+    if not deleted:
+        # Expired and released by the purge worker: charge the whole size again
+        return charge_quota(user_id, size)
+    return charge_quota(user_id, size - reserved)
+
+def release_reservation(reservation_id, expired_before=None):
+    """Give back a reservation whose upload failed or was abandoned. Safe to call more than once.
+    
+    With `expired_before`, the reservation is only released if it expired before then.
+    """
+    conditions = [QuotaReservation.id == reservation_id]
+    if expired_before is not None:
+        conditions.append(QuotaReservation.expires_at < expired_before)
+    try:
+        with db.engine.connect() as conn:
+            row = conn.execute(
+                select(QuotaReservation.user_id, QuotaReservation.size).where(*conditions)
+            ).first()
+            # Only the caller that actually deletes the row refunds it
+            if row and conn.execute(delete(QuotaReservation).where(*conditions)).rowcount:
+                conn.execute(
+                    update(User).where(User.id == row.user_id).values(storage_used=User.storage_used - row.size)
+                )
+            conn.commit()
+    except Exception as e:
+        logging.error(f"Error releasing quota reservation {reservation_id}: {str(e)}")
+
+def expire_reservations():
+    """Release reservations left behind by workers that died mid-upload"""
+    now = datetime.utcnow()
+    with db.engine.connect() as conn:
+        expired = conn.execute(
+            select(QuotaReservation.id).where(QuotaReservation.expires_at < now)
+        ).scalars().all()
+    # Re-checked on release, in case an upload refreshed its reservation meanwhile
+    for reservation_id in expired:
+        release_reservation(reservation_id, expired_before=now)
+    return len(expired)
+
+class ReservedStream:
+    """Wrap an upload stream so the quota is reserved before the bytes are read.
+    
+    The reservation grows geometrically as data arrives, so a large upload
+    takes a handful of short transactions. Raises QuotaExceededError as soon
+    as the data no longer fits.
+    """
+    
+    def __init__(self, stream, user_id):
+        self.stream = stream
+        self.user_id = user_id
+        self.reservation_id = None
+        self.reserved = 0
+        self.received = 0
+    
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.received += len(data)
+        if self.received > self.reserved:
+            self.grow(self.received - self.reserved)
+        return data
+    
+    def grow(self, needed):
+        step = current_app.config.get('QUOTA_RESERVATION_STEP', 16 * 1024 * 1024)
+        # Ask generously first, then for exactly what is missing in case the quota is nearly full
+        for amount in (max(needed, step, self.reserved), needed):
+            if self.reservation_id is None:
+                self.reservation_id = reserve_quota(self.user_id, amount)
+                reserved = self.reservation_id is not None
+            else:
+                reserved = extend_reservation(self.reservation_id, self.user_id, amount)
+            if reserved:
+                self.reserved += amount
+                return
+        raise QuotaExceededError("File exceeds your storage limit")
+    
+    def settled(self):
+        """Record that the reservation became a charge when the upload committed"""
+        self.reservation_id = None
+    
+    def release(self):
+        """Give back whatever was reserved, unless it has been settled"""
+        if self.reservation_id is not None:
+            release_reservation(self.reservation_id)
+            self.reservation_id = None
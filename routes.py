@@ -1,20 +1,47 @@
-from flask import render_template, flash, redirect, url_for, request, send_file, jsonify, abort
+from flask import (
+    render_template, flash, redirect, url_for, request, jsonify, abort, send_file, Response,
+    stream_with_context
+)
 from flask_login import login_user, logout_user, current_user, login_required
 from werkzeug.security import generate_password_hash, check_password_hash
 from urllib.parse import urlparse
 from werkzeug.utils import secure_filename
-import os
-import logging
+import hmac
 
 from app import app, db
 from models import User, File, Folder, StorageClass
 from forms import (
     LoginForm, RegistrationForm, ProfilePictureForm, FolderForm, StorageClassForm,
-    PasswordResetRequestForm, PasswordResetForm, AdminUserApprovalForm, AdminUserStorageForm,
-    FileUploadForm
+    PasswordResetRequestForm, PasswordResetForm, FileUploadForm, RenameForm
 )
 from utils import (
-    save_file, delete_file, create_folder, delete_folder, get_human_readable_size, is_admin
+    save_file, create_folder, get_human_readable_size, get_upload_limit, delete_storage_class, rename_file,
+    rename_folder, paginate_files, touch_all_listings
+)
+from downloads import send_stored_file, get_content_disposition
+from storage import get_storage
+from archives import iter_zip, iter_folder_entries, iter_file_entries
+from search import search_items
+from stats import get_type_usage
+from previews import get_preview
+from uploads import (
+    get_upload_session, get_received_chunks, create_upload_session, write_chunk, finalize_upload, cancel_upload
+)
+from fsck import start_online_fsck, get_online_fsck_status
+from compression import get_compression_report
+from auth import invalidate_user
+from throttle import limit_transfer, get_controller
+from admin import (
+    get_users_page, get_fleet_stats, invalidate_fleet_stats, approve_users, reject_users, set_storage_limits,
+    delete_user
+)
+from metrics import registry, record_transfer
+from listings import versioned_response
+from changes import (
+    CursorExpiredError, encode_change_cursor, decode_change_cursor, get_latest_change_seq, get_changes, wait_for_changes
+)
+from trash import (
+    trash_file, trash_folder, restore_file, restore_folder, empty_trash, get_trash_contents
 )
 
 # Index route
@@ -87,12 +114,13 @@ def dashboard():
     storage_limit = current_user.storage_limit
     storage_percent = (storage_used / storage_limit) * 100 if storage_limit > 0 else 0
     
-    # Get file statistics
-    total_files = File.query.filter_by(user_id=current_user.id).count()
-    total_folders = Folder.query.filter_by(user_id=current_user.id).count()
+    # Get file statistics from the maintained counters
+    total_files = current_user.file_count
+    total_folders = current_user.folder_count
+    type_usage = get_type_usage(current_user.id)
     
     # Get recent files
-    recent_files = File.query.filter_by(user_id=current_user.id).order_by(File.date_uploaded.desc()).limit(5).all()
+    recent_files = File.query.filter_by(user_id=current_user.id, deleted_at=None).order_by(File.date_uploaded.desc()).limit(5).all()
     
     return render_template(
         'dashboard.html', 
@@ -102,9 +130,31 @@ def dashboard():
         storage_percent=storage_percent,
         total_files=total_files,
         total_folders=total_folders,
-        recent_files=recent_files
+        type_usage=type_usage,
+        recent_files=recent_files,
+        get_human_readable_size=get_human_readable_size
     )
 
+# Storage usage breakdown by file type
+@app.route('/api/usage')
+@login_required
+def api_usage():
+    return jsonify({
+        'storage_used': current_user.storage_used,
+        'storage_limit': current_user.storage_limit,
+        'total_files': current_user.file_count,
+        'total_folders': current_user.folder_count,
+        'types': [
+            {
+                'type': usage.file_type,
+                'files': usage.file_count,
+                'size': usage.size,
+                'size_display': get_human_readable_size(usage.size)
+            }
+            for usage in get_type_usage(current_user.id)
+        ]
+    })
+
 # Profile route
 @app.route('/profile', methods=['GET', 'POST'])
 @login_required
@@ -119,10 +169,10 @@ def profile():
                 name, ext = filename.rsplit('.', 1)
                 if ext.lower() in ['jpg', 'jpeg', 'png', 'gif']:
                     unique_filename = f"profile_{current_user.id}.{ext}"
-                    filepath = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
-                    file.save(filepath)
+                    get_storage().put_fileobj(file.stream, unique_filename)
                     current_user.profile_picture = unique_filename
                     db.session.commit()
+                    invalidate_user(current_user.id)
                     flash('Profile picture updated successfully!', 'success')
                 else:
                     flash('Invalid file format. Please upload an image.', 'danger')
@@ -137,49 +187,65 @@ def profile():
 def file_manager():
     folder_id = request.args.get('folder_id', None, type=int)
     storage_class_id = request.args.get('storage_class_id', None, type=int)
+    cursor = request.args.get('cursor', None)
     
-    # Get current folder
+    # Get current folder and the path leading to it
     current_folder = None
+    breadcrumbs = []
     if folder_id:
-        current_folder = Folder.query.filter_by(id=folder_id, user_id=current_user.id).first_or_404()
+        current_folder = Folder.query.filter_by(id=folder_id, user_id=current_user.id, deleted_at=None).first_or_404()
+        breadcrumbs = current_folder.get_breadcrumbs()
     
     # Get storage class
     storage_class = None
     if storage_class_id:
         storage_class = StorageClass.query.filter_by(id=storage_class_id, user_id=current_user.id).first_or_404()
     
-    # Get folders and files
-    if current_folder:
-        folders = Folder.query.filter_by(parent_id=current_folder.id, user_id=current_user.id).all()
-        files = File.query.filter_by(folder_id=current_folder.id, user_id=current_user.id).all()
-    elif storage_class:
-        folders = Folder.query.filter_by(storage_class_id=storage_class.id, parent_id=None, user_id=current_user.id).all()
-        files = File.query.filter_by(file_type=storage_class.file_type, folder_id=None, user_id=current_user.id).all()
-    else:
-        folders = Folder.query.filter_by(parent_id=None, storage_class_id=None, user_id=current_user.id).all()
-        files = File.query.filter_by(folder_id=None, user_id=current_user.id).all()
-    
-    # Get storage classes
-    storage_classes = StorageClass.query.filter_by(user_id=current_user.id).all()
-    
-    # Forms
-    folder_form = FolderForm()
-    storage_class_form = StorageClassForm()
-    upload_form = FileUploadForm()
+    def render_listing():
+        # Get folders and files
+        if current_folder:
+            folders = Folder.query.filter_by(parent_id=current_folder.id, user_id=current_user.id, deleted_at=None).all()
+            file_query = File.query.filter_by(folder_id=current_folder.id, user_id=current_user.id, deleted_at=None)
+        elif storage_class:
+            folders = Folder.query.filter_by(storage_class_id=storage_class.id, parent_id=None, user_id=current_user.id, deleted_at=None).all()
+            file_query = File.query.filter_by(file_type=storage_class.file_type, folder_id=None, user_id=current_user.id, deleted_at=None)
+        else:
+            folders = Folder.query.filter_by(parent_id=None, storage_class_id=None, user_id=current_user.id, deleted_at=None).all()
+            file_query = File.query.filter_by(folder_id=None, user_id=current_user.id, deleted_at=None)
+        
+        # Only one page of files is loaded; the template links to the next one
+        try:
+            files, next_cursor = paginate_files(file_query, 'name', 'asc', cursor, app.config['FILES_PAGE_SIZE'])
+        except ValueError:
+            abort(400)
+        
+        # Get storage classes
+        storage_classes = StorageClass.query.filter_by(user_id=current_user.id).all()
+        
+        # Forms
+        folder_form = FolderForm()
+        storage_class_form = StorageClassForm()
+        upload_form = FileUploadForm()
+        
+        return render_template(
+            'file_manager.html',
+            title='File Manager',
+            current_folder=current_folder,
+            breadcrumbs=breadcrumbs,
+            storage_class=storage_class,
+            folders=folders,
+            files=files,
+            next_cursor=next_cursor,
+            storage_classes=storage_classes,
+            folder_form=folder_form,
+            storage_class_form=storage_class_form,
+            upload_form=upload_form,
+            get_human_readable_size=get_human_readable_size
+        )
     
-    return render_template(
-        'file_manager.html',
-        title='File Manager',
-        current_folder=current_folder,
-        storage_class=storage_class,
-        folders=folders,
-        files=files,
-        storage_classes=storage_classes,
-        folder_form=folder_form,
-        storage_class_form=storage_class_form,
-        upload_form=upload_form,
-        get_human_readable_size=get_human_readable_size
-    )
+    # Unchanged listings are answered from their version, without listing anything
+    version = current_folder.version if current_folder else current_user.root_version
+    return versioned_response(version, render_listing, per_session=True)
 
 # Create folder route
 @app.route('/folders/create', methods=['POST'])
@@ -198,13 +264,27 @@ def create_folder_route():
     
     return redirect(request.referrer or url_for('file_manager'))
 
+# Rename folder route
+@app.route('/folders/rename/<int:folder_id>', methods=['POST'])
+@login_required
+def rename_folder_route(folder_id):
+    form = RenameForm()
+    if form.validate_on_submit():
+        folder, error = rename_folder(folder_id, current_user.id, form.name.data)
+        if folder:
+            flash(f'Folder renamed to "{form.name.data}".', 'success')
+        else:
+            flash(f'Error renaming folder: {error}', 'danger')
+    
+    return redirect(request.referrer or url_for('file_manager'))
+
 # Delete folder route
 @app.route('/folders/delete/<int:folder_id>', methods=['POST'])
 @login_required
 def delete_folder_route(folder_id):
-    success, error = delete_folder(folder_id, current_user.id)
+    success, error = trash_folder(folder_id, current_user.id)
     if success:
-        flash('Folder deleted successfully!', 'success')
+        flash('Folder moved to the trash.', 'success')
     else:
         flash(f'Error deleting folder: {error}', 'danger')
     
@@ -222,32 +302,34 @@ def create_storage_class():
             user_id=current_user.id
         )
         db.session.add(storage_class)
+        touch_all_listings(current_user.id)
         db.session.commit()
         flash(f'Storage class "{form.name.data}" created successfully!', 'success')
     
     return redirect(url_for('file_manager'))
 
 # Delete storage class route
-@app.route('/storage-classes/delete/<int:storage_class_id>', methods=['POST'])
+@app.route('/storage-classes/delete/<int:storage_class_id>', methods=['POST'], endpoint='delete_storage_class')
 @login_required
-def delete_storage_class(storage_class_id):
-    storage_class = StorageClass.query.filter_by(id=storage_class_id, user_id=current_user.id).first_or_404()
-    
-    # Delete all folders in this storage class
-    folders = Folder.query.filter_by(storage_class_id=storage_class_id, user_id=current_user.id).all()
-    for folder in folders:
-        delete_folder(folder.id, current_user.id)
-    
-    db.session.delete(storage_class)
-    db.session.commit()
-    flash('Storage class deleted successfully!', 'success')
+def delete_storage_class_route(storage_class_id):
+    success, error = delete_storage_class(storage_class_id, current_user.id)
+    if success:
+        flash('Storage class deleted successfully!', 'success')
+    else:
+        flash(f'Error deleting storage class: {error}', 'danger')
     
     return redirect(url_for('file_manager'))
 
 # Upload file route
 @app.route('/files/upload', methods=['POST'])
 @login_required
+@limit_transfer
 def upload_file():
+    # Cap the body at what still fits before the form is parsed: Werkzeug answers 413
+    # from the declared length, or as soon as a chunked body runs past the cap,
+    # rather than spooling the whole upload first
+    request.max_content_length = get_upload_limit(current_user)
+    
     form = FileUploadForm()
     if form.validate_on_submit():
         file = form.file.data
@@ -262,36 +344,221 @@ def upload_file():
     
     return redirect(request.referrer or url_for('file_manager'))
 
+def serialize_upload_session(session):
+    return {
+        'id': session.id,
+        'filename': session.filename,
+        'size': session.total_size,
+        'chunk_size': session.chunk_size,
+        'chunk_count': session.chunk_count,
+        'received': get_received_chunks(session)
+    }
+
+# Resumable upload routes: create a session, PUT its chunks in any order, then complete it
+@app.route('/api/uploads', methods=['POST'])
+@login_required
+def api_create_upload():
+    data = request.get_json(silent=True) or {}
+    try:
+        total_size = int(data.get('size'))
+        folder_id = int(data['folder_id']) if data.get('folder_id') else None
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Invalid size or folder'}), 400
+    
+    session, error = create_upload_session(
+        current_user.id, data.get('filename'), total_size, folder_id, data.get('mimetype')
+    )
+    if error:
+        return jsonify({'error': error}), 400
+    return jsonify(serialize_upload_session(session)), 201
+
+@app.route('/api/uploads/<session_id>', methods=['GET'])
+@login_required
+def api_upload_status(session_id):
+    session = get_upload_session(session_id, current_user.id)
+    if not session:
+        abort(404)
+    return jsonify(serialize_upload_session(session))
+
+@app.route('/api/uploads/<session_id>/chunks/<int:index>', methods=['PUT'])
+@login_required
+@limit_transfer
+def api_upload_chunk(session_id, index):
+    session = get_upload_session(session_id, current_user.id)
+    if not session:
+        abort(404)
+    
+    success, error = write_chunk(session, index, request.stream, request.content_length)
+    if not success:
+        return jsonify({'error': error}), 400
+    return '', 204
+
+@app.route('/api/uploads/<session_id>/complete', methods=['POST'])
+@login_required
+def api_complete_upload(session_id):
+    session = get_upload_session(session_id, current_user.id)
+    if not session:
+        abort(404)
+    
+    file, error = finalize_upload(session)
+    if error:
+        return jsonify({'error': error}), 400
+    return jsonify({
+        'id': file.id,
+        'name': file.original_filename,
+        'size': file.size,
+        'download_url': url_for('download_file', file_id=file.id)
+    }), 201
+
+@app.route('/api/uploads/<session_id>', methods=['DELETE'])
+@login_required
+def api_cancel_upload(session_id):
+    session = get_upload_session(session_id, current_user.id)
+    if not session:
+        abort(404)
+    
+    success, error = cancel_upload(session)
+    if not success:
+        return jsonify({'error': error}), 400
+    return '', 204
+
 # Download file route
 @app.route('/files/download/<int:file_id>')
 @login_required
+@limit_transfer
 def download_file(file_id):
-    file = File.query.filter_by(id=file_id, user_id=current_user.id).first_or_404()
-    filepath = os.path.join(app.config['UPLOAD_FOLDER'], file.filename)
-    
-    if os.path.exists(filepath):
-        return send_file(
-            filepath,
-            as_attachment=True,
-            download_name=file.original_filename,
-            mimetype=file.mimetype
-        )
+    file = File.query.filter_by(id=file_id, user_id=current_user.id, deleted_at=None).first_or_404()
+    
+    # ?inline=1 serves the file for in-browser viewing (e.g. seekable media) instead of as an attachment
+    inline = request.args.get('inline', 0, type=int)
+    response = send_stored_file(file, as_attachment=not inline)
+    if response is not None:
+        if response.status_code in (200, 206):
+            record_transfer('out', response.content_length)
+        return response
     
     flash('File not found!', 'danger')
     return redirect(request.referrer or url_for('file_manager'))
 
+# Archive download route
+@app.route('/files/archive')
+@login_required
+@limit_transfer
+def download_archive():
+    # Either ?folder_id=<id> for a whole subtree or ?file_id=<id>&file_id=<id> for a selection
+    folder_id = request.args.get('folder_id', type=int)
+    file_ids = request.args.getlist('file_id', type=int)
+    if folder_id:
+        folder = Folder.query.filter_by(id=folder_id, user_id=current_user.id, deleted_at=None).first_or_404()
+        entries = iter_folder_entries(folder, current_user.id)
+        archive_name = f"{folder.name}.zip"
+    elif file_ids:
+        entries = iter_file_entries(file_ids, current_user.id)
+        archive_name = 'files.zip'
+    else:
+        abort(400)
+    
+    # The archive is produced while it is sent, so there is no Content-Length
+    response = Response(stream_with_context(iter_zip(entries)), mimetype='application/zip')
+    response.headers['Content-Disposition'] = get_content_disposition(archive_name)
+    response.cache_control.private = True
+    response.cache_control.no_store = True
+    return response
+
+# File preview route
+@app.route('/files/preview/<int:file_id>/<int:size>')
+@login_required
+def preview_file(file_id, size):
+    if size not in app.config['PREVIEW_SIZES']:
+        abort(404)
+    file = File.query.filter_by(id=file_id, user_id=current_user.id, deleted_at=None).first_or_404()
+    
+    preview_path = get_preview(file, size)
+    if not preview_path:
+        abort(404)
+    
+    # Previews are keyed by content, so browsers can keep them indefinitely
+    response = send_file(preview_path, mimetype='image/jpeg', max_age=31536000, conditional=True)
+    response.cache_control.private = True
+    response.cache_control.public = False
+    response.cache_control.immutable = True
+    return response
+
+# Rename file route
+@app.route('/files/rename/<int:file_id>', methods=['POST'])
+@login_required
+def rename_file_route(file_id):
+    form = RenameForm()
+    if form.validate_on_submit():
+        file, error = rename_file(file_id, current_user.id, form.name.data)
+        if file:
+            flash(f'File renamed to "{form.name.data}".', 'success')
+        else:
+            flash(f'Error renaming file: {error}', 'danger')
+    
+    return redirect(request.referrer or url_for('file_manager'))
+
 # Delete file route
 @app.route('/files/delete/<int:file_id>', methods=['POST'])
 @login_required
 def delete_file_route(file_id):
-    success, error = delete_file(file_id, current_user.id)
+    success, error = trash_file(file_id, current_user.id)
     if success:
-        flash('File deleted successfully!', 'success')
+        flash('File moved to the trash.', 'success')
     else:
         flash(f'Error deleting file: {error}', 'danger')
     
     return redirect(request.referrer or url_for('file_manager'))
 
+# Trash route
+@app.route('/trash')
+@login_required
+def trash():
+    folders, files = get_trash_contents(current_user.id)
+    return render_template(
+        'trash.html',
+        title='Trash',
+        folders=folders,
+        files=files,
+        get_human_readable_size=get_human_readable_size
+    )
+
+# Restore file route
+@app.route('/trash/restore/file/<int:file_id>', methods=['POST'])
+@login_required
+def restore_file_route(file_id):
+    success, error = restore_file(file_id, current_user.id)
+    if success:
+        flash('File restored successfully!', 'success')
+    else:
+        flash(f'Error restoring file: {error}', 'danger')
+    
+    return redirect(request.referrer or url_for('trash'))
+
+# Restore folder route
+@app.route('/trash/restore/folder/<int:folder_id>', methods=['POST'])
+@login_required
+def restore_folder_route(folder_id):
+    success, error = restore_folder(folder_id, current_user.id)
+    if success:
+        flash('Folder restored successfully!', 'success')
+    else:
+        flash(f'Error restoring folder: {error}', 'danger')
+    
+    return redirect(request.referrer or url_for('trash'))
+
+# Empty trash route
+@app.route('/trash/empty', methods=['POST'])
+@login_required
+def empty_trash_route():
+    success, error = empty_trash(current_user.id)
+    if success:
+        flash('Trash emptied.', 'success')
+    else:
+        flash(f'Error emptying trash: {error}', 'danger')
+    
+    return redirect(url_for('trash'))
+
 # Search files route
 @app.route('/search')
 @login_required
@@ -299,17 +566,10 @@ def search_files():
     query = request.args.get('query', '')
     if not query:
         return redirect(url_for('file_manager'))
+    page = request.args.get('page', 1, type=int)
     
-    # Search for files and folders
-    files = File.query.filter(
-        File.user_id == current_user.id,
-        File.original_filename.ilike(f'%{query}%')
-    ).all()
-    
-    folders = Folder.query.filter(
-        Folder.user_id == current_user.id,
-        Folder.name.ilike(f'%{query}%')
-    ).all()
+    # Search for files and folders, best matches first
+    folders, files, has_next = search_items(current_user.id, query, page=page)
     
     return render_template(
         'file_manager.html',
@@ -317,6 +577,8 @@ def search_files():
         files=files,
         folders=folders,
         search_query=query,
+        page=page,
+        has_next=has_next,
         get_human_readable_size=get_human_readable_size,
         folder_form=FolderForm(),
         upload_form=FileUploadForm()
@@ -330,17 +592,33 @@ def admin_dashboard():
         flash('You do not have permission to access this page.', 'danger')
         return redirect(url_for('dashboard'))
     
-    # Get pending users
-    pending_users = User.query.filter_by(is_approved=False).all()
+    # Sorting, filtering and paging all happen in the database
+    sort_by = request.args.get('sort', 'usage')
+    order = request.args.get('order', 'asc' if sort_by == 'name' else 'desc')
+    query = request.args.get('q', '').strip()
+    per_page = app.config['ADMIN_USERS_PAGE_SIZE']
     
-    # Get all users
-    all_users = User.query.filter(User.id != current_user.id).all()
+    # Get pending users, oldest registration first
+    pending_page = get_users_page(
+        request.args.get('pending_page', 1, type=int), per_page, 'registered', 'asc', query, pending=True
+    )
+    
+    # Get all other users
+    users_page = get_users_page(
+        request.args.get('page', 1, type=int), per_page, sort_by, order, query, exclude_id=current_user.id
+    )
     
     return render_template(
         'admin.html',
         title='Admin Dashboard',
-        pending_users=pending_users,
-        all_users=all_users,
+        pending_users=pending_page.items,
+        pending_pagination=pending_page,
+        all_users=users_page.items,
+        users_pagination=users_page,
+        sort_by=sort_by,
+        order=order,
+        query=query,
+        fleet=get_fleet_stats(),
         get_human_readable_size=get_human_readable_size
     )
 
@@ -355,6 +633,8 @@ def approve_user(user_id):
     user = User.query.get_or_404(user_id)
     user.is_approved = True
     db.session.commit()
+    invalidate_user(user_id)
+    invalidate_fleet_stats()
     
     flash(f'User {user.username} has been approved!', 'success')
     return redirect(url_for('admin_dashboard'))
@@ -368,10 +648,13 @@ def reject_user(user_id):
         return redirect(url_for('dashboard'))
     
     user = User.query.get_or_404(user_id)
-    db.session.delete(user)
-    db.session.commit()
+    username = user.username
+    success, error = delete_user(user_id)
+    if not success:
+        flash(f'Error rejecting user: {error}', 'danger')
+        return redirect(url_for('admin_dashboard'))
     
-    flash(f'User {user.username} has been rejected!', 'success')
+    flash(f'User {username} has been rejected!', 'success')
     return redirect(url_for('admin_dashboard'))
 
 # Admin update user storage route
@@ -390,10 +673,136 @@ def update_user_storage(user_id):
     user = User.query.get_or_404(user_id)
     user.storage_limit = int(storage_limit * 1024 * 1024 * 1024)  # Convert GB to bytes
     db.session.commit()
+    invalidate_user(user_id)
+    invalidate_fleet_stats()
     
     flash(f'Storage limit for {user.username} updated successfully!', 'success')
     return redirect(url_for('admin_dashboard'))
 
+# Admin bulk user actions route; each action is a single statement over the selection
+@app.route('/admin/users/bulk', methods=['POST'])
+@login_required
+def admin_bulk_users():
+    if not current_user.is_admin:
+        flash('You do not have permission to perform this action.', 'danger')
+        return redirect(url_for('dashboard'))
+    
+    action = request.form.get('action')
+    user_ids = request.form.getlist('user_ids', type=int)
+    if not user_ids:
+        flash('No users selected!', 'danger')
+        return redirect(request.referrer or url_for('admin_dashboard'))
+    
+    if action == 'approve':
+        count, error = approve_users(user_ids)
+        message = f'{count} users approved!'
+    elif action == 'reject':
+        count, error = reject_users(user_ids, current_user.id)
+        message = f'{count} users rejected!'
+        if count is not None and count < len(user_ids):
+            message += ' Approved users and users who already store files were skipped.'
+    elif action == 'storage':
+        storage_limit = request.form.get('storage_limit', type=float)
+        if not storage_limit or storage_limit <= 0:
+            flash('Invalid storage limit!', 'danger')
+            return redirect(request.referrer or url_for('admin_dashboard'))
+        count, error = set_storage_limits(user_ids, int(storage_limit * 1024 * 1024 * 1024))  # Convert GB to bytes
+        message = f'Storage limit updated for {count} users!'
+    else:
+        flash('Unknown action!', 'danger')
+        return redirect(request.referrer or url_for('admin_dashboard'))
+    
+    if error:
+        flash(f'Error updating users: {error}', 'danger')
+    else:
+        flash(message, 'success')
+    return redirect(request.referrer or url_for('admin_dashboard'))
+
+# Admin fleet statistics route
+@app.route('/admin/stats')
+@login_required
+def admin_stats():
+    if not current_user.is_admin:
+        abort(403)
+    
+    return jsonify(get_fleet_stats())
+
+# Admin update user transfer limits route
+@app.route('/admin/update-limits/<int:user_id>', methods=['POST'])
+@login_required
+def update_user_limits(user_id):
+    if not current_user.is_admin:
+        flash('You do not have permission to perform this action.', 'danger')
+        return redirect(url_for('dashboard'))
+    
+    # Blank fields fall back to the app-wide defaults
+    try:
+        bandwidth_limit = request.form.get('bandwidth_limit', '').strip()
+        bandwidth_limit = int(float(bandwidth_limit) * 1024 * 1024) if bandwidth_limit else None  # Convert MB/s to bytes/s
+        max_transfers = request.form.get('max_transfers', '').strip()
+        max_transfers = int(max_transfers) if max_transfers else None
+    except ValueError:
+        flash('Invalid transfer limits!', 'danger')
+        return redirect(url_for('admin_dashboard'))
+    if (bandwidth_limit is not None and bandwidth_limit < 0) or (max_transfers is not None and max_transfers < 0):
+        flash('Invalid transfer limits!', 'danger')
+        return redirect(url_for('admin_dashboard'))
+    
+    user = User.query.get_or_404(user_id)
+    user.bandwidth_limit = bandwidth_limit
+    user.max_transfers = max_transfers
+    db.session.commit()
+    invalidate_user(user_id)
+    
+    flash(f'Transfer limits for {user.username} updated successfully!', 'success')
+    return redirect(url_for('admin_dashboard'))
+
+# Admin transfer status route
+@app.route('/admin/transfers')
+@login_required
+def admin_transfers():
+    if not current_user.is_admin:
+        abort(403)
+    
+    return jsonify(get_controller().get_status())
+
+# Metrics route, in the Prometheus text format
+@app.route('/metrics')
+def metrics():
+    # Scrapers authenticate with METRICS_TOKEN; without one, only admins may look
+    token = app.config.get('METRICS_TOKEN')
+    if token:
+        if not hmac.compare_digest(request.headers.get('Authorization', ''), f"Bearer {token}"):
+            abort(401)
+    elif not (current_user.is_authenticated and current_user.is_admin):
+        abort(403)
+    
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4')
+
+# Admin consistency check route
+@app.route('/admin/fsck', methods=['GET', 'POST'])
+@login_required
+def admin_fsck():
+    if not current_user.is_admin:
+        abort(403)
+    
+    # POST starts a check in the background; GET reports on the last one
+    if request.method == 'POST':
+        repair = request.form.get('repair', 0, type=int) or request.args.get('repair', 0, type=int)
+        if not start_online_fsck(app, repair=bool(repair)):
+            return jsonify({'error': 'A check is already running'}), 409
+        return jsonify(get_online_fsck_status()), 202
+    return jsonify(get_online_fsck_status())
+
+# Admin compression report route
+@app.route('/admin/compression')
+@login_required
+def admin_compression():
+    if not current_user.is_admin:
+        abort(403)
+    
+    return jsonify(get_compression_report())
+
 # Password reset request route
 @app.route('/reset-password', methods=['GET', 'POST'])
 def reset_password_request():
@@ -434,6 +843,7 @@ def reset_password(user_id):
         
         user.password_hash = generate_password_hash(form.password.data)
         db.session.commit()
+        invalidate_user(user_id)
         
         flash('Your password has been reset successfully!', 'success')
         return redirect(url_for('login'))
@@ -467,34 +877,89 @@ def api_sort_files():
     folder_id = request.args.get('folder_id', None, type=int)
     sort_by = request.args.get('sort_by', 'date_uploaded')
     order = request.args.get('order', 'desc')
-    
-    # Build query
-    query = File.query.filter_by(user_id=current_user.id)
-    if folder_id is not None:
-        query = query.filter_by(folder_id=folder_id)
-    
-    # Apply sorting
-    if sort_by == 'name':
-        query = query.order_by(File.original_filename.asc() if order == 'asc' else File.original_filename.desc())
-    elif sort_by == 'date':
-        query = query.order_by(File.date_uploaded.asc() if order == 'asc' else File.date_uploaded.desc())
-    elif sort_by == 'size':
-        query = query.order_by(File.size.asc() if order == 'asc' else File.size.desc())
-    elif sort_by == 'type':
-        query = query.order_by(File.file_type.asc() if order == 'asc' else File.file_type.desc())
-    
-    files = query.all()
-    
-    # Prepare data for response
-    result = []
-    for file in files:
-        result.append({
-            'id': file.id,
-            'name': file.original_filename,
-            'type': file.file_type,
-            'size': get_human_readable_size(file.size),
-            'date': file.date_uploaded.strftime('%Y-%m-%d %H:%M:%S'),
-            'download_url': url_for('download_file', file_id=file.id)
-        })
-    
-    return jsonify(result)
+    cursor = request.args.get('cursor', None)
+    limit = min(max(request.args.get('limit', app.config['FILES_PAGE_SIZE'], type=int), 1),
+                app.config['API_MAX_PAGE_SIZE'])
+    
+    def list_files():
+        # Build query
+        query = File.query.filter_by(user_id=current_user.id, deleted_at=None)
+        if folder_id is not None:
+            query = query.filter_by(folder_id=folder_id)
+        
+        # Apply sorting and fetch one page after the cursor
+        try:
+            files, next_cursor = paginate_files(query, sort_by, order, cursor, limit)
+        except ValueError:
+            return jsonify({'error': 'Invalid cursor'}), 400
+        
+        # Prepare data for response
+        result = []
+        for file in files:
+            result.append({
+                'id': file.id,
+                'name': file.original_filename,
+                'type': file.file_type,
+                'size': get_human_readable_size(file.size),
+                'date': file.date_uploaded.strftime('%Y-%m-%d %H:%M:%S'),
+                'download_url': url_for('download_file', file_id=file.id)
+            })
+        
+        # The body stays a plain list; the next page is advertised in headers
+        response = jsonify(result)
+        if next_cursor:
+            response.headers['X-Next-Cursor'] = next_cursor
+            next_url = url_for('api_sort_files', folder_id=folder_id, sort_by=sort_by, order=order,
+                               limit=limit, cursor=next_cursor)
+            response.headers['Link'] = f'<{next_url}>; rel="next"'
+        return response
+    
+    # Without a folder every file is listed, which the root version covers
+    if folder_id is None:
+        return versioned_response(current_user.root_version, list_files)
+    version = db.session.query(Folder.version).filter_by(
+        id=folder_id, user_id=current_user.id, deleted_at=None
+    ).scalar()
+    if version is None:
+        return list_files()
+    return versioned_response(version, list_files)
+
+# Change feed route; deleting or restoring a folder is one change covering everything below it
+@app.route('/api/changes')
+@login_required
+def api_changes():
+    cursor = request.args.get('cursor', None)
+    limit = min(max(request.args.get('limit', app.config['CHANGES_PAGE_SIZE'], type=int), 1),
+                app.config['API_MAX_PAGE_SIZE'])
+    timeout = min(max(request.args.get('timeout', 0, type=float), 0), app.config['CHANGES_LONGPOLL_TIMEOUT'])
+    user_id = current_user.id
+    
+    # Without a cursor, only hand out one to start from; clients take it before listing everything
+    if not cursor:
+        return jsonify({'changes': [], 'cursor': encode_change_cursor(get_latest_change_seq(user_id)), 'has_more': False})
+    try:
+        after_seq = decode_change_cursor(cursor)
+    except ValueError:
+        return jsonify({'error': 'Invalid cursor'}), 400
+    
+    # Long-poll: with nothing new yet, hold the request until a change or the timeout
+    try:
+        changes, has_more = get_changes(user_id, after_seq, limit)
+        if not changes and timeout and wait_for_changes(user_id, after_seq, timeout):
+            changes, has_more = get_changes(user_id, after_seq, limit)
+    except CursorExpiredError as e:
+        return jsonify({'error': str(e)}), 410
+    
+    return jsonify({
+        'changes': [{
+            'action': change.action,
+            'type': change.item_type,
+            'id': change.item_id,
+            'parent_id': change.parent_id,
+            'name': change.name,
+            'size': change.size,
+            'date': change.date_created.strftime('%Y-%m-%d %H:%M:%S'),
+        } for change in changes],
+        'cursor': encode_change_cursor(changes[-1].seq) if changes else cursor,
+        'has_more': has_more
+    })
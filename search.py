@@ -0,0 +1,182 @@
+import logging
+from sqlalchemy import text, select, func, literal, union_all, inspect
+from app import db
+from models import File, Folder
+
+# Files and folders share one SQLite FTS5 table; their ids are interleaved
+# into its rowid space so triggers can find an entry without a scan
+FILE_ROWID = "{id} * 2"
+FOLDER_ROWID = "{id} * 2 + 1"
+
+SQLITE_INDEX_DDL = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5(
+        name, kind UNINDEXED, item_id UNINDEXED, user_id UNINDEXED, tokenize='trigram'
+    )""",
+    f"""CREATE TRIGGER IF NOT EXISTS file_search_insert AFTER INSERT ON file
+    WHEN new.deleted_at IS NULL BEGIN
+        INSERT INTO search_index(rowid, name, kind, item_id, user_id)
+        VALUES ({FILE_ROWID.format(id='new.id')}, new.original_filename, 'file', new.id, new.user_id);
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS file_search_update AFTER UPDATE OF original_filename, deleted_at ON file BEGIN
+        DELETE FROM search_index WHERE rowid = {FILE_ROWID.format(id='old.id')};
+        INSERT INTO search_index(rowid, name, kind, item_id, user_id)
+        SELECT {FILE_ROWID.format(id='new.id')}, new.original_filename, 'file', new.id, new.user_id
+        WHERE new.deleted_at IS NULL;
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS file_search_delete AFTER DELETE ON file BEGIN
+        DELETE FROM search_index WHERE rowid = {FILE_ROWID.format(id='old.id')};
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS folder_search_insert AFTER INSERT ON folder
+    WHEN new.deleted_at IS NULL BEGIN
+        INSERT INTO search_index(rowid, name, kind, item_id, user_id)
+        VALUES ({FOLDER_ROWID.format(id='new.id')}, new.name, 'folder', new.id, new.user_id);
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS folder_search_update AFTER UPDATE OF name, deleted_at ON folder BEGIN
+        DELETE FROM search_index WHERE rowid = {FOLDER_ROWID.format(id='old.id')};
+        INSERT INTO search_index(rowid, name, kind, item_id, user_id)
+        SELECT {FOLDER_ROWID.format(id='new.id')}, new.name, 'folder', new.id, new.user_id
+        WHERE new.deleted_at IS NULL;
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS folder_search_delete AFTER DELETE ON folder BEGIN
+        DELETE FROM search_index WHERE rowid = {FOLDER_ROWID.format(id='old.id')};
+    END""",
+]
+
+SQLITE_INDEX_FILL = [
+    f"""INSERT INTO search_index(rowid, name, kind, item_id, user_id)
+    SELECT {FILE_ROWID.format(id='id')}, original_filename, 'file', id, user_id FROM file WHERE deleted_at IS NULL""",
+    f"""INSERT INTO search_index(rowid, name, kind, item_id, user_id)
+    SELECT {FOLDER_ROWID.format(id='id')}, name, 'folder', id, user_id FROM folder WHERE deleted_at IS NULL""",
+]
+
+# PostgreSQL keeps trigram GIN indexes on the tables themselves, so there is nothing to sync
+POSTGRES_INDEX_DDL = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE INDEX IF NOT EXISTS ix_file_name_trgm ON file USING gin (original_filename gin_trgm_ops) "
+    "WHERE deleted_at IS NULL",
+    "CREATE INDEX IF NOT EXISTS ix_folder_name_trgm ON folder USING gin (name gin_trgm_ops) "
+    "WHERE deleted_at IS NULL",
+]
+
+# The trigram tokenizer cannot match anything shorter than this through the index
+MIN_INDEXED_QUERY = 3
+
+_index_available = None
+
+def get_dialect():
+    """Get the name of the database dialect in use"""
+    return db.engine.dialect.name
+
+def ensure_search_index():
+    """Create the search index and the triggers that keep it in sync, if missing"""
+    global _index_available
+    statements = {'sqlite': SQLITE_INDEX_DDL, 'postgresql': POSTGRES_INDEX_DDL}.get(get_dialect(), [])
+    with db.engine.begin() as conn:
+        for statement in statements:
+            conn.execute(text(statement))
+    _index_available = None
+
+def rebuild_search_index():
+    """Drop and rebuild the search index from the file and folder tables"""
+    global _index_available
+    dialect = get_dialect()
+    with db.engine.begin() as conn:
+        if dialect == 'sqlite':
+            conn.execute(text("DROP TABLE IF EXISTS search_index"))
+            for trigger in ('file_search_insert', 'file_search_update', 'file_search_delete',
+                            'folder_search_insert', 'folder_search_update', 'folder_search_delete'):
+                conn.execute(text(f"DROP TRIGGER IF EXISTS {trigger}"))
+            for statement in SQLITE_INDEX_DDL + SQLITE_INDEX_FILL:
+                conn.execute(text(statement))
+            conn.execute(text("INSERT INTO search_index(search_index) VALUES ('optimize')"))
+        elif dialect == 'postgresql':
+            for statement in POSTGRES_INDEX_DDL:
+                conn.execute(text(statement))
+            conn.execute(text("REINDEX INDEX ix_file_name_trgm"))
+            conn.execute(text("REINDEX INDEX ix_folder_name_trgm"))
+    _index_available = None
+
+def is_search_index_available():
+    """Check once per process whether the search index has been created"""
+    global _index_available
+    if _index_available is None:
+        dialect = get_dialect()
+        if dialect == 'sqlite':
+            _index_available = inspect(db.engine).has_table('search_index')
+        elif dialect == 'postgresql':
+            _index_available = bool(db.session.execute(
+                text("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")
+            ).first())
+        else:
+            _index_available = False
+    return _index_available
+
+def get_like_pattern(query):
+    """Build a substring LIKE pattern, escaping the query's own wildcards with a backslash"""
+    return '%' + query.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+
+def search_sqlite_index(user_id, query, limit, offset):
+    """Rank matches from the FTS5 index with bm25, falling back to a substring scan for short queries"""
+    params = {'user_id': user_id, 'limit': limit, 'offset': offset}
+    if len(query) >= MIN_INDEXED_QUERY:
+        params['match'] = '"' + query.replace('"', '""') + '"'
+        sql = """SELECT kind, item_id FROM search_index
+                 WHERE search_index MATCH :match AND user_id = :user_id
+                 ORDER BY bm25(search_index), item_id LIMIT :limit OFFSET :offset"""
+    else:
+        params['pattern'] = get_like_pattern(query)
+        sql = """SELECT kind, item_id FROM search_index
+                 WHERE name LIKE :pattern ESCAPE '\\' AND user_id = :user_id
+                 ORDER BY length(name), item_id LIMIT :limit OFFSET :offset"""
+    return db.session.execute(text(sql), params).all()
+
+def search_by_similarity(user_id, query, limit, offset):
+    """Rank substring matches by trigram similarity on PostgreSQL, or by name length elsewhere"""
+    pattern = get_like_pattern(query)
+    files = select(
+        literal('file').label('kind'), File.id.label('item_id'), File.original_filename.label('name')
+    ).where(
+        File.user_id == user_id, File.deleted_at.is_(None), File.original_filename.ilike(pattern, escape='\\')
+    )
+    folders = select(
+        literal('folder').label('kind'), Folder.id.label('item_id'), Folder.name.label('name')
+    ).where(
+        Folder.user_id == user_id, Folder.deleted_at.is_(None), Folder.name.ilike(pattern, escape='\\')
+    )
+    matches = union_all(files, folders).subquery()
+    if get_dialect() == 'postgresql' and is_search_index_available():
+        rank = func.similarity(matches.c.name, query).desc()
+    else:
+        rank = func.length(matches.c.name)
+    return db.session.execute(
+        select(matches.c.kind, matches.c.item_id).order_by(rank, matches.c.item_id).limit(limit).offset(offset)
+    ).all()
+
+def search_items(user_id, query, page=1, per_page=50):
+    """Search a user's files and folders by name.
+    
+    Returns (folders, files, has_next) for the requested page, each list in
+    rank order.
+    """
+    offset = (max(page, 1) - 1) * per_page
+    try:
+        if get_dialect() == 'sqlite' and is_search_index_available():
+            rows = search_sqlite_index(user_id, query, per_page + 1, offset)
+        else:
+            rows = search_by_similarity(user_id, query, per_page + 1, offset)
+    except Exception as e:
+        db.session.rollback()
+        logging.error(f"Error querying search index: {str(e)}")
+        rows = search_by_similarity(user_id, query, per_page + 1, offset)
+    
+    has_next = len(rows) > per_page
+    rows = rows[:per_page]
+    file_ids = [item_id for kind, item_id in rows if kind == 'file']
+    folder_ids = [item_id for kind, item_id in rows if kind == 'folder']
+    files = {f.id: f for f in File.query.filter(File.id.in_(file_ids), File.deleted_at.is_(None))} if file_ids else {}
+    folders = {f.id: f for f in Folder.query.filter(Folder.id.in_(folder_ids), Folder.deleted_at.is_(None))} if folder_ids else {}
+    return (
+        [folders[i] for i in folder_ids if i in folders],
+        [files[i] for i in file_ids if i in files],
+        has_next
+    )
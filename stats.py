@@ -0,0 +1,83 @@
+from sqlalchemy import select, update, delete, insert, func
+from sqlalchemy.exc import IntegrityError
+from app import db
+from models import User, File, Folder, UserTypeUsage
+
+def count_files(user_id, file_type, size, count):
+    """Add `count` files totalling `size` bytes of one type to a user's counters.
+    
+    Runs in the caller's transaction; pass negative values when files go away.
+    """
+    db.session.execute(
+        update(User).where(User.id == user_id).values(file_count=User.file_count + count)
+        .execution_options(synchronize_session=False)
+    )
+    bump = (
+        update(UserTypeUsage)
+        .where(UserTypeUsage.user_id == user_id, UserTypeUsage.file_type == file_type)
+        .values(size=UserTypeUsage.size + size, file_count=UserTypeUsage.file_count + count)
+        .execution_options(synchronize_session=False)
+    )
+    if db.session.execute(bump).rowcount:
+        return
+    
+    # First file of this type for the user
+    try:
+        with db.session.begin_nested():
+            db.session.execute(insert(UserTypeUsage).values(
+                user_id=user_id, file_type=file_type, size=size, file_count=count
+            ))
+    except IntegrityError:
+        # Another transaction created the row first
+        db.session.execute(bump)
+
+def count_matching_files(user_id, file_filter, sign):
+    """Add (sign=1) or remove (sign=-1) every file matching `file_filter` in a user's counters.
+    
+    Totals come from one grouped query, so call this before the matching rows change.
+    """
+    rows = db.session.execute(
+        select(File.file_type, func.coalesce(func.sum(File.size), 0), func.count())
+        .where(File.user_id == user_id, file_filter)
+        .group_by(File.file_type)
+    ).all()
+    for file_type, size, count in rows:
+        count_files(user_id, file_type, sign * size, sign * count)
+
+def count_folders(user_id, count):
+    """Add `count` folders to a user's counters; runs in the caller's transaction"""
+    db.session.execute(
+        update(User).where(User.id == user_id).values(folder_count=User.folder_count + count)
+        .execution_options(synchronize_session=False)
+    )
+
+def get_type_usage(user_id):
+    """Get a user's per-type totals, largest first"""
+    return UserTypeUsage.query.filter(
+        UserTypeUsage.user_id == user_id, UserTypeUsage.file_count > 0
+    ).order_by(UserTypeUsage.size.desc()).all()
+
+def reconcile_user_stats(user_id=None):
+    """Recompute file/folder counts and per-type totals from the rows themselves.
+    
+    Each total is rebuilt with one grouped query, for one user or for everyone.
+    """
+    live_files = select(func.count()).where(File.user_id == User.id, File.deleted_at.is_(None)).scalar_subquery()
+    live_folders = select(func.count()).where(Folder.user_id == User.id, Folder.deleted_at.is_(None)).scalar_subquery()
+    users = update(User).values(file_count=live_files, folder_count=live_folders)
+    type_rows = delete(UserTypeUsage)
+    grouped = select(File.user_id, File.file_type, func.sum(File.size), func.count()).where(File.deleted_at.is_(None))
+    if user_id is not None:
+        users = users.where(User.id == user_id)
+        type_rows = type_rows.where(UserTypeUsage.user_id == user_id)
+        grouped = grouped.where(File.user_id == user_id)
+    
+    db.session.execute(users.execution_options(synchronize_session=False))
+    db.session.execute(type_rows)
+    db.session.execute(
+        insert(UserTypeUsage).from_select(
+            ['user_id', 'file_type', 'size', 'file_count'],
+            grouped.group_by(File.user_id, File.file_type)
+        )
+    )
+    db.session.commit()
@@ -0,0 +1,323 @@
+import os
+import re
+import uuid
+import shutil
+import hashlib
+import tempfile
+import contextlib
+from flask import current_app
+
+# boto3 is optional: only the S3 backend needs it
+try:
+    import boto3
+    from boto3.s3.transfer import TransferConfig
+    from botocore.config import Config as BotoConfig
+    from botocore.exceptions import ClientError
+except ImportError:
+    boto3 = None
+
+CHECKSUM = re.compile(r'^[0-9a-f]{64}$')
+
+# Directory names of the two fan-out levels
+FANOUT_DIR = re.compile(r'^[0-9a-f]{2}$')
+
+# S3 rejects multipart parts smaller than this, except the last one
+S3_MIN_PART_SIZE = 5 * 1024 * 1024
+
+def get_fanout_key(name):
+    """Get the fan-out location of a stored name: ab/cd/<name>.
+    
+    Blobs are spread by their checksum, anything else by a hash of its name.
+    """
+    key = name if CHECKSUM.match(name) else hashlib.sha256(name.encode()).hexdigest()
+    return f"{key[:2]}/{key[2:4]}/{name}"
+
+def is_scratch_name(name):
+    """Scratch content (uploads in progress) is named with a leading dot and kept out of the fan-out"""
+    return name.startswith('.')
+
+def get_temp_name():
+    """Get a fresh scratch name to stream an upload into before its checksum is known"""
+    return f".upload_{uuid.uuid4()}"
+
+class LocalStorage:
+    """Stored content as files under a directory, in the fan-out layout"""
+    
+    def __init__(self, root):
+        self.root = root
+    
+    def get_fanout_path(self, name):
+        """Get where a stored name lives in the fan-out layout"""
+        if is_scratch_name(name):
+            return os.path.join(self.root, name)
+        return os.path.join(self.root, *get_fanout_key(name).split('/'))
+    
+    def get_flat_path(self, name):
+        """Get where a stored name lived before the fan-out layout"""
+        return os.path.join(self.root, name)
+    
+    def get_path(self, name):
+        """Get the path of stored content, which may not have moved to the fan-out layout yet"""
+        path = self.get_fanout_path(name)
+        if not os.path.exists(path):
+            flat_path = self.get_flat_path(name)
+            if os.path.exists(flat_path):
+                return flat_path
+        return path
+    
+    def make_path(self, name):
+        """Get the fan-out path to write a stored name to, creating its directories"""
+        path = self.get_fanout_path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+    
+    def get_local_path(self, name):
+        return self.get_path(name)
+    
+    @contextlib.contextmanager
+    def fetch(self, name):
+        """Yield a local path to the content; here it is the stored file itself"""
+        yield self.get_path(name)
+    
+    def get_local_copy(self, name):
+        """Get (path, is_temporary) for content that must be read from a local file"""
+        return self.get_path(name), False
+    
+    def write_chunks(self, name, chunks):
+        with open(self.make_path(name), 'wb') as out:
+            for chunk in chunks:
+                out.write(chunk)
+    
+    def put_file(self, local_path, name):
+        """Adopt a local file as stored content; a rename when it is on the same filesystem"""
+        shutil.move(local_path, self.make_path(name))
+    
+    def put_fileobj(self, fileobj, name):
+        with open(self.make_path(name), 'wb') as out:
+            shutil.copyfileobj(fileobj, out)
+    
+    def rename(self, name, new_name):
+        os.replace(self.get_path(name), self.make_path(new_name))
+    
+    def delete(self, name):
+        path = self.get_path(name)
+        if os.path.exists(path):
+            os.remove(path)
+    
+    def get_size(self, name):
+        """Get the size of stored content, or None if it is missing"""
+        try:
+            return os.stat(self.get_path(name)).st_size
+        except FileNotFoundError:
+            return None
+    
+    def iter_range(self, name, start=0, stop=None, chunk_size=256 * 1024):
+        """Yield the bytes [start, stop) of stored content in chunks"""
+        with open(self.get_path(name), 'rb') as f:
+            f.seek(start)
+            remaining = stop - start if stop is not None else None
+            while remaining is None or remaining > 0:
+                chunk = f.read(chunk_size if remaining is None else min(chunk_size, remaining))
+                if not chunk:
+                    break
+                if remaining is not None:
+                    remaining -= len(chunk)
+                yield chunk
+    
+    def get_download_url(self, name, filename, mimetype, as_attachment=True, encoding=None):
+        """Local content has no URL of its own; it is sent by the app or the front proxy"""
+        return None
+    
+    def iter_entries(self, folder=None, depth=0):
+        """Yield (name, size, mtime) for everything stored, top level and fan-out directories alike"""
+        with os.scandir(folder or self.root) as it:
+            for entry in it:
+                if entry.is_file():
+                    stat = entry.stat()
+                    yield entry.name, stat.st_size, stat.st_mtime
+                elif depth < 2 and entry.is_dir() and FANOUT_DIR.match(entry.name):
+                    yield from self.iter_entries(entry.path, depth + 1)
+    
+    def move_to_fanout(self, name):
+        """Move content from the flat layout into the fan-out one. Returns False if there was nothing to move.
+        
+        The content is linked into place before the old name is removed, so it
+        can be opened under one name or the other throughout.
+        """
+        flat_path = self.get_flat_path(name)
+        if not os.path.isfile(flat_path):
+            return False
+        path = self.make_path(name)
+        try:
+            os.link(flat_path, path)
+        except FileExistsError:
+            pass
+        except OSError:
+            # No hard links on this filesystem: a rename is still atomic
+            os.replace(flat_path, path)
+            return True
+        os.remove(flat_path)
+        return True
+
+class S3Storage:
+    """Stored content as objects in an S3-compatible bucket (AWS, MinIO, Ceph, moto, ...)"""
+    
+    def __init__(self, bucket, prefix='', endpoint_url=None, region=None, access_key=None, secret_key=None,
+                 part_size=8 * 1024 * 1024, presign_expires=300, presign_downloads=True):
+        if boto3 is None:
+            raise RuntimeError("The S3 storage backend needs boto3 (pip install boto3)")
+        self.bucket = bucket
+        self.prefix = prefix
+        self.part_size = max(part_size, S3_MIN_PART_SIZE)
+        self.presign_expires = presign_expires
+        self.presign_downloads = presign_downloads
+        self.transfer_config = TransferConfig(multipart_chunksize=self.part_size, multipart_threshold=self.part_size)
+        self.client = boto3.client(
+            's3', endpoint_url=endpoint_url, region_name=region,
+            aws_access_key_id=access_key, aws_secret_access_key=secret_key,
+            config=BotoConfig(signature_version='s3v4', retries={'mode': 'standard'})
+        )
+    
+    def get_key(self, name):
+        if is_scratch_name(name):
+            return f"{self.prefix}tmp/{name}"
+        return self.prefix + get_fanout_key(name)
+    
+    def get_local_path(self, name):
+        return None
+    
+    @contextlib.contextmanager
+    def fetch(self, name):
+        """Yield a local path to a temporary copy of the content"""
+        path, _ = self.get_local_copy(name)
+        try:
+            yield path
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+    
+    def get_local_copy(self, name):
+        """Download content to a temporary file; the caller removes it"""
+        fd, path = tempfile.mkstemp(prefix='.s3-', suffix=os.path.splitext(name)[1])
+        os.close(fd)
+        self.client.download_file(self.bucket, self.get_key(name), path, Config=self.transfer_config)
+        return path, True
+    
+    def write_chunks(self, name, chunks):
+        """Stream chunks into an object with a multipart upload, holding at most one part in memory"""
+        key = self.get_key(name)
+        buffer = bytearray()
+        upload_id = None
+        parts = []
+        try:
+            for chunk in chunks:
+                buffer += chunk
+                if len(buffer) >= self.part_size:
+                    if upload_id is None:
+                        upload_id = self.client.create_multipart_upload(Bucket=self.bucket, Key=key)['UploadId']
+                    parts.append(self.upload_part(key, upload_id, len(parts) + 1, bytes(buffer)))
+                    buffer.clear()
+            if upload_id is None:
+                # Small enough for a single request
+                self.client.put_object(Bucket=self.bucket, Key=key, Body=bytes(buffer))
+                return
+            if buffer:
+                parts.append(self.upload_part(key, upload_id, len(parts) + 1, bytes(buffer)))
+            self.client.complete_multipart_upload(
+                Bucket=self.bucket, Key=key, UploadId=upload_id, MultipartUpload={'Parts': parts}
+            )
+        except BaseException:
+            if upload_id is not None:
+                self.client.abort_multipart_upload(Bucket=self.bucket, Key=key, UploadId=upload_id)
+            raise
+    
+    def upload_part(self, key, upload_id, number, data):
+        response = self.client.upload_part(
+            Bucket=self.bucket, Key=key, UploadId=upload_id, PartNumber=number, Body=data
+        )
+        return {'PartNumber': number, 'ETag': response['ETag']}
+    
+    def put_file(self, local_path, name):
+        """Upload a local file, in parallel parts when it is large, then remove it"""
+        self.client.upload_file(local_path, self.bucket, self.get_key(name), Config=self.transfer_config)
+        os.remove(local_path)
+    
+    def put_fileobj(self, fileobj, name):
+        self.client.upload_fileobj(fileobj, self.bucket, self.get_key(name), Config=self.transfer_config)
+    
+    def rename(self, name, new_name):
+        """Copy server-side (in parts past 5 GB) and drop the original; no bytes pass through here"""
+        source = {'Bucket': self.bucket, 'Key': self.get_key(name)}
+        self.client.copy(source, self.bucket, self.get_key(new_name), Config=self.transfer_config)
+        self.client.delete_object(**source)
+    
+    def delete(self, name):
+        self.client.delete_object(Bucket=self.bucket, Key=self.get_key(name))
+    
+    def get_size(self, name):
+        """Get the size of stored content, or None if it is missing"""
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=self.get_key(name))['ContentLength']
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return None
+            raise
+    
+    def iter_range(self, name, start=0, stop=None, chunk_size=256 * 1024):
+        """Yield the bytes [start, stop) of an object with one ranged GET"""
+        byte_range = f"bytes={start}-{stop - 1}" if stop is not None else f"bytes={start}-"
+        if stop is not None and stop <= start:
+            return
+        body = self.client.get_object(Bucket=self.bucket, Key=self.get_key(name), Range=byte_range)['Body']
+        try:
+            yield from body.iter_chunks(chunk_size)
+        finally:
+            body.close()
+    
+    def get_download_url(self, name, filename, mimetype, as_attachment=True, encoding=None):
+        """Presign a GET so the client fetches the bytes from the bucket directly"""
+        if not self.presign_downloads:
+            return None
+        from downloads import get_content_disposition
+        params = {
+            'Bucket': self.bucket,
+            'Key': self.get_key(name),
+            'ResponseContentType': mimetype,
+            'ResponseContentDisposition': get_content_disposition(filename, as_attachment),
+        }
+        if encoding:
+            params['ResponseContentEncoding'] = encoding
+        return self.client.generate_presigned_url('get_object', Params=params, ExpiresIn=self.presign_expires)
+    
+    def iter_entries(self):
+        """Yield (name, size, mtime) for every object under the prefix"""
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix):
+            for item in page.get('Contents', []):
+                yield item['Key'].rsplit('/', 1)[-1], item['Size'], item['LastModified'].timestamp()
+
+def create_storage(config):
+    """Build the storage backend named by STORAGE_BACKEND ('local' or 's3')"""
+    backend = config.get('STORAGE_BACKEND', 'local')
+    if backend == 'local':
+        return LocalStorage(config['UPLOAD_FOLDER'])
+    if backend == 's3':
+        return S3Storage(
+            config['S3_BUCKET'],
+            prefix=config.get('S3_PREFIX', ''),
+            endpoint_url=config.get('S3_ENDPOINT_URL'),
+            region=config.get('S3_REGION'),
+            access_key=config.get('S3_ACCESS_KEY_ID'),
+            secret_key=config.get('S3_SECRET_ACCESS_KEY'),
+            part_size=config.get('S3_PART_SIZE', 8 * 1024 * 1024),
+            presign_expires=config.get('S3_PRESIGN_EXPIRES', 300),
+            presign_downloads=config.get('S3_PRESIGN_DOWNLOADS', True)
+        )
+    raise ValueError(f"Unknown storage backend: {backend}")
+
+def get_storage():
+    """Get the storage backend of the current app, creating it on first use"""
+    storage = current_app.extensions.get('storage')
+    if storage is None:
+        storage = current_app.extensions['storage'] = create_storage(current_app.config)
+    return storage
@@ -0,0 +1,68 @@
+import os
+import tempfile
+
+import pytest
+
+# The app module binds its database when first imported, so point it at a
+# scratch file before any test module imports it
+SCRATCH_DIR = tempfile.mkdtemp(prefix='eforice-tests-')
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(SCRATCH_DIR, 'app.db')
+os.environ.pop('DATABASE_REPLICA_URL', None)
+
+# Modules are imported the way the app imports them, starting from the app module
+import app  # noqa: E402,F401
+
+@pytest.fixture
+def app(tmp_path):
+    """The app with empty tables and its own upload folder"""
+    import auth
+    import admin
+    import listings
+    from main import app
+    from extensions import db
+    
+    app.config.update(
+        TESTING=True,
+        WTF_CSRF_ENABLED=False,
+        UPLOAD_FOLDER=str(tmp_path / 'uploads'),
+        PREVIEW_FOLDER=str(tmp_path / 'previews'),
+        TRASH_PURGE_INTERVAL=0,
+    )
+    os.makedirs(app.config['UPLOAD_FOLDER'])
+    for name in ('storage', 'throttle'):
+        app.extensions.pop(name, None)
+    # Per-process caches would otherwise carry users over from earlier tests
+    auth._identities = listings._listings = admin._fleet_stats = None
+    
+    # Apps built by other tests register their replica bind on the shared extension,
+    # so only the primary's tables are managed here
+    with app.app_context():
+        db.create_all(bind_key=None)
+    yield app
+    with app.app_context():
+        db.session.remove()
+        db.drop_all(bind_key=None)
+
+@pytest.fixture
+def user(app):
+    """An approved user with a 10 kB quota"""
+    from extensions import db
+    from models import User
+    
+    with app.app_context():
+        user = User(username='alice', email='alice@example.com', password_hash='x', is_approved=True,
+                    storage_limit=10000)
+        db.session.add(user)
+        db.session.commit()
+        db.session.refresh(user)
+        db.session.expunge(user)
+    return user
+
+@pytest.fixture
+def client(app, user):
+    """A test client logged in as `user`"""
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = str(user.id)
+        session['_fresh'] = True
+    return client
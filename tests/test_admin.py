@@ -0,0 +1,82 @@
+import io
+import os
+
+from sqlalchemy import select, func
+from werkzeug.datastructures import FileStorage
+
+from extensions import db
+from models import (
+    User, File, Folder, FolderClosure, Blob, StorageClass, UserTypeUsage, UploadSession, UploadChunk,
+    QuotaReservation, ChangeEvent
+)
+from storage import get_storage
+from utils import create_folder, save_file
+from uploads import create_upload_session
+from admin import delete_user
+
+USER_TABLES = (File, Folder, StorageClass, UserTypeUsage, UploadSession, QuotaReservation, ChangeEvent)
+
+def upload(user_id, name, data, folder_id=None):
+    file, error = save_file(FileStorage(io.BytesIO(data), filename=name, content_type='text/plain'), user_id, folder_id)
+    assert error is None
+    return file
+
+def count_rows(model, *criteria):
+    return db.session.execute(select(func.count()).select_from(model).where(*criteria)).scalar()
+
+def make_tenant(app, user):
+    """Give `user` nested folders, files inside and outside them, an open upload and content shared with bob"""
+    with app.app_context():
+        bob = User(username='bob', email='bob@example.com', password_hash='x', is_approved=True, storage_limit=10000)
+        db.session.add(bob)
+        db.session.commit()
+        
+        docs, _ = create_folder('docs', user.id)
+        papers, _ = create_folder('papers', user.id, docs.id)
+        upload(user.id, 'own.txt', b'only alice has this', papers.id)
+        upload(user.id, 'root.txt', b'shared with bob')
+        shared = upload(bob.id, 'copy.txt', b'shared with bob')
+        session, error = create_upload_session(user.id, 'big.bin', 100, docs.id)
+        assert error is None
+        return bob.id, shared.blob_id, session.get_path()
+
+def test_delete_user_removes_every_row_and_releases_content(app, user):
+    bob_id, shared_blob_id, scratch_path = make_tenant(app, user)
+    with app.app_context():
+        own_name = db.session.execute(select(File.filename).where(File.original_filename == 'own.txt')).scalar()
+        assert os.path.exists(scratch_path)
+        
+        assert delete_user(user.id) == (True, None)
+        
+        for model in USER_TABLES:
+            assert count_rows(model, model.user_id == user.id) == 0, model.__name__
+        assert count_rows(FolderClosure) == 0
+        assert count_rows(UploadChunk) == 0
+        assert db.session.get(User, user.id) is None
+        
+        # Content only alice used is gone, content bob still uses keeps bob's reference
+        assert get_storage().get_size(own_name) is None
+        assert db.session.execute(select(Blob.ref_count).where(Blob.id == shared_blob_id)).scalar() == 1
+        assert get_storage().get_size(db.session.get(Blob, shared_blob_id).filename) is not None
+        assert not os.path.exists(scratch_path)
+        assert count_rows(File, File.user_id == bob_id) == 1
+
+def test_delete_user_reports_missing_user(app):
+    with app.app_context():
+        assert delete_user(12345) == (False, "User not found")
+
+def test_reject_route_deletes_the_user(app, user, client):
+    make_tenant(app, user)
+    with app.app_context():
+        db.session.execute(
+            User.__table__.update().where(User.id == user.id).values(is_admin=True)
+        )
+        target = db.session.execute(select(User.id).where(User.username == 'bob')).scalar()
+        db.session.commit()
+    
+    response = client.post(f'/admin/reject/{target}')
+    assert response.status_code == 302
+    with app.app_context():
+        assert db.session.get(User, target) is None
+        assert count_rows(File, File.user_id == target) == 0
+        assert db.session.execute(select(Blob.ref_count)).scalars().all() == [1, 1]
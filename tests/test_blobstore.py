@@ -0,0 +1,90 @@
+import hashlib
+
+import pytest
+from sqlalchemy import update
+
+from extensions import db
+from models import Blob
+from storage import get_storage, get_temp_name
+from blobstore import acquire_blob, release_blob, delete_contents
+
+def write_temp(data):
+    name = get_temp_name()
+    get_storage().write_chunks(name, [data])
+    return name
+
+def read(name):
+    return b''.join(get_storage().iter_range(name))
+
+def acquire(data, **kwargs):
+    checksum = hashlib.sha256(data).hexdigest()
+    return acquire_blob(write_temp(data), len(data), checksum, **kwargs)
+
+def test_new_content_is_adopted_and_duplicates_share_it(app):
+    with app.app_context():
+        storage = get_storage()
+        blob = acquire(b'hello')
+        db.session.commit()
+        assert read(blob.filename) == b'hello'
+        
+        temp_name = write_temp(b'hello')
+        again = acquire_blob(temp_name, 5, blob.checksum)
+        db.session.commit()
+        assert again.id == blob.id
+        assert again.ref_count == 2
+        assert storage.get_size(temp_name) is None
+
+def test_rolled_back_blob_leaves_no_content(app):
+    with app.app_context():
+        blob = acquire(b'never committed')
+        name = blob.filename
+        assert read(name) == b'never committed'
+        db.session.rollback()
+        assert Blob.query.count() == 0
+        assert get_storage().get_size(name) is None
+
+def test_existing_content_is_never_replaced(app):
+    with app.app_context():
+        blob = acquire(b'plain content')
+        db.session.commit()
+        
+        # The same content arriving compressed only adds a reference
+        again = acquire(b'plain content', encoding='gzip', stored_size=3)
+        db.session.commit()
+        assert again.id == blob.id
+        assert again.encoding is None
+        assert read(blob.filename) == b'plain content'
+
+def test_blob_being_deleted_is_not_claimed_or_overwritten(app):
+    with app.app_context():
+        blob = acquire(b'dying')
+        db.session.commit()
+        # A row down to no references, as left between a release and its delete
+        db.session.execute(update(Blob).where(Blob.id == blob.id).values(ref_count=0))
+        db.session.commit()
+        
+        temp_name = write_temp(b'dying')
+        with pytest.raises(RuntimeError):
+            acquire_blob(temp_name, 5, blob.checksum, encoding='gzip')
+        db.session.rollback()
+        assert read(blob.filename) == b'dying'
+        assert read(temp_name) == b'dying'
+
+def test_released_content_claimed_again_is_not_deleted(app):
+    with app.app_context():
+        blob = acquire(b'shared')
+        db.session.commit()
+        unused_name = release_blob(blob.id)
+        db.session.commit()
+        assert unused_name == blob.filename
+        
+        # Another upload stores the same content before the deferred delete runs
+        blob = acquire(b'shared')
+        db.session.commit()
+        delete_contents([unused_name])
+        assert read(blob.filename) == b'shared'
+        
+        unused_name = release_blob(blob.id)
+        db.session.commit()
+        delete_contents([unused_name])
+        assert get_storage().get_size(unused_name) is None
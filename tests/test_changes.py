@@ -0,0 +1,112 @@
+import os
+import threading
+
+import pytest
+
+from app import create_app
+from extensions import db
+from models import User
+from changes import record_change, get_changes, get_latest_change_seq, encode_change_cursor
+from utils import create_folder
+
+def test_feed_returns_changes_after_cursor(app, user, client):
+    start = client.get('/api/changes').get_json()
+    assert start == {'changes': [], 'cursor': encode_change_cursor(0), 'has_more': False}
+    
+    with app.app_context():
+        docs, _ = create_folder('docs', user.id)
+        create_folder('papers', user.id, docs.id)
+    
+    page = client.get('/api/changes', query_string={'cursor': start['cursor'], 'limit': 1}).get_json()
+    assert [(change['action'], change['name']) for change in page['changes']] == [('create', 'docs')]
+    assert page['has_more']
+    page = client.get('/api/changes', query_string={'cursor': page['cursor']}).get_json()
+    assert [(change['action'], change['name']) for change in page['changes']] == [('create', 'papers')]
+    assert not page['has_more']
+
+def check_writers_commit_in_cursor_order(app, user_id):
+    """Interleave two writers: the one numbered first is held open while the other tries to commit.
+    
+    A reader must not be able to see the second change before the first,
+    or its cursor would move past the first for good.
+    """
+    first_taken = threading.Event()
+    release_first = threading.Event()
+    second_done = threading.Event()
+    
+    def first_writer():
+        with app.app_context():
+            record_change(user_id, 'create', 'file', 1, None, 'first.txt', 1)
+            db.session.flush()
+            first_taken.set()
+            release_first.wait(10)
+            db.session.commit()
+    
+    def second_writer():
+        with app.app_context():
+            first_taken.wait(10)
+            record_change(user_id, 'create', 'file', 2, None, 'second.txt', 1)
+            db.session.commit()
+            second_done.set()
+    
+    threads = [threading.Thread(target=first_writer), threading.Thread(target=second_writer)]
+    for thread in threads:
+        thread.start()
+    try:
+        assert first_taken.wait(10)
+        # The second writer cannot take a number while the first holds the user row
+        assert not second_done.wait(0.5)
+        with app.app_context():
+            assert get_changes(user_id, 0) == ([], False)
+            assert get_latest_change_seq(user_id) == 0
+    finally:
+        release_first.set()
+        for thread in threads:
+            thread.join(10)
+    
+    assert second_done.is_set()
+    with app.app_context():
+        changes, _ = get_changes(user_id, 0)
+        assert [(change.seq, change.name) for change in changes] == [(1, 'first.txt'), (2, 'second.txt')]
+
+def test_concurrent_writers_commit_in_cursor_order(app, user):
+    check_writers_commit_in_cursor_order(app, user.id)
+
+POSTGRES_URL = os.environ.get('TEST_POSTGRES_URL')
+
+@pytest.mark.skipif(not POSTGRES_URL, reason='TEST_POSTGRES_URL is not set')
+def test_concurrent_writers_commit_in_cursor_order_on_postgres(tmp_path):
+    """PostgreSQL lets both transactions write at once, so only the user row lock keeps them in order"""
+    pytest.importorskip('psycopg2')
+    app = create_app({'SQLALCHEMY_DATABASE_URI': POSTGRES_URL, 'UPLOAD_FOLDER': str(tmp_path)})
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        user = User(username='alice', email='alice@example.com', password_hash='x')
+        db.session.add(user)
+        db.session.commit()
+        user_id = user.id
+    try:
+        check_writers_commit_in_cursor_order(app, user_id)
+    finally:
+        with app.app_context():
+            db.session.remove()
+            db.drop_all()
+
+def test_compacted_cursor_is_refused(app, user, client):
+    from datetime import datetime, timedelta
+    from changes import compact_changes
+    from models import ChangeEvent
+    
+    with app.app_context():
+        for name in ('a', 'b', 'c'):
+            create_folder(name, user.id)
+        ChangeEvent.query.filter(ChangeEvent.seq <= 2).update({'date_created': datetime.utcnow() - timedelta(days=90)})
+        db.session.commit()
+        assert compact_changes() == 2
+        assert db.session.get(User, user.id).change_floor == 2
+    
+    response = client.get('/api/changes', query_string={'cursor': encode_change_cursor(1)})
+    assert response.status_code == 410
+    page = client.get('/api/changes', query_string={'cursor': encode_change_cursor(2)}).get_json()
+    assert [change['name'] for change in page['changes']] == ['c']
@@ -0,0 +1,51 @@
+import os
+
+import commands
+from extensions import db
+from models import File
+from storage import get_storage
+
+def add_legacy_files(app, user, contents):
+    """Files stored the old way, under per-upload names straight in the upload folder"""
+    with app.app_context():
+        for i, data in enumerate(contents):
+            name = f"legacy_{i}.txt"
+            with open(os.path.join(app.config['UPLOAD_FOLDER'], name), 'wb') as f:
+                f.write(data)
+            db.session.add(File(
+                filename=name, original_filename=name, file_type='document', mimetype='text/plain',
+                size=len(data), user_id=user.id
+            ))
+        db.session.commit()
+
+def test_interrupted_migration_keeps_legacy_files(app, user, monkeypatch):
+    # The test tables are already current
+    monkeypatch.setattr(commands, 'upgrade_schema', lambda: [])
+    add_legacy_files(app, user, [b'first', b'second', b'third'])
+    legacy_paths = [os.path.join(app.config['UPLOAD_FOLDER'], f"legacy_{i}.txt") for i in range(3)]
+    
+    store_file = commands.store_file
+    calls = []
+    
+    def failing_store_file(*args, **kwargs):
+        calls.append(args)
+        if len(calls) == 2:
+            raise RuntimeError("disk full")
+        return store_file(*args, **kwargs)
+    
+    monkeypatch.setattr(commands, 'store_file', failing_store_file)
+    result = app.test_cli_runner().invoke(args=['migrate-blobs'])
+    assert isinstance(result.exception, RuntimeError)
+    with app.app_context():
+        assert [file.blob_id for file in File.query.order_by(File.id)] == [None, None, None]
+    assert all(os.path.exists(path) for path in legacy_paths)
+    assert not any(os.path.exists(f"{path}.store") for path in legacy_paths)
+    
+    monkeypatch.setattr(commands, 'store_file', store_file)
+    result = app.test_cli_runner().invoke(args=['migrate-blobs'])
+    assert result.exit_code == 0, result.output
+    assert "Migrated 3 files" in result.output
+    assert not any(os.path.exists(path) for path in legacy_paths)
+    with app.app_context():
+        contents = [b''.join(get_storage().iter_range(file.filename)) for file in File.query.order_by(File.id)]
+        assert contents == [b'first', b'second', b'third']
@@ -0,0 +1,129 @@
+import os
+
+import pytest
+from flask import g
+from sqlalchemy import select, text
+from sqlalchemy.pool import QueuePool
+
+from app import create_app
+from extensions import db, get_engine_options, normalize_database_url
+from models import User
+
+def make_app(tmp_path, **config):
+    return create_app({
+        'SQLALCHEMY_DATABASE_URI': f"sqlite:///{tmp_path / 'primary.db'}",
+        'UPLOAD_FOLDER': str(tmp_path / 'uploads'),
+        **config
+    })
+
+def add_user(username):
+    db.session.add(User(username=username, email=f'{username}@example.com', password_hash='x'))
+    db.session.commit()
+
+def test_sqlite_pragmas_are_applied(tmp_path):
+    app = make_app(tmp_path, SQLITE_BUSY_TIMEOUT=1234, SQLITE_MMAP_SIZE=1024 * 1024)
+    with app.app_context(), db.engine.connect() as conn:
+        assert conn.execute(text('PRAGMA journal_mode')).scalar() == 'wal'
+        assert conn.execute(text('PRAGMA synchronous')).scalar() == 1  # NORMAL
+        assert conn.execute(text('PRAGMA busy_timeout')).scalar() == 1234
+        assert conn.execute(text('PRAGMA mmap_size')).scalar() == 1024 * 1024
+
+def test_pool_is_configured(tmp_path):
+    app = make_app(tmp_path, DB_POOL_SIZE=3, DB_MAX_OVERFLOW=7, DB_POOL_RECYCLE=60, DB_POOL_PRE_PING=True)
+    with app.app_context():
+        pool = db.engine.pool
+        assert isinstance(pool, QueuePool)
+        assert pool.size() == 3
+        assert pool._max_overflow == 7
+        assert pool._recycle == 60
+        assert pool._pre_ping is True
+
+def test_in_memory_sqlite_has_no_pool_size():
+    options = get_engine_options({
+        'SQLALCHEMY_DATABASE_URI': 'sqlite://',
+        'DB_POOL_SIZE': 3,
+        'DB_MAX_OVERFLOW': 7,
+        'DB_POOL_PRE_PING': False,
+        'DB_POOL_RECYCLE': 60,
+    })
+    assert options == {'pool_pre_ping': False, 'pool_recycle': 60}
+
+def test_postgres_urls_use_psycopg2():
+    assert normalize_database_url('postgres://u:p@db/eforice') == 'postgresql+psycopg2://u:p@db/eforice'
+    assert normalize_database_url('postgresql://u:p@db/eforice') == 'postgresql+psycopg2://u:p@db/eforice'
+    assert normalize_database_url('postgresql+psycopg2://db/eforice') == 'postgresql+psycopg2://db/eforice'
+    assert normalize_database_url('sqlite:///site.db') == 'sqlite:///site.db'
+
+def check_replica_routing(app):
+    """Reads go to the replica only while a request allows it; writes and locking reads never do"""
+    with app.app_context():
+        primary, replica = db.engines[None], db.engines['replica']
+        statement = select(User)
+        assert db.session.get_bind(clause=statement) is primary
+        
+        g.use_replica = True
+        assert db.session.get_bind(clause=statement) is replica
+        assert db.session.get_bind(clause=statement.with_for_update()) is primary
+        assert db.session.get_bind(clause=text('SELECT 1')) is primary
+    
+    @app.route('/files')
+    def file_manager():
+        return ','.join(user.username for user in db.session.execute(select(User)).scalars())
+    
+    @app.route('/other')
+    def other():
+        return ','.join(user.username for user in db.session.execute(select(User)).scalars())
+    
+    client = app.test_client()
+    assert client.get('/files').get_data(as_text=True) == 'replica-user'
+    assert client.get('/other').get_data(as_text=True) == 'primary-user'
+
+def test_sqlite_reads_go_to_replica(tmp_path):
+    app = make_app(tmp_path, DATABASE_REPLICA_URL=f"sqlite:///{tmp_path / 'replica.db'}")
+    with app.app_context():
+        # The replica gets the same schema; models themselves only bind to the primary
+        db.create_all()
+        db.metadata.create_all(db.engines['replica'])
+        # Different rows on each side show which database answered
+        add_user('primary-user')
+        with db.engines['replica'].begin() as conn:
+            conn.execute(User.__table__.insert().values(
+                username='replica-user', email='replica@example.com', password_hash='x'
+            ))
+    check_replica_routing(app)
+
+POSTGRES_URL = os.environ.get('TEST_POSTGRES_URL')
+POSTGRES_REPLICA_URL = os.environ.get('TEST_POSTGRES_REPLICA_URL')
+
+@pytest.mark.skipif(not POSTGRES_URL, reason='TEST_POSTGRES_URL is not set')
+def test_postgres_pool_is_configured(tmp_path):
+    pytest.importorskip('psycopg2')
+    app = make_app(tmp_path, SQLALCHEMY_DATABASE_URI=POSTGRES_URL, DB_POOL_SIZE=3, DB_MAX_OVERFLOW=7)
+    with app.app_context():
+        assert db.engine.dialect.driver == 'psycopg2'
+        assert db.engine.pool.size() == 3
+        assert db.engine.pool._max_overflow == 7
+        with db.engine.connect() as conn:
+            assert conn.execute(text('SELECT 1')).scalar() == 1
+
+@pytest.mark.skipif(not (POSTGRES_URL and POSTGRES_REPLICA_URL),
+                    reason='TEST_POSTGRES_URL and TEST_POSTGRES_REPLICA_URL are not set')
+def test_postgres_reads_go_to_replica(tmp_path):
+    pytest.importorskip('psycopg2')
+    app = make_app(tmp_path, SQLALCHEMY_DATABASE_URI=POSTGRES_URL, DATABASE_REPLICA_URL=POSTGRES_REPLICA_URL)
+    with app.app_context():
+        # Two separate databases stand in for a primary and its replica
+        for engine in (db.engines[None], db.engines['replica']):
+            db.metadata.drop_all(engine)
+            db.metadata.create_all(engine)
+        add_user('primary-user')
+        with db.engines['replica'].begin() as conn:
+            conn.execute(User.__table__.insert().values(
+                username='replica-user', email='replica@example.com', password_hash='x'
+            ))
+    try:
+        check_replica_routing(app)
+    finally:
+        with app.app_context():
+            for engine in (db.engines[None], db.engines['replica']):
+                db.metadata.drop_all(engine)
@@ -0,0 +1,21 @@
+import utils
+from extensions import db
+from models import Folder, FolderClosure
+from utils import create_folder
+
+def test_failed_create_leaves_session_usable(app, user, monkeypatch):
+    def fail(*args, **kwargs):
+        raise RuntimeError("journal unavailable")
+    
+    with app.app_context():
+        monkeypatch.setattr(utils, 'record_change', fail)
+        assert create_folder('docs', user.id) == (None, "journal unavailable")
+        monkeypatch.undo()
+        
+        # Nothing of the failed folder is left, and the next write goes through
+        assert Folder.query.count() == 0
+        assert FolderClosure.query.count() == 0
+        folder, error = create_folder('docs', user.id)
+        assert error is None
+        assert [f.name for f in Folder.query] == ['docs']
+        assert db.session.get(FolderClosure, (folder.id, folder.id)) is not None
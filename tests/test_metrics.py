@@ -0,0 +1,62 @@
+import re
+
+import pytest
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+
+from extensions import db
+from metrics import Registry, METRICS, LATENCY_BUCKETS
+
+# One sample line: name, optional labels, then a number
+SAMPLE = re.compile(r'^[a-z_]+(\{[a-z_]+="(?:[^"\\\n]|\\["\\n])*"(,[a-z_]+="(?:[^"\\\n]|\\["\\n])*")*\})? [0-9.e+-]+$')
+
+def test_render_follows_exposition_format():
+    registry = Registry()
+    registry.inc('eforice_requests_total', {'endpoint': 'index', 'method': 'GET', 'status': '200'})
+    registry.inc('eforice_requests_total', {'endpoint': 'index', 'method': 'GET', 'status': '200'})
+    registry.inc('eforice_sql_seconds_total', {'endpoint': 'say "hi"\\\n'}, 0.1234567)
+    for value in (0.003, 0.2, 30):
+        registry.observe('eforice_request_duration_seconds', {'endpoint': 'index'}, value, LATENCY_BUCKETS)
+    
+    output = registry.render()
+    assert output.endswith('\n')
+    lines = output.splitlines()
+    for line in lines:
+        assert line.startswith(('# HELP ', '# TYPE ')) or SAMPLE.match(line), line
+    
+    # Every metric is announced once, in order, even without samples
+    assert [line.split()[2] for line in lines if line.startswith('# TYPE')] == list(METRICS)
+    assert 'eforice_requests_total{endpoint="index",method="GET",status="200"} 2' in lines
+    assert 'eforice_sql_seconds_total{endpoint="say \\"hi\\"\\\\\\n"} 0.123457' in lines
+    
+    # Buckets are cumulative and end in +Inf, which matches the count
+    buckets = [line for line in lines if line.startswith('eforice_request_duration_seconds_bucket')]
+    assert buckets[0] == 'eforice_request_duration_seconds_bucket{endpoint="index",le="0.005"} 1'
+    assert buckets[5] == 'eforice_request_duration_seconds_bucket{endpoint="index",le="0.25"} 2'
+    assert buckets[-1] == 'eforice_request_duration_seconds_bucket{endpoint="index",le="+Inf"} 3'
+    assert 'eforice_request_duration_seconds_count{endpoint="index"} 3' in lines
+    assert 'eforice_request_duration_seconds_sum{endpoint="index"} 30.203' in lines
+
+def test_metrics_endpoint_counts_requests(app, client, monkeypatch):
+    monkeypatch.setitem(app.config, 'METRICS_TOKEN', 'secret')
+    client.get('/api/changes')
+    assert client.get('/metrics').status_code == 401
+    
+    response = client.get('/metrics', headers={'Authorization': 'Bearer secret'})
+    assert response.mimetype == 'text/plain'
+    assert re.search(r'^eforice_requests_total\{endpoint="api_changes",method="GET",status="200"\} \d+$',
+                     response.get_data(as_text=True), re.MULTILINE)
+
+def test_queries_outside_requests_leave_no_start_behind(app):
+    with app.app_context():
+        with db.engine.connect() as conn:
+            for _ in range(3):
+                conn.execute(text('SELECT 1'))
+            assert not conn.info.get('metrics_query_start')
+
+def test_failed_statement_leaves_no_start_behind(app):
+    with app.app_context():
+        with db.engine.connect() as conn:
+            with pytest.raises(OperationalError):
+                conn.execute(text('SELECT * FROM no_such_table'))
+            assert not conn.info.get('metrics_query_start')
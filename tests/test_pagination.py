@@ -0,0 +1,52 @@
+import io
+from datetime import datetime, timedelta
+
+import pytest
+from werkzeug.datastructures import FileStorage
+
+from extensions import db
+from models import File
+from utils import FILE_SORT_KEYS, save_file, paginate_files, encode_cursor, decode_cursor
+
+SORT_KEYS = list(FILE_SORT_KEYS) + ['no_such_column']
+
+@pytest.fixture
+def files(app, user):
+    """Files whose names, sizes, types and dates sort differently, some of them tied"""
+    uploads = [('b.txt', 30), ('a.png', 10), ('d.mp3', 30), ('c.txt', 20), ('e.png', 5)]
+    start = datetime(2024, 1, 1)
+    with app.app_context():
+        for i, (name, size) in enumerate(uploads):
+            file, error = save_file(FileStorage(io.BytesIO(name.encode() * size), filename=name), user.id)
+            assert error is None
+            # Dates run against upload order, so sorting by id alone would not pass
+            file.date_uploaded = start - timedelta(days=i)
+        db.session.commit()
+
+@pytest.mark.parametrize('sort_by', SORT_KEYS)
+def test_cursor_round_trips(app, sort_by):
+    value = datetime(2024, 5, 6, 7, 8, 9) if sort_by not in ('name', 'size', 'type') else 'x'
+    with app.app_context():
+        assert decode_cursor(encode_cursor(value, 42), sort_by) == (value, 42)
+
+@pytest.mark.parametrize('order', ['asc', 'desc'])
+@pytest.mark.parametrize('sort_by', SORT_KEYS)
+def test_pages_follow_the_full_order(app, user, files, sort_by, order):
+    with app.app_context():
+        query = File.query.filter_by(user_id=user.id)
+        expected = [file.id for file in paginate_files(query, sort_by, order, limit=100)[0]]
+        assert len(expected) == 5
+        
+        seen, cursor = [], None
+        while True:
+            page, cursor = paginate_files(query, sort_by, order, cursor, limit=2)
+            seen += [file.id for file in page]
+            if cursor is None:
+                break
+        assert seen == expected
+
+def test_unknown_sort_key_sorts_by_date(app, user, files):
+    with app.app_context():
+        query = File.query.filter_by(user_id=user.id)
+        page, _ = paginate_files(query, 'no_such_column', 'asc', limit=100)
+        assert [file.original_filename for file in page] == ['e.png', 'c.txt', 'd.mp3', 'a.png', 'b.txt']
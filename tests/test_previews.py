@@ -0,0 +1,101 @@
+import io
+import os
+import glob
+import tempfile
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+import pytest
+from werkzeug.datastructures import FileStorage
+
+import utils
+import previews
+from extensions import db
+from models import File
+from storage import get_storage
+from utils import save_file
+from previews import get_preview, schedule_previews
+
+def upload_text(user_id, data=b'preview me\n' * 500):
+    file, error = save_file(FileStorage(io.BytesIO(data), filename='notes.txt', content_type='text/plain'), user_id)
+    assert error is None
+    return file.id
+
+class FailingFuture:
+    def __init__(self, error):
+        self.error = error
+        self.cancelled = False
+    
+    def result(self, timeout=None):
+        raise self.error
+    
+    def cancel(self):
+        self.cancelled = True
+        return True
+
+class FailingExecutor:
+    def __init__(self, error):
+        self.future = FailingFuture(error)
+    
+    def submit(self, fn, *args):
+        return self.future
+
+def decoded_copies():
+    return set(glob.glob(os.path.join(tempfile.gettempdir(), '.decoded-*')))
+
+def test_compressed_content_is_rendered_by_the_worker(app, user, monkeypatch):
+    monkeypatch.setitem(app.config, 'STORAGE_COMPRESSION', 'gzip')
+    # Nothing rendering in the background, so any copy left behind is this render's
+    monkeypatch.setattr(utils, 'schedule_previews', lambda file: None)
+    with app.app_context():
+        file = db.session.get(File, upload_text(user.id))
+        assert file.blob.encoding == 'gzip'
+        before = decoded_copies()
+        
+        path = get_preview(file, 128)
+        assert path is not None and os.path.getsize(path) > 0
+        # The worker removed the decompressed copy it made
+        assert decoded_copies() <= before
+
+@pytest.mark.parametrize('error', [FutureTimeoutError(), BrokenProcessPool("worker died")])
+def test_failed_render_means_no_preview(app, user, monkeypatch, error):
+    executor = FailingExecutor(error)
+    monkeypatch.setattr(previews, 'get_executor', lambda: executor)
+    monkeypatch.setattr(previews, '_executor', executor)
+    with app.app_context():
+        file = db.session.get(File, upload_text(user.id))
+        assert get_preview(file, 128) is None
+    if isinstance(error, FutureTimeoutError):
+        assert executor.future.cancelled
+    else:
+        # The broken pool is dropped so the next preview starts a fresh one
+        assert previews._executor is None
+
+class RecordingExecutor:
+    def __init__(self):
+        self.submitted = []
+    
+    def submit(self, fn, *args):
+        self.submitted.append((fn, args))
+
+def test_scheduling_leaves_content_to_the_worker(app, user, monkeypatch):
+    monkeypatch.setitem(app.config, 'STORAGE_COMPRESSION', 'gzip')
+    executor = RecordingExecutor()
+    monkeypatch.setattr(previews, 'get_executor', lambda: executor)
+    
+    def no_reads(*args, **kwargs):
+        raise AssertionError("content read while scheduling previews")
+    
+    with app.app_context():
+        file = db.session.get(File, upload_text(user.id))
+        storage = get_storage()
+        monkeypatch.setattr(storage, 'iter_range', no_reads)
+        monkeypatch.setattr(storage, 'get_local_copy', no_reads)
+        executor.submitted.clear()
+        
+        schedule_previews(file)
+        [(fn, (source, kind, targets))] = executor.submitted
+        assert fn is previews.fetch_and_render
+        assert source[1:] == (file.filename, 'gzip', '.txt')
+        assert kind == 'text'
+        assert [size for _, size in targets] == list(app.config['PREVIEW_SIZES'])
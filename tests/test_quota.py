@@ -0,0 +1,79 @@
+import io
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import select, update, func
+from werkzeug.datastructures import FileStorage
+
+from extensions import db
+from models import User, File, QuotaReservation
+from utils import save_file, delete_file
+
+SIZE = 1000
+FITS = 8
+QUOTA_ERROR = "File exceeds your storage limit"
+
+def run_concurrently(app, tasks, workers=8):
+    """Run each task in a thread of its own app context and return their results"""
+    def run(task):
+        with app.app_context():
+            try:
+                return task()
+            finally:
+                db.session.remove()
+    
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(run, tasks))
+
+def upload(user_id, n):
+    def task():
+        # Distinct content, so deduplication does not short-circuit anything
+        file = FileStorage(
+            io.BytesIO(os.urandom(SIZE)), filename=f"stress-{n}.bin", content_type='application/octet-stream'
+        )
+        _, error = save_file(file, user_id)
+        return error
+    return task
+
+def check_accounting(user_id):
+    """The quota holds, usage is exactly what is stored and no reservation is left over"""
+    used, limit = db.session.execute(
+        select(User.storage_used, User.storage_limit).where(User.id == user_id)
+    ).one()
+    stored = db.session.execute(
+        select(func.coalesce(func.sum(File.size), 0)).where(File.user_id == user_id, File.deleted_at.is_(None))
+    ).scalar()
+    reserved = db.session.execute(select(func.count()).where(QuotaReservation.user_id == user_id)).scalar()
+    assert used <= limit
+    assert used == stored
+    assert reserved == 0
+    return used
+
+def test_concurrent_uploads_never_exceed_quota(app, user):
+    with app.app_context():
+        db.session.execute(update(User).where(User.id == user.id).values(storage_limit=SIZE * FITS))
+        db.session.commit()
+    
+    errors = run_concurrently(app, [upload(user.id, n) for n in range(4 * FITS)])
+    assert set(errors) == {None, QUOTA_ERROR}
+    assert errors.count(None) == FITS
+    with app.app_context():
+        assert check_accounting(user.id) == SIZE * FITS
+
+def test_concurrent_deletes_and_uploads_keep_accounting_exact(app, user):
+    with app.app_context():
+        db.session.execute(update(User).where(User.id == user.id).values(storage_limit=SIZE * FITS))
+        db.session.commit()
+    run_concurrently(app, [upload(user.id, n) for n in range(FITS)])
+    with app.app_context():
+        file_ids = db.session.execute(select(File.id).where(File.user_id == user.id)).scalars().all()
+    
+    def remove(file_id):
+        return lambda: delete_file(file_id, user.id)[1]
+    
+    # Half the files go while twice as many uploads race for the room they free
+    tasks = [remove(file_id) for file_id in file_ids[:FITS // 2]] + [upload(user.id, FITS + n) for n in range(FITS)]
+    errors = run_concurrently(app, tasks)
+    assert set(errors) <= {None, QUOTA_ERROR}
+    with app.app_context():
+        check_accounting(user.id)
@@ -0,0 +1,156 @@
+import os
+
+import pytest
+
+from storage import LocalStorage, S3Storage, S3_MIN_PART_SIZE, get_temp_name
+
+moto = pytest.importorskip('moto')
+
+CHECKSUM = 'ab' * 32
+OTHER_CHECKSUM = 'cd' * 32
+
+@pytest.fixture(params=['local', 's3'])
+def storage(request, tmp_path, monkeypatch):
+    """Each backend behind the same contract; S3 runs against moto's in-process stand-in"""
+    if request.param == 'local':
+        yield LocalStorage(str(tmp_path))
+        return
+    for name in ('AWS_CONFIG_FILE', 'AWS_SHARED_CREDENTIALS_FILE', 'AWS_PROFILE'):
+        monkeypatch.delenv(name, raising=False)
+    with moto.mock_aws():
+        s3 = S3Storage('eforice-test', prefix='files/', region='us-east-1', access_key='testing',
+                       secret_key='testing', part_size=S3_MIN_PART_SIZE)
+        s3.client.create_bucket(Bucket='eforice-test')
+        yield s3
+
+def read(storage, name, start=0, stop=None):
+    return b''.join(storage.iter_range(name, start, stop, chunk_size=3))
+
+def test_write_and_read_ranges(storage):
+    storage.write_chunks(CHECKSUM, [b'hello ', b'world'])
+    assert storage.get_size(CHECKSUM) == 11
+    assert read(storage, CHECKSUM) == b'hello world'
+    assert read(storage, CHECKSUM, 6) == b'world'
+    assert read(storage, CHECKSUM, 2, 8) == b'llo wo'
+    assert read(storage, CHECKSUM, 10, 11) == b'd'
+    assert read(storage, CHECKSUM, 4, 4) == b''
+
+def test_get_size_of_missing_content(storage):
+    assert storage.get_size(CHECKSUM) is None
+    # Deleting what is not there is not an error either
+    storage.delete(CHECKSUM)
+
+def test_rename_moves_content(storage):
+    temp_name = get_temp_name()
+    storage.write_chunks(temp_name, [b'scratch'])
+    storage.rename(temp_name, CHECKSUM)
+    assert storage.get_size(temp_name) is None
+    assert read(storage, CHECKSUM) == b'scratch'
+    
+    # Renaming onto existing content replaces it
+    storage.write_chunks(OTHER_CHECKSUM, [b'other'])
+    storage.rename(OTHER_CHECKSUM, CHECKSUM)
+    assert storage.get_size(OTHER_CHECKSUM) is None
+    assert read(storage, CHECKSUM) == b'other'
+
+def test_delete(storage):
+    storage.write_chunks(CHECKSUM, [b'data'])
+    storage.delete(CHECKSUM)
+    assert storage.get_size(CHECKSUM) is None
+
+def test_put_file_adopts_local_file(storage, tmp_path):
+    local_path = tmp_path / 'incoming'
+    local_path.write_bytes(b'from disk')
+    storage.put_file(str(local_path), CHECKSUM)
+    assert not local_path.exists()
+    assert read(storage, CHECKSUM) == b'from disk'
+
+def test_put_fileobj(storage, tmp_path):
+    local_path = tmp_path / 'incoming'
+    local_path.write_bytes(b'from a stream')
+    with open(local_path, 'rb') as fileobj:
+        storage.put_fileobj(fileobj, CHECKSUM)
+    assert read(storage, CHECKSUM) == b'from a stream'
+
+def test_fetch_gives_a_local_file(storage):
+    storage.write_chunks(CHECKSUM, [b'local copy'])
+    with storage.fetch(CHECKSUM) as path:
+        with open(path, 'rb') as f:
+            assert f.read() == b'local copy'
+    if storage.get_local_path(CHECKSUM) is None:
+        # Temporary copies are removed afterwards
+        assert not os.path.exists(path)
+
+def test_iter_entries_lists_everything(storage):
+    names = {format(i, '064x'): i + 1 for i in range(7)}
+    for name, size in names.items():
+        storage.write_chunks(name, [b'x' * size])
+    temp_name = get_temp_name()
+    storage.write_chunks(temp_name, [b'partial'])
+    
+    entries = {name: size for name, size, mtime in storage.iter_entries()}
+    assert entries == {**names, temp_name: 7}
+
+def test_s3_iter_entries_follows_pages(storage, monkeypatch):
+    if not isinstance(storage, S3Storage):
+        pytest.skip('S3 only')
+    names = [format(i, '064x') for i in range(7)]
+    for name in names:
+        storage.write_chunks(name, [b'x'])
+    
+    # Small pages, so the listing has to follow continuation tokens
+    pages = []
+    get_paginator = storage.client.get_paginator
+    
+    class SmallPages:
+        def __init__(self, operation):
+            self.paginator = get_paginator(operation)
+        
+        def paginate(self, **kwargs):
+            for page in self.paginator.paginate(PaginationConfig={'PageSize': 2}, **kwargs):
+                pages.append(page)
+                yield page
+    
+    monkeypatch.setattr(storage.client, 'get_paginator', SmallPages)
+    assert sorted(name for name, size, mtime in storage.iter_entries()) == names
+    assert len(pages) == 4
+
+def test_s3_write_chunks_uses_multipart_upload(storage, monkeypatch):
+    if not isinstance(storage, S3Storage):
+        pytest.skip('S3 only')
+    parts = []
+    upload_part = storage.upload_part
+    
+    def count_parts(key, upload_id, number, data):
+        parts.append(len(data))
+        return upload_part(key, upload_id, number, data)
+    
+    monkeypatch.setattr(storage, 'upload_part', count_parts)
+    chunk = os.urandom(1024 * 1024)
+    storage.write_chunks(CHECKSUM, [chunk] * 11)
+    
+    assert parts == [5 * len(chunk), 5 * len(chunk), len(chunk)]
+    assert storage.get_size(CHECKSUM) == 11 * len(chunk)
+    assert read(storage, CHECKSUM, 5 * len(chunk) - 2, 5 * len(chunk) + 2) == chunk[-2:] + chunk[:2]
+
+def test_s3_failed_multipart_upload_is_aborted(storage):
+    if not isinstance(storage, S3Storage):
+        pytest.skip('S3 only')
+    
+    def chunks():
+        yield b'x' * S3_MIN_PART_SIZE
+        raise IOError('client went away')
+    
+    with pytest.raises(IOError):
+        storage.write_chunks(CHECKSUM, chunks())
+    assert storage.get_size(CHECKSUM) is None
+    assert not storage.client.list_multipart_uploads(Bucket='eforice-test').get('Uploads')
+
+def test_s3_download_url_is_presigned(storage):
+    if not isinstance(storage, S3Storage):
+        assert storage.get_download_url(CHECKSUM, 'a.txt', 'text/plain') is None
+        return
+    url = storage.get_download_url(CHECKSUM, 'a.txt', 'text/plain', encoding='gzip')
+    assert storage.get_key(CHECKSUM) in url
+    assert 'X-Amz-Signature=' in url
+    assert 'response-content-encoding=gzip' in url
@@ -0,0 +1,148 @@
+import io
+import os
+
+import uploads
+from extensions import db
+from models import File, UploadSession
+from storage import get_storage
+from uploads import create_upload_session, write_chunk, finalize_upload, get_upload_session, set_finalizing
+
+def start_upload(user_id, data):
+    session, error = create_upload_session(user_id, 'notes.txt', len(data))
+    assert error is None
+    assert write_chunk(session, 0, io.BytesIO(data)) == (True, None)
+    return session.id
+
+def test_finalize_stores_file_and_removes_scratch(app, user):
+    with app.app_context():
+        session_id = start_upload(user.id, b'chunked content')
+        session = get_upload_session(session_id, user.id)
+        path = session.get_path()
+        
+        file, error = finalize_upload(session)
+        assert error is None
+        assert b''.join(get_storage().iter_range(file.filename)) == b'chunked content'
+        assert db.session.get(UploadSession, session_id) is None
+        assert not os.path.exists(path)
+        assert not os.path.exists(path + '.store')
+
+def test_failed_finalize_can_be_retried(app, user, monkeypatch):
+    with app.app_context():
+        session_id = start_upload(user.id, b'retry me')
+        
+        def fail(*args, **kwargs):
+            raise RuntimeError("journal write failed")
+        
+        add_file_record = uploads.add_file_record
+        monkeypatch.setattr(uploads, 'add_file_record', fail)
+        file, error = finalize_upload(get_upload_session(session_id, user.id))
+        assert (file, error) == (None, "journal write failed")
+        
+        # The session and its scratch file survive the rollback
+        session = get_upload_session(session_id, user.id)
+        assert session is not None
+        assert os.path.exists(session.get_path())
+        assert not os.path.exists(session.get_path() + '.store')
+        assert File.query.count() == 0
+        
+        monkeypatch.setattr(uploads, 'add_file_record', add_file_record)
+        file, error = finalize_upload(session)
+        assert error is None
+        assert b''.join(get_storage().iter_range(file.filename)) == b'retry me'
+
+def read_scratch(session):
+    with open(session.get_path(), 'rb') as f:
+        return f.read()
+
+def test_chunks_are_checked_before_anything_is_written(app, user, monkeypatch):
+    monkeypatch.setitem(app.config, 'UPLOAD_SESSION_CHUNK_SIZE', 4)
+    with app.app_context():
+        session, error = create_upload_session(user.id, 'notes.txt', 10)
+        assert error is None
+        assert write_chunk(session, 1, io.BytesIO(b'bbbb')) == (True, None)
+        
+        # Too long, too short or declared with the wrong length: nothing lands in the file
+        assert write_chunk(session, 0, io.BytesIO(b'aaaaXX'))[0] is False
+        assert write_chunk(session, 2, io.BytesIO(b'c'))[0] is False
+        assert write_chunk(session, 0, io.BytesIO(b'aaaa'), length=6)[0] is False
+        assert read_scratch(session) == b'\0\0\0\0bbbb\0\0'
+        
+        # A recorded chunk can be sent again, but not changed
+        assert write_chunk(session, 1, io.BytesIO(b'bbbb')) == (True, None)
+        assert write_chunk(session, 1, io.BytesIO(b'BBBB')) == (
+            False, "Chunk 1 was already received with different content"
+        )
+        assert read_scratch(session) == b'\0\0\0\0bbbb\0\0'
+
+def test_chunks_are_refused_while_finalizing(app, user):
+    with app.app_context():
+        session_id = start_upload(user.id, b'final')
+        session = get_upload_session(session_id, user.id)
+        assert set_finalizing(session_id, True)
+        assert not set_finalizing(session_id, True)
+        assert write_chunk(session, 0, io.BytesIO(b'FINAL')) == (False, "Upload is already being completed")
+        assert finalize_upload(session) == (None, "Upload is already being completed")
+        assert read_scratch(session) == b'final'
+
+def test_failed_finalize_accepts_chunks_again(app, user):
+    with app.app_context():
+        session, error = create_upload_session(user.id, 'notes.txt', 5)
+        assert error is None
+        assert finalize_upload(session) == (None, "1 chunks are still missing")
+        assert write_chunk(session, 0, io.BytesIO(b'later')) == (True, None)
+        file, error = finalize_upload(session)
+        assert error is None
+        assert b''.join(get_storage().iter_range(file.filename)) == b'later'
+
+class CountingStream(io.BytesIO):
+    """A request body that records how much of it was read"""
+    
+    consumed = 0
+    
+    def read(self, size=-1):
+        data = super().read(size)
+        self.consumed += len(data)
+        return data
+    
+    def readline(self, size=-1):
+        data = super().readline(size)
+        self.consumed += len(data)
+        return data
+    
+    def readinto(self, buffer):
+        count = super().readinto(buffer)
+        self.consumed += count
+        return count
+
+def multipart_body(data):
+    return (
+        b'--boundary\r\nContent-Disposition: form-data; name="file"; filename="big.bin"\r\n'
+        b'Content-Type: application/octet-stream\r\n\r\n' + data + b'\r\n--boundary--\r\n'
+    )
+
+def post_upload(client, body, headers=None, **environ):
+    return client.post(
+        '/files/upload', input_stream=body, content_type='multipart/form-data; boundary=boundary',
+        headers=headers, environ_overrides=environ
+    )
+
+def test_oversized_upload_is_refused_before_the_body_is_read(client):
+    data = multipart_body(b'x' * 200 * 1024)
+    body = CountingStream(data)
+    response = post_upload(client, body, CONTENT_LENGTH=str(len(data)))
+    assert response.status_code == 413
+    assert body.consumed == 0
+
+def test_oversized_chunked_upload_stops_at_the_quota(client):
+    data = multipart_body(b'x' * 1024 * 1024)
+    body = CountingStream(data)
+    response = post_upload(client, body, {'Transfer-Encoding': 'chunked'}, **{'wsgi.input_terminated': True})
+    assert response.status_code == 413
+    assert body.consumed < len(data) // 2
+
+def test_upload_within_quota_is_stored(app, user, client):
+    data = multipart_body(b'small file')
+    response = post_upload(client, CountingStream(data), CONTENT_LENGTH=str(len(data)))
+    assert response.status_code == 302
+    with app.app_context():
+        assert [file.original_filename for file in File.query.filter_by(user_id=user.id)] == ['big.bin']
@@ -0,0 +1,232 @@
+import time
+import functools
+import threading
+from flask import current_app, request, jsonify
+from flask_login import current_user
+from werkzeug.wsgi import ClosingIterator, FileWrapper
+
+class TransferRejected(Exception):
+    """A transfer was refused admission; the client should retry after `retry_after` seconds"""
+    
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class TokenBucket:
+    """Byte-rate limiter: `rate` bytes per second with bursts of up to `burst` bytes"""
+    
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+    
+    def consume(self, amount):
+        """Take `amount` bytes worth of tokens and return how long to wait before sending them.
+        
+        The bucket may go into debt, so one large read is paid for by a longer
+        wait rather than refused.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= amount
+            return -self.tokens / self.rate if self.tokens < 0 else 0
+
+class ThrottledStream:
+    """Read-only stream wrapper that paces reads through a token bucket"""
+    
+    def __init__(self, stream, bucket):
+        self.stream = stream
+        self.bucket = bucket
+    
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.wait(len(data))
+        return data
+    
+    def readline(self, size=-1):
+        data = self.stream.readline(size)
+        self.wait(len(data))
+        return data
+    
+    def wait(self, amount):
+        delay = self.bucket.consume(amount) if amount else 0
+        if delay:
+            time.sleep(delay)
+
+class UserTransfers:
+    """Transfers in progress for one user, and the bucket they share"""
+    
+    def __init__(self):
+        self.active = 0
+        self.bucket = None
+
+class Transfer:
+    """An admitted transfer, holding a global slot and one of its user's slots until released"""
+    
+    def __init__(self, controller, user_id, bucket):
+        self.controller = controller
+        self.user_id = user_id
+        self.bucket = bucket
+        self.released = False
+    
+    def throttle_chunks(self, chunks):
+        """Pace a response body through the user's bucket, closing the original when done"""
+        try:
+            for chunk in chunks:
+                delay = self.bucket.consume(len(chunk))
+                if delay:
+                    time.sleep(delay)
+                yield chunk
+        finally:
+            if hasattr(chunks, 'close'):
+                chunks.close()
+    
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.controller.release(self)
+
+class AdmissionController:
+    """Admission control for uploads and downloads in this process.
+    
+    Each user gets a byte-rate bucket and a cap on concurrent transfers.
+    Transfers also share a global pool of in-flight slots. A request that
+    finds the pool full waits in a bounded queue for a while before it is
+    turned away.
+    """
+    
+    def __init__(self, max_in_flight, queue_size, queue_timeout, retry_after):
+        self.slots = threading.BoundedSemaphore(max_in_flight)
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.waiting = 0
+        self.users = {}
+        self.lock = threading.Lock()
+    
+    def admit(self, user_id, rate, max_transfers):
+        """Admit a transfer for a user, raising TransferRejected when it cannot go ahead now"""
+        with self.lock:
+            state = self.users.setdefault(user_id, UserTransfers())
+            if max_transfers and state.active >= max_transfers:
+                raise TransferRejected(
+                    f"Too many transfers in progress (at most {max_transfers} at once)", self.retry_after
+                )
+            if self.waiting >= self.queue_size:
+                raise TransferRejected("The server is busy, please retry shortly", self.retry_after)
+            state.active += 1
+            self.waiting += 1
+        
+        try:
+            admitted = self.slots.acquire(timeout=self.queue_timeout)
+        finally:
+            with self.lock:
+                self.waiting -= 1
+        if not admitted:
+            with self.lock:
+                state.active -= 1
+            raise TransferRejected("The server is busy, please retry shortly", self.retry_after)
+        
+        with self.lock:
+            if not rate:
+                state.bucket = None
+            elif state.bucket is None:
+                state.bucket = TokenBucket(rate, rate)
+            else:
+                # The limit may have been changed by an admin since the last transfer
+                state.bucket.rate = state.bucket.burst = rate
+            return Transfer(self, user_id, state.bucket)
+    
+    def release(self, transfer):
+        with self.lock:
+            self.users[transfer.user_id].active -= 1
+        self.slots.release()
+    
+    def get_status(self):
+        with self.lock:
+            return {
+                'waiting': self.waiting,
+                'active': sum(state.active for state in self.users.values()),
+                'active_by_user': {user_id: state.active for user_id, state in self.users.items() if state.active},
+            }
+
+def get_controller():
+    """Get the admission controller of the current app, creating it on first use"""
+    controller = current_app.extensions.get('throttle')
+    if controller is None:
+        config = current_app.config
+        controller = current_app.extensions['throttle'] = AdmissionController(
+            config.get('TRANSFER_MAX_IN_FLIGHT', 32),
+            config.get('TRANSFER_QUEUE_SIZE', 64),
+            config.get('TRANSFER_QUEUE_TIMEOUT', 10),
+            config.get('TRANSFER_RETRY_AFTER', 5)
+        )
+    return controller
+
+def get_user_limits(user):
+    """Get (bytes per second, concurrent transfers) for a user; falsy values mean unlimited"""
+    rate = user.bandwidth_limit
+    if rate is None:
+        rate = current_app.config.get('DEFAULT_BANDWIDTH_LIMIT', 0)
+    max_transfers = user.max_transfers
+    if max_transfers is None:
+        max_transfers = current_app.config.get('DEFAULT_MAX_TRANSFERS', 4)
+    return rate, max_transfers
+
+def release_after(close, release):
+    """Chain `release` after a response body's own close method, which may be None"""
+    def closing():
+        try:
+            if close is not None:
+                close()
+        finally:
+            release()
+    return closing
+
+def limit_transfer(view):
+    """Admit a transfer view through the admission controller and pace its bytes.
+    
+    The request body is throttled before the view parses it, and the
+    response body as it is sent. The slots are held until the response has
+    been fully sent.
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        rate, max_transfers = get_user_limits(current_user)
+        try:
+            transfer = get_controller().admit(current_user.id, rate, max_transfers)
+        except TransferRejected as e:
+            response = jsonify({'error': str(e)})
+            response.status_code = 429
+            response.headers['Retry-After'] = str(e.retry_after)
+            return response
+        
+        try:
+            if transfer.bucket is not None:
+                request.environ['wsgi.input'] = ThrottledStream(request.environ['wsgi.input'], transfer.bucket)
+            response = current_app.make_response(view(*args, **kwargs))
+        except BaseException:
+            transfer.release()
+            raise
+        
+        if transfer.bucket is not None:
+            if 'X-Accel-Redirect' in response.headers:
+                # nginx sends the body, so it applies the rate itself
+                response.headers['X-Accel-Limit-Rate'] = str(int(transfer.bucket.rate))
+            elif not response.is_sequence:
+                response.response = transfer.throttle_chunks(response.response)
+        response.call_on_close(transfer.release)
+        if response.direct_passthrough and not response.is_sequence:
+            # The server closes a passed-through body itself, bypassing the response's close callbacks
+            body = response.response
+            if isinstance(body, (FileWrapper, request.environ.get('wsgi.file_wrapper', FileWrapper))):
+                # Servers only sendfile() their own file wrapper, so chain onto its close rather than wrap it
+                body.close = release_after(getattr(body, 'close', None), transfer.release)
+            else:
+                response.response = ClosingIterator(body, transfer.release)
+        return response
+    return wrapper
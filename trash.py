@@ -0,0 +1,293 @@
+import os
+import time
+import fcntl
+import logging
+import threading
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import select, update, delete, or_, and_, func
+from sqlalchemy.orm import aliased
+
+from app import db
+from models import File, Folder, FolderClosure
+from utils import adjust_folder_sizes, bump_root_version, bulk_delete_folders
+from quota import charge_quota, credit_quota, expire_reservations
+from stats import count_files, count_matching_files, count_folders
+from blobstore import release_blobs, delete_contents
+from uploads import expire_upload_sessions
+from changes import record_change, compact_changes
+
+# Items are hidden and purged once they have been in the trash this long;
+# emptying the trash backdates items to this so the purge worker takes them
+EXPIRED = datetime(1970, 1, 1)
+
+def get_trash_cutoff():
+    """Get the time before which trashed items are due for purging"""
+    return datetime.utcnow() - timedelta(days=current_app.config.get('TRASH_RETENTION_DAYS', 30))
+
+def trash_file(file_id, user_id):
+    """Move a file to the trash, releasing its space from the quota and folder sizes"""
+    try:
+        file = File.query.filter_by(id=file_id, user_id=user_id, deleted_at=None).first()
+        if not file:
+            return False, "File not found"
+        
+        # date_modified is carried over so trashing does not count as a content change
+        db.session.execute(
+            update(File).where(File.id == file.id)
+            .values(deleted_at=datetime.utcnow(), date_modified=File.date_modified)
+        )
+        credit_quota(user_id, file.size)
+        count_files(user_id, file.file_type, -file.size, -1)
+        if file.folder_id:
+            adjust_folder_sizes(file.folder_id, -file.size)
+        bump_root_version(user_id)
+        record_change(user_id, 'delete', 'file', file.id, file.folder_id, file.original_filename, file.size)
+        db.session.commit()
+        return True, None
+    except Exception as e:
+        db.session.rollback()
+        logging.error(f"Error trashing file: {str(e)}")
+        return False, str(e)
+
+def trash_folder(folder_id, user_id):
+    """Move a folder and everything below it to the trash"""
+    try:
+        folder = Folder.query.filter_by(id=folder_id, user_id=user_id, deleted_at=None).first()
+        if not folder:
+            return False, "Folder not found"
+        
+        # Everything trashed together shares one timestamp so it can be restored together
+        now = datetime.utcnow()
+        subtree = select(FolderClosure.descendant_id).where(FolderClosure.ancestor_id == folder.id)
+        count_matching_files(user_id, and_(File.folder_id.in_(subtree), File.deleted_at.is_(None)), -1)
+        count_folders(user_id, -db.session.execute(
+            select(func.count()).where(Folder.id.in_(subtree), Folder.deleted_at.is_(None))
+        ).scalar())
+        db.session.execute(
+            update(Folder).where(Folder.id.in_(subtree), Folder.deleted_at.is_(None))
+            .values(deleted_at=now).execution_options(synchronize_session=False)
+        )
+        db.session.execute(
+            update(File).where(File.folder_id.in_(subtree), File.deleted_at.is_(None))
+            .values(deleted_at=now, date_modified=File.date_modified)
+            .execution_options(synchronize_session=False)
+        )
+        
+        # The folder's size already excludes anything trashed earlier
+        credit_quota(user_id, folder.size)
+        if folder.parent_id:
+            adjust_folder_sizes(folder.parent_id, -folder.size)
+        bump_root_version(user_id)
+        record_change(user_id, 'delete', 'folder', folder.id, folder.parent_id, folder.name)
+        db.session.commit()
+        return True, None
+    except Exception as e:
+        db.session.rollback()
+        logging.error(f"Error trashing folder: {str(e)}")
+        return False, str(e)
+
+def restore_file(file_id, user_id):
+    """Bring a file back from the trash"""
+    try:
+        file = File.query.filter(
+            File.id == file_id, File.user_id == user_id, File.deleted_at >= get_trash_cutoff()
+        ).first()
+        if not file:
+            return False, "File not found in trash"
+        if file.folder_id and file.folder.deleted_at is not None:
+            return False, "Restore the folder it was in first"
+        
+        # Charged atomically, so restores racing uploads cannot overshoot the quota
+        if not charge_quota(user_id, file.size):
+            db.session.rollback()
+            return False, "Not enough storage left to restore this file"
+        db.session.execute(
+            update(File).where(File.id == file.id)
+            .values(deleted_at=None, date_modified=File.date_modified)
+        )
+        count_files(user_id, file.file_type, file.size, 1)
+        if file.folder_id:
+            adjust_folder_sizes(file.folder_id, file.size)
+        bump_root_version(user_id)
+        record_change(user_id, 'create', 'file', file.id, file.folder_id, file.original_filename, file.size)
+        db.session.commit()
+        return True, None
+    except Exception as e:
+        db.session.rollback()
+        logging.error(f"Error restoring file: {str(e)}")
+        return False, str(e)
+
+def restore_folder(folder_id, user_id):
+    """Bring a folder back from the trash along with everything trashed with it"""
+    try:
+        folder = Folder.query.filter(
+            Folder.id == folder_id, Folder.user_id == user_id, Folder.deleted_at >= get_trash_cutoff()
+        ).first()
+        if not folder:
+            return False, "Folder not found in trash"
+        if folder.parent_id and folder.parent.deleted_at is not None:
+            return False, "Restore the folder it was in first"
+        if not charge_quota(user_id, folder.size):
+            db.session.rollback()
+            return False, "Not enough storage left to restore this folder"
+        
+        # Items trashed separately before the folder stay in the trash
+        trashed_at = folder.deleted_at
+        subtree = select(FolderClosure.descendant_id).where(FolderClosure.ancestor_id == folder.id)
+        count_matching_files(user_id, and_(File.folder_id.in_(subtree), File.deleted_at == trashed_at), 1)
+        count_folders(user_id, db.session.execute(
+            select(func.count()).where(Folder.id.in_(subtree), Folder.deleted_at == trashed_at)
+        ).scalar())
+        db.session.execute(
+            update(Folder).where(Folder.id.in_(subtree), Folder.deleted_at == trashed_at)
+            .values(deleted_at=None).execution_options(synchronize_session=False)
+        )
+        db.session.execute(
+            update(File).where(File.folder_id.in_(subtree), File.deleted_at == trashed_at)
+            .values(deleted_at=None, date_modified=File.date_modified)
+            .execution_options(synchronize_session=False)
+        )
+        
+        if folder.parent_id:
+            adjust_folder_sizes(folder.parent_id, folder.size)
+        bump_root_version(user_id)
+        record_change(user_id, 'create', 'folder', folder.id, folder.parent_id, folder.name)
+        db.session.commit()
+        return True, None
+    except Exception as e:
+        db.session.rollback()
+        logging.error(f"Error restoring folder: {str(e)}")
+        return False, str(e)
+
+def empty_trash(user_id):
+    """Expire everything in a user's trash; the purge worker removes it in the background"""
+    try:
+        db.session.execute(
+            update(Folder).where(Folder.user_id == user_id, Folder.deleted_at.is_not(None))
+            .values(deleted_at=EXPIRED).execution_options(synchronize_session=False)
+        )
+        db.session.execute(
+            update(File).where(File.user_id == user_id, File.deleted_at.is_not(None))
+            .values(deleted_at=EXPIRED, date_modified=File.date_modified)
+            .execution_options(synchronize_session=False)
+        )
+        db.session.commit()
+        return True, None
+    except Exception as e:
+        db.session.rollback()
+        logging.error(f"Error emptying trash: {str(e)}")
+        return False, str(e)
+
+def get_trash_contents(user_id):
+    """Get the trashed files and folders a user can restore, excluding items inside trashed folders"""
+    cutoff = get_trash_cutoff()
+    parent = aliased(Folder)
+    folders = Folder.query.outerjoin(parent, Folder.parent_id == parent.id).filter(
+        Folder.user_id == user_id,
+        Folder.deleted_at >= cutoff,
+        or_(parent.id.is_(None), parent.deleted_at.is_(None))
+    ).order_by(Folder.deleted_at.desc()).all()
+    files = File.query.outerjoin(Folder, File.folder_id == Folder.id).filter(
+        File.user_id == user_id,
+        File.deleted_at >= cutoff,
+        or_(Folder.id.is_(None), Folder.deleted_at.is_(None))
+    ).order_by(File.deleted_at.desc()).all()
+    return folders, files
+
+def purge_trash(cutoff, batch_size):
+    """Permanently delete one batch of items trashed before `cutoff` and return how many went"""
+    unused_names = []
+    
+    # Whole trashed folders, with their contents, grouped per owner
+    folders = db.session.execute(
+        select(Folder.id, Folder.user_id).where(Folder.deleted_at < cutoff).limit(batch_size)
+    ).all()
+    folder_ids_by_user = {}
+    for folder_id, user_id in folders:
+        folder_ids_by_user.setdefault(user_id, []).append(folder_id)
+    for user_id, folder_ids in folder_ids_by_user.items():
+        unused_names += bulk_delete_folders(folder_ids, user_id)
+    
+    # Files trashed on their own
+    files = db.session.execute(
+        select(File.id, File.blob_id, File.filename).where(File.deleted_at < cutoff).limit(batch_size)
+    ).all()
+    if files:
+        db.session.execute(
+            delete(File).where(File.id.in_([file_id for file_id, _, _ in files]))
+            .execution_options(synchronize_session=False)
+        )
+        ref_counts = {}
+        for _, blob_id, filename in files:
+            if blob_id:
+                ref_counts[blob_id] = ref_counts.get(blob_id, 0) + 1
+            else:
+                unused_names.append(filename)
+        unused_names += release_blobs(ref_counts, batch_size)
+    
+    db.session.commit()
+    delete_contents(unused_names)
+    return len(folders) + len(files)
+
+def purge_expired_trash():
+    """Purge everything past the retention period in rate-limited batches.
+    
+    Only one process purges at a time; others return 0 straight away.
+    """
+    lock_path = os.path.join(current_app.config['UPLOAD_FOLDER'], '.trash-purge.lock')
+    with open(lock_path, 'w') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return 0
+        
+        cutoff = get_trash_cutoff()
+        batch_size = current_app.config.get('TRASH_PURGE_BATCH_SIZE', 200)
+        pause = current_app.config.get('TRASH_PURGE_PAUSE', 0.5)
+        purged = 0
+        while True:
+            count = purge_trash(cutoff, batch_size)
+            purged += count
+            if not count:
+                break
+            time.sleep(pause)
+        return purged
+
+def run_purge_worker(app):
+    """Purge expired trash, abandoned uploads and old change journal entries periodically for the lifetime of the process"""
+    while True:
+        with app.app_context():
+            try:
+                purged = purge_expired_trash()
+                if purged:
+                    logging.info(f"Purged {purged} items from the trash")
+                expired = expire_upload_sessions()
+                if expired:
+                    logging.info(f"Discarded {expired} abandoned upload sessions")
+                released = expire_reservations()
+                if released:
+                    logging.info(f"Released {released} expired quota reservations")
+                compacted = compact_changes()
+                if compacted:
+                    logging.info(f"Compacted {compacted} change journal entries")
+            except Exception as e:
+                db.session.rollback()
+                logging.error(f"Error purging trash: {str(e)}")
+            finally:
+                db.session.remove()
+        time.sleep(app.config.get('TRASH_PURGE_INTERVAL', 300))
+
+def init_purge_worker(app):
+    """Start the purge worker with the first request a serving process handles"""
+    state = {'started': False}
+    lock = threading.Lock()
+    
+    @app.before_request
+    def start_purge_worker():
+        if state['started'] or not app.config.get('TRASH_PURGE_INTERVAL'):
+            return
+        with lock:
+            if not state['started']:
+                threading.Thread(target=run_purge_worker, args=(app,), name='trash-purge', daemon=True).start()
+                state['started'] = True
@@ -0,0 +1,267 @@
+import os
+import uuid
+import logging
+import mimetypes
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import select, update, delete
+from sqlalchemy.exc import IntegrityError
+
+from app import db
+from models import Folder, UploadSession, UploadChunk
+from utils import add_file_record, get_file_type
+from quota import QuotaExceededError, reserve_quota, refresh_reservation, release_reservation
+from blobstore import hash_file, store_file, link_for_store, unlink_paths
+from auth import get_user
+from compression import is_compressible
+from previews import schedule_previews
+from metrics import record_transfer
+
+def get_upload_session(session_id, user_id):
+    """Get one of a user's upload sessions, or None"""
+    return UploadSession.query.filter_by(id=session_id, user_id=user_id).first()
+
+def get_received_chunks(session):
+    """Get the sorted indexes of the chunks of a session received so far"""
+    return db.session.execute(
+        select(UploadChunk.index).where(UploadChunk.session_id == session.id).order_by(UploadChunk.index)
+    ).scalars().all()
+
+def create_upload_session(user_id, filename, total_size, folder_id=None, mimetype=None):
+    """Start a resumable upload and preallocate the file its chunks are written into"""
+    session = None
+    try:
+        if not filename or total_size is None or total_size < 0:
+            return None, "A file name and size are required"
+        if folder_id and not Folder.query.filter_by(id=folder_id, user_id=user_id, deleted_at=None).first():
+            return None, "Folder not found"
+        
+        chunk_size = current_app.config.get('UPLOAD_SESSION_CHUNK_SIZE', 8 * 1024 * 1024)
+        session = UploadSession(
+            id=str(uuid.uuid4()),
+            user_id=user_id,
+            folder_id=folder_id,
+            filename=filename,
+            mimetype=mimetype or mimetypes.guess_type(filename)[0] or 'application/octet-stream',
+            total_size=total_size,
+            chunk_size=chunk_size,
+            chunk_count=-(-total_size // chunk_size)
+        )
+        
+        # The whole size is reserved up front, on a connection of its own, and stays charged
+        # while the chunks arrive
+        db.session.commit()
+        ttl = current_app.config.get('UPLOAD_SESSION_TTL', 86400)
+        session.reservation_id = reserve_quota(user_id, total_size, ttl=2 * ttl) if total_size else None
+        if total_size and session.reservation_id is None:
+            return None, "File exceeds your storage limit"
+        
+        # A sparse file of the final size: chunks land at their offset and
+        # finalizing only has to rename it into the blob store
+        with open(session.get_path(), 'wb') as f:
+            f.truncate(total_size)
+        
+        db.session.add(session)
+        db.session.commit()
+        return session, None
+    except Exception as e:
+        db.session.rollback()
+        if session is not None and session.reservation_id:
+            release_reservation(session.reservation_id)
+        logging.error(f"Error creating upload session: {str(e)}")
+        return None, str(e)
+
+def read_chunk(stream, length):
+    """Read exactly `length` bytes of a chunk, or return None if the body is shorter or longer"""
+    read_size = current_app.config.get('UPLOAD_CHUNK_SIZE', 1024 * 1024)
+    data = bytearray()
+    while len(data) <= length:
+        block = stream.read(min(read_size, length - len(data) + 1))
+        if not block:
+            break
+        data += block
+    return bytes(data) if len(data) == length else None
+
+def lock_for_chunk(session_id):
+    """Lock an upload session's row until the caller commits, unless it is being finalized"""
+    return db.session.execute(
+        update(UploadSession).where(UploadSession.id == session_id, UploadSession.finalizing.is_(False))
+        .values(date_updated=datetime.utcnow()).execution_options(synchronize_session=False)
+    ).rowcount == 1
+
+def write_chunk(session, index, stream, length=None):
+    """Write one chunk of an upload at its offset. Chunks may arrive in any order, in parallel or again.
+    
+    Nothing touches the scratch file until the whole chunk has arrived with
+    the right length. A chunk already recorded is only accepted again with
+    the same bytes, and none is accepted once finalizing has started.
+    """
+    try:
+        if not 0 <= index < session.chunk_count:
+            return False, "Invalid chunk index"
+        expected = session.get_chunk_length(index)
+        if length is not None and length != expected:
+            return False, f"Chunk {index} must be exactly {expected} bytes"
+        data = read_chunk(stream, expected)
+        if data is None:
+            return False, f"Chunk {index} must be exactly {expected} bytes"
+        record_transfer('in', len(data))
+        
+        # Finalize takes the same row, so it cannot start while this chunk is written
+        if not lock_for_chunk(session.id):
+            db.session.rollback()
+            return False, "Upload is already being completed"
+        try:
+            with db.session.begin_nested():
+                db.session.add(UploadChunk(session_id=session.id, index=index))
+            recorded = False
+        except IntegrityError:
+            recorded = True
+        
+        with open(session.get_path(), 'r+b') as f:
+            f.seek(index * session.chunk_size)
+            if recorded:
+                # Sent again after a dropped connection: fine as long as nothing changes
+                if f.read(expected) != data:
+                    db.session.rollback()
+                    return False, f"Chunk {index} was already received with different content"
+            else:
+                f.write(data)
+        if session.reservation_id:
+            refresh_reservation(session.reservation_id, ttl=2 * current_app.config.get('UPLOAD_SESSION_TTL', 86400))
+        db.session.commit()
+        return True, None
+    except FileNotFoundError:
+        db.session.rollback()
+        return False, "Upload session has expired"
+    except Exception as e:
+        db.session.rollback()
+        logging.error(f"Error writing upload chunk: {str(e)}")
+        return False, str(e)
+
+def set_finalizing(session_id, finalizing):
+    """Mark an upload session as being finalized, or no longer. Returns False if it already was."""
+    changed = db.session.execute(
+        update(UploadSession).where(UploadSession.id == session_id, UploadSession.finalizing.is_not(finalizing))
+        .values(finalizing=finalizing, date_updated=datetime.utcnow()).execution_options(synchronize_session=False)
+    ).rowcount
+    db.session.commit()
+    return changed == 1
+
+def finalize_upload(session):
+    """Turn a fully received upload into a stored file, with the same accounting as save_file.
+    
+    Chunks are refused from the start, so the content hashed and linked into
+    storage cannot change underneath; a failed attempt lets them in again.
+    """
+    session_id = session.id
+    try:
+        if not set_finalizing(session_id, True):
+            return None, "Upload is already being completed"
+    except Exception as e:
+        db.session.rollback()
+        logging.error(f"Error finalizing upload: {str(e)}")
+        return None, str(e)
+    
+    new_file, error = store_upload(session)
+    if error:
+        try:
+            set_finalizing(session_id, False)
+        except Exception as e:
+            db.session.rollback()
+            logging.error(f"Error reopening upload session {session_id}: {str(e)}")
+    return new_file, error
+
+def store_upload(session):
+    """Store the content of a session being finalized and delete the session"""
+    store_path = None
+    try:
+        received = db.session.execute(
+            select(db.func.count()).where(UploadChunk.session_id == session.id)
+        ).scalar()
+        if received < session.chunk_count:
+            return None, f"{session.chunk_count - received} chunks are still missing"
+        
+        # Chunks can arrive in any order, so the checksum is only known once all are in
+        path = session.get_path()
+        file_size, checksum = hash_file(path)
+        if file_size != session.total_size:
+            return None, "Uploaded data does not match the declared size"
+        
+        # The session goes in the same transaction as the file record
+        claimed = db.session.execute(
+            delete(UploadSession).where(UploadSession.id == session.id)
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        if not claimed:
+            db.session.rollback()
+            return None, "Upload session not found"
+        db.session.execute(delete(UploadChunk).where(UploadChunk.session_id == session.id))
+        
+        user = get_user(session.user_id)
+        folder_id = session.folder_id
+        if folder_id and not Folder.query.filter_by(id=folder_id, user_id=user.id, deleted_at=None).first():
+            db.session.rollback()
+            return None, "Folder not found"
+        
+        # The assembled file moves into storage and becomes the blob, or is dropped as a duplicate.
+        # Storage consumes a second link to it, so until the commit a retry still finds the original.
+        compress = is_compressible(get_file_type(session.filename))
+        store_path = link_for_store(path)
+        blob = store_file(store_path, file_size, checksum, compress=compress)
+        new_file = add_file_record(
+            user, blob, file_size, session.filename, session.mimetype, folder_id,
+            reservation_id=session.reservation_id
+        )
+        db.session.commit()
+        unlink_paths([path])
+        
+        schedule_previews(new_file)
+        return new_file, None
+    except QuotaExceededError as e:
+        db.session.rollback()
+        unlink_paths([store_path])
+        return None, str(e)
+    except Exception as e:
+        db.session.rollback()
+        unlink_paths([store_path])
+        logging.error(f"Error finalizing upload: {str(e)}")
+        return None, str(e)
+
+def cancel_upload(session):
+    """Abandon an upload and remove what was received"""
+    try:
+        path = session.get_path()
+        reservation_id = session.reservation_id
+        db.session.delete(session)
+        db.session.commit()
+        if reservation_id:
+            release_reservation(reservation_id)
+        unlink_paths([path])
+        return True, None
+    except Exception as e:
+        db.session.rollback()
+        logging.error(f"Error cancelling upload: {str(e)}")
+        return False, str(e)
+
+def expire_upload_sessions():
+    """Remove upload sessions that have received nothing for UPLOAD_SESSION_TTL seconds"""
+    cutoff = datetime.utcnow() - timedelta(seconds=current_app.config.get('UPLOAD_SESSION_TTL', 86400))
+    expired = db.session.execute(
+        select(UploadSession.id, UploadSession.reservation_id).where(UploadSession.date_updated < cutoff)
+    ).all()
+    if not expired:
+        return 0
+    reservation_ids = [reservation_id for _, reservation_id in expired if reservation_id]
+    expired = [session_id for session_id, _ in expired]
+    db.session.execute(delete(UploadChunk).where(UploadChunk.session_id.in_(expired)))
+    db.session.execute(
+        delete(UploadSession).where(UploadSession.id.in_(expired))
+        .execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+    for reservation_id in reservation_ids:
+        release_reservation(reservation_id)
+    upload_folder = current_app.config['UPLOAD_FOLDER']
+    unlink_paths([os.path.join(upload_folder, f".session_{session_id}") for session_id in expired])
+    return len(expired)
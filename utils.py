@@ -1,10 +1,22 @@
-import os
+import json
 import uuid
+import base64
 import mimetypes
+from datetime import datetime
 from werkzeug.utils import secure_filename
 from flask import current_app
-from models import File, User, Folder
+from sqlalchemy import select, update, delete, insert, literal, func, desc, and_, tuple_
+from sqlalchemy.orm import aliased
+from models import User, File, Folder, FolderClosure, StorageClass
 from app import db
+from blobstore import store_stream, release_blob, release_blobs, delete_contents
+from compression import is_compressible
+from stats import count_files, count_matching_files, count_folders
+from previews import schedule_previews
+from quota import ReservedStream, QuotaExceededError, charge_quota, credit_quota, settle_reservation
+from auth import get_user
+from metrics import record_transfer
+from changes import record_change, record_folder_deletions
 import logging
 
 # File type mapping
@@ -26,6 +38,66 @@ def get_file_type(filename):
     
     return 'other'
 
+# Columns file listings can be ordered by, keyed by the sort_by values the API accepts
+FILE_SORT_KEYS = {
+    'name': File.original_filename,
+    'date': File.date_uploaded,
+    'date_uploaded': File.date_uploaded,
+    'size': File.size,
+    'type': File.file_type,
+}
+# What an unknown sort_by falls back to
+DEFAULT_FILE_SORT = 'date'
+
+def normalize_file_sort(sort_by):
+    """Map a requested sort_by onto FILE_SORT_KEYS, falling back to DEFAULT_FILE_SORT"""
+    return sort_by if sort_by in FILE_SORT_KEYS else DEFAULT_FILE_SORT
+
+def encode_cursor(value, item_id):
+    """Encode the sort key and id of the last row of a page as an opaque cursor"""
+    if isinstance(value, datetime):
+        value = value.isoformat()
+    return base64.urlsafe_b64encode(json.dumps([value, item_id]).encode()).decode().rstrip('=')
+
+def decode_cursor(cursor, sort_by):
+    """Decode a cursor back into (sort key, id); raises ValueError if it is malformed"""
+    sort_by = normalize_file_sort(sort_by)
+    try:
+        value, item_id = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        if FILE_SORT_KEYS[sort_by] is File.date_uploaded:
+            value = datetime.fromisoformat(value)
+        return value, int(item_id)
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+
+def paginate_files(query, sort_by='name', order='asc', cursor=None, limit=100):
+    """Get one page of a file query in sort order, starting after `cursor`.
+    
+    Returns (files, next_cursor), where next_cursor is None on the last page.
+    """
+    # Normalized once, so the cursor is decoded against the column actually sorted on
+    sort_by = normalize_file_sort(sort_by)
+    column = FILE_SORT_KEYS[sort_by]
+    descending = order != 'asc'
+    
+    # Keyset pagination: continue strictly after the last (sort key, id) seen
+    if cursor:
+        value, file_id = decode_cursor(cursor, sort_by)
+        key, last = tuple_(column, File.id), tuple_(value, file_id)
+        query = query.filter(key < last if descending else key > last)
+    
+    if descending:
+        query = query.order_by(column.desc(), File.id.desc())
+    else:
+        query = query.order_by(column.asc(), File.id.asc())
+    files = query.limit(limit + 1).all()
+    
+    next_cursor = None
+    if len(files) > limit:
+        files = files[:limit]
+        next_cursor = encode_cursor(getattr(files[-1], column.key), files[-1].id)
+    return files, next_cursor
+
 def get_unique_filename(original_filename):
     """Generate a unique filename to prevent overwriting"""
     filename = secure_filename(original_filename)
@@ -36,64 +108,113 @@ def get_unique_filename(original_filename):
         return f"{name}_{unique_id}.{ext}"
     return f"{filename}_{unique_id}"
 
+# Allowance for the multipart boundaries and part headers that are counted in
+# the request Content-Length on top of the file bytes themselves
+MULTIPART_OVERHEAD = 64 * 1024
+
+def get_remaining_quota(user):
+    """Get the number of bytes a user can still store"""
+    return max(user.storage_limit - user.storage_used, 0)
+
+def get_upload_limit(user):
+    """Get the largest request body an upload by `user` can send and still fit in the quota"""
+    return get_remaining_quota(user) + MULTIPART_OVERHEAD
+
+def check_upload_quota(user, content_length):
+    """Reject an upload up front when its declared length cannot fit in the quota"""
+    if content_length and content_length > get_upload_limit(user):
+        return "File exceeds your storage limit"
+    return None
+
+def add_file_record(user, blob, file_size, original_filename, mimetype, folder_id=None, reservation_id=None):
+    """Create the File row for stored content and charge it to the user and folders.
+    
+    The size is taken from `reservation_id` when the upload reserved quota up
+    front. Raises QuotaExceededError if it does not fit; the caller commits
+    the session.
+    """
+    file_type = get_file_type(original_filename)
+    
+    # Charge the user's quota atomically, then update the file counters
+    if reservation_id:
+        charged = settle_reservation(reservation_id, user.id, file_size)
+    else:
+        charged = charge_quota(user.id, file_size)
+    if not charged:
+        raise QuotaExceededError("File exceeds your storage limit")
+    count_files(user.id, file_type, file_size, 1)
+    
+    # Create a new file record
+    new_file = File(
+        filename=blob.filename,
+        original_filename=original_filename,
+        file_type=file_type,
+        mimetype=mimetype,
+        size=file_size,
+        user_id=user.id,
+        folder_id=folder_id,
+        blob_id=blob.id
+    )
+    
+    # Update the size of the folder and all its ancestors
+    if folder_id:
+        adjust_folder_sizes(folder_id, file_size)
+    bump_root_version(user.id)
+    
+    db.session.add(new_file)
+    db.session.flush()
+    record_change(user.id, 'create', 'file', new_file.id, folder_id, original_filename, file_size)
+    return new_file
+
 def save_file(file, user_id, folder_id=None):
     """Save uploaded file to disk and database"""
+    stream = None
     try:
         # Get the file details
         original_filename = file.filename
         mimetype = file.content_type or mimetypes.guess_type(original_filename)[0] or 'application/octet-stream'
-        file_type = get_file_type(original_filename)
-        
-        # Generate a unique filename
-        unique_filename = get_unique_filename(original_filename)
-        
-        # Get the file path
-        filepath = os.path.join(current_app.config['UPLOAD_FOLDER'], unique_filename)
         
-        # Save the file to disk
-        file.save(filepath)
+        if folder_id and not Folder.query.filter_by(id=folder_id, user_id=user_id, deleted_at=None).first():
+            return None, "Folder not found"
         
-        # Get file size
-        file_size = os.path.getsize(filepath)
+        # Check the declared size against the user's quota before writing anything
+        user = get_user(user_id)
+        error = check_upload_quota(user, file.content_length)
+        if error:
+            return None, error
         
-        # Update user's storage usage
-        user = User.query.get(user_id)
-        if user.storage_used + file_size > user.storage_limit:
-            # Remove the file if it exceeds the user's storage limit
-            os.remove(filepath)
-            return None, "File exceeds your storage limit"
+        # End the read transaction so its connection goes back to the pool while the upload streams
+        db.session.commit()
         
-        user.storage_used += file_size
+        # Stream the file into the blob store. Quota is reserved ahead of the bytes read, so
+        # concurrent uploads cannot overshoot it; content already stored only gains a reference.
+        # Text-like types are stored compressed when a sample shows it pays off.
+        stream = ReservedStream(file.stream, user_id)
+        blob, file_size = store_stream(stream, compress=is_compressible(get_file_type(original_filename)))
         
-        # Create a new file record
-        new_file = File(
-            filename=unique_filename,
-            original_filename=original_filename,
-            file_type=file_type,
-            mimetype=mimetype,
-            size=file_size,
-            user_id=user_id,
-            folder_id=folder_id
+        # Settle the reservation against the real size and create the file record
+        new_file = add_file_record(
+            user, blob, file_size, original_filename, mimetype, folder_id, reservation_id=stream.reservation_id
         )
-        
-        # Update folder size if file is in a folder
-        if folder_id:
-            folder = Folder.query.get(folder_id)
-            if folder:
-                folder.size += file_size
-                # Update parent folder sizes recursively
-                parent = folder.parent
-                while parent:
-                    parent.size += file_size
-                    parent = parent.parent
-        
-        db.session.add(new_file)
         db.session.commit()
+        stream.settled()
+        record_transfer('in', file_size)
+        
+        # Thumbnails are rendered off the request path
+        schedule_previews(new_file)
         
         return new_file, None
+    except QuotaExceededError as e:
+        db.session.rollback()
+        return None, str(e)
     except Exception as e:
+        db.session.rollback()
         logging.error(f"Error saving file: {str(e)}")
         return None, str(e)
+    finally:
+        # Give back the reservation of an upload that did not make it
+        if stream is not None:
+            stream.release()
 
 def delete_file(file_id, user_id):
     """Delete a file from disk and database"""
@@ -102,40 +223,125 @@ def delete_file(file_id, user_id):
         if not file:
             return False, "File not found"
         
-        # Get the file path
-        filepath = os.path.join(current_app.config['UPLOAD_FOLDER'], file.filename)
-        
-        # Delete the file from disk
-        if os.path.exists(filepath):
-            os.remove(filepath)
-        
-        # Update user's storage usage
-        user = User.query.get(user_id)
-        user.storage_used -= file.size
-        
-        # Update folder size if file is in a folder
-        if file.folder_id:
-            folder = Folder.query.get(file.folder_id)
-            if folder:
-                folder.size -= file.size
-                # Update parent folder sizes recursively
-                parent = folder.parent
-                while parent:
-                    parent.size -= file.size
-                    parent = parent.parent
-        
-        # Delete the file record
+        # Files in the trash no longer count towards the quota or folder sizes
+        if file.deleted_at is None:
+            # Update user's storage usage and file counters
+            credit_quota(user_id, file.size)
+            count_files(user_id, file.file_type, -file.size, -1)
+            
+            # Update the size of the folder and all its ancestors
+            if file.folder_id:
+                adjust_folder_sizes(file.folder_id, -file.size)
+            bump_root_version(user_id)
+            record_change(user_id, 'delete', 'file', file.id, file.folder_id, file.original_filename, file.size)
+        
+        # Delete the file record, then drop its reference to the blob.
+        # The blob is deleted once nothing uses it any more.
+        blob_id = file.blob_id
         db.session.delete(file)
+        db.session.flush()
+        if blob_id:
+            unused_name = release_blob(blob_id)
+        else:
+            unused_name = file.filename
         db.session.commit()
         
+        # Remove the content from storage only after the database no longer points at it
+        delete_contents([unused_name])
+        
         return True, None
     except Exception as e:
+        db.session.rollback()
         logging.error(f"Error deleting file: {str(e)}")
         return False, str(e)
 
+def rename_file(file_id, user_id, name):
+    """Rename a file"""
+    try:
+        file = File.query.filter_by(id=file_id, user_id=user_id, deleted_at=None).first()
+        if not file:
+            return None, "File not found"
+        
+        # A new extension can move the file to another type in the usage counters
+        file_type = get_file_type(name)
+        if file_type != file.file_type:
+            count_files(user_id, file.file_type, -file.size, -1)
+            count_files(user_id, file_type, file.size, 1)
+        
+        file.original_filename = name
+        file.file_type = file_type
+        touch_listings(user_id, file.folder_id)
+        record_change(user_id, 'rename', 'file', file.id, file.folder_id, name, file.size)
+        db.session.commit()
+        return file, None
+    except Exception as e:
+        db.session.rollback()
+        logging.error(f"Error renaming file: {str(e)}")
+        return None, str(e)
+
+def adjust_folder_sizes(folder_id, delta):
+    """Add `delta` bytes to a folder and every ancestor in a single UPDATE, bumping their listing versions"""
+    ancestors = select(FolderClosure.ancestor_id).where(FolderClosure.descendant_id == folder_id)
+    db.session.execute(
+        update(Folder).where(Folder.id.in_(ancestors)).values(size=Folder.size + delta, version=Folder.version + 1)
+        .execution_options(synchronize_session='fetch')
+    )
+
+def bump_root_version(user_id):
+    """Mark a user's root listing as changed; runs in the caller's transaction.
+    
+    The root shows top-level folder sizes and backs the all-files API, so any
+    change in the user's tree goes through here.
+    """
+    db.session.execute(
+        update(User).where(User.id == user_id).values(root_version=User.root_version + 1)
+        .execution_options(synchronize_session=False)
+    )
+
+def touch_listings(user_id, folder_id=None, subtree=False):
+    """Bump the versions of every listing a change in a folder (None for the root) shows up in.
+    
+    That is the folder, its ancestors and the root; with `subtree`, the
+    folders below it too, whose breadcrumbs show its name.
+    """
+    if folder_id:
+        folder_ids = select(FolderClosure.ancestor_id).where(FolderClosure.descendant_id == folder_id)
+        if subtree:
+            folder_ids = folder_ids.union(
+                select(FolderClosure.descendant_id).where(FolderClosure.ancestor_id == folder_id)
+            )
+        db.session.execute(
+            update(Folder).where(Folder.id.in_(folder_ids)).values(version=Folder.version + 1)
+            .execution_options(synchronize_session=False)
+        )
+    bump_root_version(user_id)
+
+def touch_all_listings(user_id):
+    """Bump every listing of a user, for changes such as storage classes that all of them show"""
+    db.session.execute(
+        update(Folder).where(Folder.user_id == user_id).values(version=Folder.version + 1)
+        .execution_options(synchronize_session=False)
+    )
+    bump_root_version(user_id)
+
+def add_to_folder_tree(folder_id, parent_id=None):
+    """Insert closure rows linking a new folder to itself and to all ancestors of its parent"""
+    rows = select(literal(folder_id), literal(folder_id), literal(0))
+    if parent_id:
+        rows = rows.union_all(
+            select(FolderClosure.ancestor_id, literal(folder_id), FolderClosure.depth + 1)
+            .where(FolderClosure.descendant_id == parent_id)
+        )
+    db.session.execute(
+        insert(FolderClosure).from_select(['ancestor_id', 'descendant_id', 'depth'], rows)
+    )
+
 def create_folder(name, user_id, parent_id=None, storage_class_id=None):
     """Create a new folder"""
     try:
+        if parent_id and not Folder.query.filter_by(id=parent_id, user_id=user_id, deleted_at=None).first():
+            return None, "Parent folder not found"
+        
         folder = Folder(
             name=name,
             user_id=user_id,
@@ -143,12 +349,121 @@ def create_folder(name, user_id, parent_id=None, storage_class_id=None):
             storage_class_id=storage_class_id
         )
         db.session.add(folder)
+        db.session.flush()
+        add_to_folder_tree(folder.id, folder.parent_id)
+        count_folders(user_id, 1)
+        touch_listings(user_id, folder.parent_id)
+        record_change(user_id, 'create', 'folder', folder.id, folder.parent_id, name)
         db.session.commit()
         return folder, None
     except Exception as e:
+        db.session.rollback()
         logging.error(f"Error creating folder: {str(e)}")
         return None, str(e)
 
+def rename_folder(folder_id, user_id, name):
+    """Rename a folder"""
+    try:
+        folder = Folder.query.filter_by(id=folder_id, user_id=user_id, deleted_at=None).first()
+        if not folder:
+            return None, "Folder not found"
+        
+        folder.name = name
+        touch_listings(user_id, folder.id, subtree=True)
+        record_change(user_id, 'rename', 'folder', folder.id, folder.parent_id, name)
+        db.session.commit()
+        return folder, None
+    except Exception as e:
+        db.session.rollback()
+        logging.error(f"Error renaming folder: {str(e)}")
+        return None, str(e)
+
+def bulk_delete_folders(folder_ids, user_id):
+    """Delete folders and everything below them with set-based statements.
+    
+    Runs in the caller's transaction and returns the names of content that is
+    no longer referenced; delete it once the session has committed.
+    """
+    batch_size = current_app.config.get('DELETE_BATCH_SIZE', 500)
+    roots = select(Folder.id).where(Folder.id.in_(folder_ids), Folder.user_id == user_id)
+    
+    # Whole subtree in one query, deepest folders first so children are removed before parents
+    subtree_closure = aliased(FolderClosure)
+    subtree = select(subtree_closure.descendant_id).where(subtree_closure.ancestor_id.in_(roots))
+    rows = db.session.execute(
+        select(subtree_closure.descendant_id, func.max(subtree_closure.depth).label('depth'))
+        .where(subtree_closure.ancestor_id.in_(roots))
+        .group_by(subtree_closure.descendant_id)
+        .order_by(desc('depth'))
+    ).all()
+    subtree_ids = [folder_id for folder_id, _ in rows]
+    if not subtree_ids:
+        return []
+    
+    in_subtree = and_(File.folder_id.in_(subtree), File.user_id == user_id)
+    # Trashed files were already taken out of folder sizes and the quota
+    counted = and_(in_subtree, File.deleted_at.is_(None))
+    
+    # Shrink the surviving ancestors by what each loses, in one aggregate UPDATE
+    ancestor_closure = aliased(FolderClosure)
+    lost_size = (
+        select(func.coalesce(func.sum(File.size), 0))
+        .join(FolderClosure, FolderClosure.descendant_id == File.folder_id)
+        .where(FolderClosure.ancestor_id == Folder.id, counted)
+        .scalar_subquery()
+    )
+    db.session.execute(
+        update(Folder)
+        .where(
+            Folder.id.in_(select(ancestor_closure.ancestor_id).where(ancestor_closure.descendant_id.in_(roots))),
+            Folder.id.not_in(subtree)
+        )
+        .values(size=Folder.size - lost_size, version=Folder.version + 1)
+        .execution_options(synchronize_session=False)
+    )
+    bump_root_version(user_id)
+    record_folder_deletions(user_id, roots)
+    
+    # Release the user's storage in one UPDATE
+    total_size = db.session.execute(
+        select(func.coalesce(func.sum(File.size), 0)).where(counted)
+    ).scalar()
+    credit_quota(user_id, total_size)
+    
+    # Take the live files and folders out of the user's counters
+    count_matching_files(user_id, counted, -1)
+    live_folders = db.session.execute(
+        select(func.count()).where(Folder.id.in_(subtree), Folder.deleted_at.is_(None))
+    ).scalar()
+    count_folders(user_id, -live_folders)
+    
+    # Work out which content loses references before the rows go away
+    ref_counts = dict(db.session.execute(
+        select(File.blob_id, func.count()).where(in_subtree, File.blob_id.is_not(None)).group_by(File.blob_id)
+    ).all())
+    legacy_names = db.session.execute(
+        select(File.filename).where(in_subtree, File.blob_id.is_(None))
+    ).scalars().all()
+    
+    # Remove the rows in batches: files, then tree links, then folders
+    batches = [subtree_ids[i:i + batch_size] for i in range(0, len(subtree_ids), batch_size)]
+    for batch in batches:
+        db.session.execute(
+            delete(File).where(File.folder_id.in_(batch)).execution_options(synchronize_session=False)
+        )
+    unused_names = release_blobs(ref_counts, batch_size)
+    for batch in batches:
+        db.session.execute(
+            delete(FolderClosure).where(FolderClosure.descendant_id.in_(batch))
+            .execution_options(synchronize_session=False)
+        )
+    for batch in batches:
+        db.session.execute(
+            delete(Folder).where(Folder.id.in_(batch)).execution_options(synchronize_session=False)
+        )
+    
+    return unused_names + legacy_names
+
 def delete_folder(folder_id, user_id):
     """Delete a folder and all its contents"""
     try:
@@ -156,37 +471,41 @@ def delete_folder(folder_id, user_id):
         if not folder:
             return False, "Folder not found"
         
-        # Get the size of the folder
-        folder_size = folder.size
-        
-        # Delete all files in the folder
-        for file in folder.files:
-            delete_file(file.id, user_id)
-        
-        # Delete all subfolders recursively
-        for subfolder in folder.subfolders:
-            delete_folder(subfolder.id, user_id)
-        
-        # Update parent folder size
-        if folder.parent_id:
-            parent = Folder.query.get(folder.parent_id)
-            if parent:
-                parent.size -= folder_size
-                # Update parent folder sizes recursively
-                grandparent = parent.parent
-                while grandparent:
-                    grandparent.size -= folder_size
-                    grandparent = grandparent.parent
-        
-        # Delete the folder record
-        db.session.delete(folder)
+        unused_names = bulk_delete_folders([folder.id], user_id)
         db.session.commit()
         
+        # Remove the content from storage only after the database no longer points at it
+        delete_contents(unused_names)
+        
         return True, None
     except Exception as e:
+        db.session.rollback()
         logging.error(f"Error deleting folder: {str(e)}")
         return False, str(e)
 
+def delete_storage_class(storage_class_id, user_id):
+    """Delete a storage class along with all of its folders"""
+    try:
+        storage_class = StorageClass.query.filter_by(id=storage_class_id, user_id=user_id).first()
+        if not storage_class:
+            return False, "Storage class not found"
+        
+        folder_ids = db.session.execute(
+            select(Folder.id).where(Folder.storage_class_id == storage_class.id, Folder.user_id == user_id)
+        ).scalars().all()
+        unused_names = bulk_delete_folders(folder_ids, user_id)
+        db.session.execute(delete(StorageClass).where(StorageClass.id == storage_class.id))
+        touch_all_listings(user_id)
+        db.session.commit()
+        
+        delete_contents(unused_names)
+        
+        return True, None
+    except Exception as e:
+        db.session.rollback()
+        logging.error(f"Error deleting storage class: {str(e)}")
+        return False, str(e)
+
 def get_human_readable_size(size_bytes):
     """Convert bytes to human-readable format"""
     if size_bytes == 0: